@@ -0,0 +1,239 @@
+'''
+Benchmark suite for the hot paths of opl. Runs each benchmark against the local stand-in servers (started in a
+separate process so they do not skew timings or memory) and writes the results as JSON, e.g.:
+
+    python benchmarks/run.py --sizes 1000 10000 100000 --repeat 5 --output bench.json
+'''
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import datetime
+import tracemalloc
+import multiprocessing
+from typing import Callable, Dict, List, NamedTuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opl
+import servers
+
+
+class Case(NamedTuple):
+    '''
+    A prepared benchmark: `run` performs one measured operation which processes `rows` rows
+    '''
+    run: Callable[[], object]
+    rows: int
+
+
+# each benchmark takes (size, server URLs) and prepares a case
+def bench_incquery_execute(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_project = opl.IncQueryProject(h_urls['incquery'], 'bench', 'bench', compartment=f'mms-index:/bench/{n_size}')
+    return Case(lambda: k_project.execute('bench'), n_size)
+
+def bench_incquery_execute_columns(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_project = opl.IncQueryProject(h_urls['incquery'], 'bench', 'bench', compartment=f'mms-index:/bench/{n_size}')
+    return Case(lambda: k_project.execute_columns('bench'), n_size)
+
+# each row is extended by a query yielding 10 matches; rows repeat 10 distinct join keys
+def _extension(n_size: int, h_urls: Dict[str, str]):
+    k_project = opl.IncQueryProject(h_urls['incquery'], 'bench', 'bench', compartment='mms-index:/bench/10')
+    a_rows = [{'element': {'relativeElementID': f'_element_{i_row % 10}'}} for i_row in range(max(1, n_size // 100))]
+    k_field = opl.QueryField(
+        join=lambda g_row: {'element': g_row['element']},
+        query='bench',
+        select=lambda g_match: g_match['name'],
+    )
+    return k_project, a_rows, k_field
+
+def bench_incquery_extend_row(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_project, a_rows, k_field = _extension(n_size, h_urls)
+    return Case(lambda: [k_project.extend_row(g_row, k_field) for g_row in a_rows], len(a_rows))
+
+def bench_incquery_extend_rows(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_project, a_rows, k_field = _extension(n_size, h_urls)
+    return Case(lambda: k_project.extend_rows(a_rows, k_field), len(a_rows))
+
+S_TEMPLATE = '''
+# @def labeled
+ask {
+    ?thing rdfs:label ?label .
+    filter(lang(?label) = 'en')
+}
+# @end
+select ?thing ?label {
+    ?thing a <$type> ;
+        :relatedTo <$target> .
+
+    # @mixin labeled
+
+    # @inject $filter
+}
+'''
+
+def bench_sparql_load(n_size: int, h_urls: Dict[str, str]) -> Case:
+    def run():
+        for i_row in range(n_size):
+            opl.Sparql.load(S_TEMPLATE, {
+                'type': 'https://openmbee.org/rdf/bench/Type',
+                'target': f'https://openmbee.org/rdf/bench/{i_row}',
+            }, {'filter': 'filter(?thing != ?target)'})
+    return Case(run, n_size)
+
+def bench_sparql_fetch(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_sparql = opl.Sparql(f'{h_urls["sparql"]}/sparql/{n_size}')
+    return Case(lambda: k_sparql.fetch('select * { ?s ?p ?o }'), n_size)
+
+def bench_sparql_fetch_iter(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_sparql = opl.Sparql(f'{h_urls["sparql"]}/sparql/{n_size}')
+    return Case(lambda: sum(1 for _ in k_sparql.fetch_iter('select * { ?s ?p ?o }')), n_size)
+
+def bench_sparql_construct(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_sparql = opl.Sparql(f'{h_urls["sparql"]}/sparql/{n_size}')
+    return Case(lambda: k_sparql.construct('construct { ?s ?p ?o } { ?s ?p ?o }'), n_size)
+
+def bench_sparql_construct_stream(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_sparql = opl.Sparql(f'{h_urls["sparql"]}/sparql/{n_size}')
+    return Case(lambda: k_sparql.construct_stream('construct { ?s ?p ?o } { ?s ?p ?o }').close(), n_size)
+
+def bench_sparql_construct_graph(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_sparql = opl.Sparql(f'{h_urls["sparql"]}/sparql/{n_size}')
+    return Case(lambda: k_sparql.construct_graph('construct { ?s ?p ?o } { ?s ?p ?o }'), n_size)
+
+def bench_sparql_construct_triples(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_sparql = opl.Sparql(f'{h_urls["sparql"]}/sparql/{n_size}')
+    return Case(lambda: sum(1 for _ in k_sparql.construct_triples('construct { ?s ?p ?o } { ?s ?p ?o }')), n_size)
+
+# the same query issued 10 times concurrently; rows are per query
+def bench_sparql_async_fetch(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_sparql = opl.AsyncSparql(f'{h_urls["sparql"]}/sparql/{n_size}')
+
+    async def run():
+        return await asyncio.gather(*[k_sparql.fetch('select * { ?s ?p ?o }') for _ in range(10)])
+
+    return Case(lambda: asyncio.run(run()), n_size * 10)
+
+def bench_table_to_html(n_size: int, h_urls: Dict[str, str]) -> Case:
+    a_rows = [{'name': f'Element <{i_row}>', 'tags': ['a', 'b & c'], 'id': str(i_row)} for i_row in range(n_size)]
+    k_table = opl.QueryResultsTable(a_rows, {'name': 'Name', 'tags': 'Tags', 'id': 'ID'}, {
+        'id': lambda s_value, g_row: f'<code>{s_value}</code>',
+    })
+    return Case(lambda: k_table.to_html(), n_size)
+
+def bench_page_update_content(n_size: int, h_urls: Dict[str, str]) -> Case:
+    k_wiki = opl.Confluence(h_urls['confluence'], 'bench', 'bench')
+    k_page = k_wiki.page(str(n_size))
+    sx_content = '<table><tbody>'+''.join(f'<tr><td>Updated {i_row}</td></tr>' for i_row in range(n_size))+'</tbody></table>'
+    return Case(lambda: k_page.update_content(sx_content), n_size)
+
+
+H_BENCHMARKS = {
+    'incquery.execute': bench_incquery_execute,
+    'incquery.execute_columns': bench_incquery_execute_columns,
+    'incquery.extend_row': bench_incquery_extend_row,
+    'incquery.extend_rows': bench_incquery_extend_rows,
+    'sparql.load': bench_sparql_load,
+    'sparql.fetch': bench_sparql_fetch,
+    'sparql.fetch_iter': bench_sparql_fetch_iter,
+    'sparql.async_fetch': bench_sparql_async_fetch,
+    'sparql.construct': bench_sparql_construct,
+    'sparql.construct_stream': bench_sparql_construct_stream,
+    'sparql.construct_graph': bench_sparql_construct_graph,
+    'sparql.construct_triples': bench_sparql_construct_triples,
+    'table.to_html': bench_table_to_html,
+    'confluence.update_content': bench_page_update_content,
+}
+
+
+# nearest-rank percentile of sorted values
+def _percentile(a_sorted: List[float], x_percent: float) -> float:
+    i_rank = max(0, min(len(a_sorted) - 1, int(round(x_percent / 100 * len(a_sorted) + 0.5)) - 1))
+    return a_sorted[i_rank]
+
+def measure(si_bench: str, n_size: int, n_repeat: int, h_urls: Dict[str, str]) -> dict:
+    k_case = H_BENCHMARKS[si_bench](n_size, h_urls)
+
+    # warm up
+    k_case.run()
+
+    # latency
+    a_latencies = []
+    for _ in range(n_repeat):
+        x_start = time.perf_counter()
+        k_case.run()
+        a_latencies.append(time.perf_counter() - x_start)
+
+    # peak memory of a separate run, since tracing slows execution down
+    tracemalloc.start()
+    k_case.run()
+    _, n_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    a_sorted = sorted(a_latencies)
+    x_median = _percentile(a_sorted, 50)
+    return {
+        'benchmark': si_bench,
+        'size': n_size,
+        'rows': k_case.rows,
+        'repeat': n_repeat,
+        'latency_ms': {
+            'min': a_sorted[0] * 1e3,
+            'mean': sum(a_sorted) / len(a_sorted) * 1e3,
+            'p50': x_median * 1e3,
+            'p90': _percentile(a_sorted, 90) * 1e3,
+            'p99': _percentile(a_sorted, 99) * 1e3,
+            'max': a_sorted[-1] * 1e3,
+        },
+        'throughput_rows_per_s': k_case.rows / x_median if x_median else None,
+        'peak_memory_bytes': n_peak,
+    }
+
+
+def main(a_argv: List[str]=None):
+    y_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    y_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='payload sizes in rows')
+    y_parser.add_argument('--repeat', type=int, default=5, help='number of measured runs per benchmark and size')
+    y_parser.add_argument('--only', nargs='+', default=None, help='only run benchmarks whose name starts with one of these')
+    y_parser.add_argument('--output', default=None, help='path to write the JSON results to; defaults to stdout')
+    g_args = y_parser.parse_args(a_argv)
+
+    # select benchmarks
+    a_benches = [si_bench for si_bench in H_BENCHMARKS if not g_args.only or any(si_bench.startswith(s_prefix) for s_prefix in g_args.only)]
+
+    # start stand-in servers in a separate process
+    y_ports = multiprocessing.Queue()
+    y_process = multiprocessing.Process(target=servers.serve, args=(y_ports,), daemon=True)
+    y_process.start()
+    h_urls = y_ports.get(timeout=30)
+
+    try:
+        a_results = []
+        for si_bench in a_benches:
+            for n_size in g_args.sizes:
+                g_result = measure(si_bench, n_size, g_args.repeat, h_urls)
+                a_results.append(g_result)
+                print(f'{si_bench} [{n_size}]: p50 {g_result["latency_ms"]["p50"]:.2f} ms', file=sys.stderr)
+    finally:
+        y_process.terminate()
+
+    sx_report = json.dumps({
+        'opl_version': opl.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'results': a_results,
+    }, indent=2)
+
+    if g_args.output:
+        with open(g_args.output, 'w') as d_output:
+            d_output.write(sx_report)
+    else:
+        print(sx_report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+'''
+Local stand-in HTTP servers for the IncQuery, SPARQL and Confluence APIs used by opl, producing synthetic payloads
+whose size is encoded in each request so that benchmarks can scale them from a handful of rows to millions:
+
+ - IncQuery: the number of matches is the trailing path segment of the compartment IRI, e.g., `mms-index:/bench/1000`
+ - SPARQL: the number of rows/triples is the trailing path segment of the endpoint URL, e.g., `/sparql/1000`
+ - Confluence: the page ID is the number of table rows in the page body
+'''
+import re
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+P_BENCH = 'https://openmbee.org/rdf/bench/'
+P_XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+# trailing number in a string
+def _size(s_value: str) -> int:
+    m_size = re.search(r'(\d+)\D*$', s_value or '')
+    return int(m_size.group(1)) if m_size else 0
+
+# synthetic element descriptor, with a limited number of distinct elements so that interning is exercised
+def _element(i_row: int) -> dict:
+    return {
+        'compartmentURI': 'mms-index:/bench',
+        'relativeElementID': f'_element_{i_row % 997}',
+    }
+
+def _incquery_matches(n_rows: int) -> bytes:
+    return json.dumps({
+        'queryFQN': 'bench',
+        'binding': [],
+        'matchSetSize': n_rows,
+        'matches': [
+            {'arguments': [
+                {'parameter': 'element', 'value': _element(i_row)},
+                {'parameter': 'name', 'value': f'Element {i_row}'},
+            ]} for i_row in range(n_rows)
+        ],
+    }).encode()
+
+def _sparql_json(n_rows: int) -> bytes:
+    return json.dumps({
+        'head': {'vars': ['s', 'label', 'count']},
+        'results': {'bindings': [
+            {
+                's': {'type': 'uri', 'value': f'{P_BENCH}{i_row}'},
+                'label': {'type': 'literal', 'value': f'Row {i_row}', 'xml:lang': 'en'},
+                'count': {'type': 'literal', 'value': str(i_row), 'datatype': P_XSD+'integer'},
+            } for i_row in range(n_rows)
+        ]},
+    }).encode()
+
+def _sparql_tsv(n_rows: int) -> bytes:
+    return ('?s\t?label\t?count\n'+''.join(
+        f'<{P_BENCH}{i_row}>\t"Row {i_row}"@en\t{i_row}\n' for i_row in range(n_rows)
+    )).encode()
+
+def _sparql_turtle(n_rows: int) -> bytes:
+    return ''.join(
+        f'<{P_BENCH}{i_row}> <{P_BENCH}label> "Row {i_row}"@en .\n' for i_row in range(n_rows)
+    ).encode()
+
+def _confluence_body(n_rows: int) -> str:
+    return '<table><tbody>'+''.join(f'<tr><td>Row {i_row}</td></tr>' for i_row in range(n_rows))+'</tbody></table>'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *a_args):
+        pass
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send(self, sb_body: bytes, s_type: str='application/json', n_status: int=200):
+        self.send_response(n_status)
+        self.send_header('Content-Type', s_type)
+        self.send_header('Content-Length', str(len(sb_body)))
+        self.end_headers()
+        self.wfile.write(sb_body)
+
+
+class _IncQueryHandler(_Handler):
+    def do_GET(self):
+        if self.path.endswith('/inmemory-index.listModelCompartments'):
+            return self._send(json.dumps({'inmemoryModelCompartments': []}).encode())
+        self._send(b'{}', n_status=404)
+
+    def do_POST(self):
+        g_body = json.loads(self._read_body() or b'{}')
+
+        if self.path.endswith('/inmemory-index.loadModelCompartment'):
+            return self._send(json.dumps({'message': 'loaded', 'statistics': {
+                si_stat: 0 for si_stat in (
+                    'elementStoreSize', 'elementStoreTuples', 'directInstancesStoreSize',
+                    'attributeStoreSize', 'attributeStoreTuples', 'referenceStoreSize',
+                    'referenceStoreTuples', 'mergedUniqueElements', 'mergedLoadCost',
+                )
+            }}).encode())
+        elif self.path.endswith('/demo.executeQueryOneOff'):
+            return self._send(_incquery_matches(_size(g_body['modelCompartment']['compartmentURI'])))
+        self._send(b'{}', n_status=404)
+
+
+class _SparqlHandler(_Handler):
+    def do_POST(self):
+        self._read_body()
+        n_rows = _size(urlparse(self.path).path)
+        s_accept = self.headers.get('Accept') or ''
+
+        # synthetic turtle is also valid n-triples
+        if 'text/turtle' in s_accept:
+            return self._send(_sparql_turtle(n_rows), 'text/turtle')
+        elif 'application/n-triples' in s_accept:
+            return self._send(_sparql_turtle(n_rows), 'application/n-triples')
+        elif 'text/tab-separated-values' in s_accept:
+            return self._send(_sparql_tsv(n_rows), 'text/tab-separated-values')
+        self._send(_sparql_json(n_rows), 'application/sparql-results+json')
+
+    do_GET = do_POST
+
+
+class _ConfluenceHandler(_Handler):
+    _h_versions = {}
+    _k_lock = threading.Lock()
+
+    def _page(self, si_page: str, b_body: bool=True) -> dict:
+        with self._k_lock:
+            n_version = self._h_versions.setdefault(si_page, 1)
+
+        g_page = {
+            'id': si_page,
+            'type': 'page',
+            'title': f'Benchmark {si_page}',
+            'version': {'number': n_version},
+        }
+
+        if b_body:
+            g_page['body'] = {'storage': {'value': _confluence_body(_size(si_page)), 'representation': 'storage'}}
+
+        return g_page
+
+    def do_GET(self):
+        du_path = urlparse(self.path)
+        h_query = parse_qs(du_path.query)
+        a_parts = du_path.path.rstrip('/').split('/')
+
+        # version history
+        if a_parts[-1] == 'history':
+            g_page = self._page(a_parts[-2], False)
+            return self._send(json.dumps({'lastUpdated': g_page['version']}).encode())
+
+        # content search
+        if a_parts[-1] == 'search':
+            a_ids = re.findall(r'\d+', h_query.get('cql', [''])[0])
+            return self._send(json.dumps({'results': [self._page(si_page) for si_page in a_ids], '_links': {}}).encode())
+
+        # single page
+        b_body = 'body.storage' in (h_query.get('expand') or [''])[0]
+        self._send(json.dumps(self._page(a_parts[-1], b_body)).encode())
+
+    def do_PUT(self):
+        g_body = json.loads(self._read_body() or b'{}')
+        si_page = urlparse(self.path).path.rstrip('/').split('/')[-1]
+
+        with self._k_lock:
+            self._h_versions[si_page] = g_body.get('version', {}).get('number', 1)
+
+        self._send(json.dumps(self._page(si_page, False)).encode())
+
+
+H_HANDLERS = {
+    'incquery': _IncQueryHandler,
+    'sparql': _SparqlHandler,
+    'confluence': _ConfluenceHandler,
+}
+
+def serve(y_ports=None):
+    '''
+    Start all stand-in servers on ephemeral localhost ports and serve forever. If a queue is given,
+    a dict that maps each server name to its base URL is put on it once the servers are listening
+    '''
+    h_urls = {}
+    a_servers = []
+    for si_server, dc_handler in H_HANDLERS.items():
+        y_server = ThreadingHTTPServer(('127.0.0.1', 0), dc_handler)
+        y_server.daemon_threads = True
+        a_servers.append(y_server)
+        h_urls[si_server] = f'http://127.0.0.1:{y_server.server_port}'
+
+    for y_server in a_servers[1:]:
+        threading.Thread(target=y_server.serve_forever, daemon=True).start()
+
+    if y_ports is not None:
+        y_ports.put(h_urls)
+
+    a_servers[0].serve_forever()
+
+
+if __name__ == '__main__':
+    import queue
+    y_ports = queue.Queue()
+    threading.Thread(target=serve, args=(y_ports,), daemon=True).start()
+    print(json.dumps(y_ports.get()))
+    threading.Event().wait()
@@ -1,18 +1,34 @@
+from opl.cache import ResultCache
 from opl.confluence import Confluence
-from opl.incquery import IncQueryProject, QueryResultsTable, QueryField
-from opl.sparql import Sparql
+from opl.incquery import IncQueryProject, IncQueryProjects, QueryResults, QueryResultsTable, QueryField, QueryDiff
+from opl.sparql import Sparql, AsyncSparql, QueryTemplate
+from opl.pipeline import Pipeline, StageResult
+from opl.transport import TransportPolicy, CircuitOpen
 
+from opl import instrumentation, transport
 from opl.constants import prefixes
 from opl.patterns import patterns
 
 __version__ = '1.0.11'
 
 __all__ = [
+    'ResultCache',
     'Confluence',
     'IncQueryProject',
+    'IncQueryProjects',
+    'QueryResults',
     'QueryResultsTable',
     'QueryField',
+    'QueryDiff',
     'Sparql',
+    'AsyncSparql',
+    'QueryTemplate',
+    'Pipeline',
+    'StageResult',
+    'TransportPolicy',
+    'CircuitOpen',
+    'instrumentation',
+    'transport',
     'prefixes',
     'patterns',
 ]
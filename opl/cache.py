@@ -0,0 +1,174 @@
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict
+
+
+class ResultCache:
+    '''
+    Thread-safe LRU cache with optional expiry and an optional on-disk backing store,
+    used by the clients in this library to memoize results that are known not to change
+
+    :param size: Maximum number of entries to retain (both in memory and on disk)
+    :param ttl: Optional number of seconds after which an entry expires
+    :param path: Optional path to an SQLite database file that persists entries across processes
+    '''
+    def __init__(self, size: int=1024, ttl: float=None, path: str=None):
+        self._n_size = size
+        self._x_ttl = ttl
+        self._s_path = path
+
+        # key => (stored timestamp, value), ordered by least recently used
+        self._h_entries = OrderedDict()
+        self._k_lock = threading.RLock()
+
+        # counters
+        self._n_hits = 0
+        self._n_misses = 0
+
+        # open backing store
+        self._y_db = None
+        if path is not None:
+            self._y_db = sqlite3.connect(path, check_same_thread=False)
+            self._y_db.execute('create table if not exists entries (key text primary key, stored real, accessed real, value blob)')
+            self._y_db.commit()
+
+    @staticmethod
+    def key(*parts) -> str:
+        '''
+        Create a cache key by hashing the `repr` of the given parts
+
+        :param parts: Values that together identify a result; should have a deterministic `repr`
+        '''
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    @property
+    def hits(self) -> int:
+        return self._n_hits
+
+    @property
+    def misses(self) -> int:
+        return self._n_misses
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        '''
+        Counters describing the effectiveness of the cache
+        '''
+        return {
+            'hits': self._n_hits,
+            'misses': self._n_misses,
+            'entries': len(self._h_entries),
+        }
+
+    def _expired(self, x_stored: float) -> bool:
+        return self._x_ttl is not None and time.time() - x_stored > self._x_ttl
+
+    # insert an entry into memory and evict the least recently used ones beyond the size bound
+    def _remember(self, si_key: str, x_stored: float, z_value: Any):
+        self._h_entries[si_key] = (x_stored, z_value)
+        self._h_entries.move_to_end(si_key)
+        while len(self._h_entries) > self._n_size:
+            self._h_entries.popitem(last=False)
+
+    def get(self, key: str, default: Any=None) -> Any:
+        '''
+        Retrieve an entry, or return `default` if it is missing or has expired
+
+        :param key: The cache key
+        :param default: Value to return on a miss
+        '''
+        si_key = key
+
+        with self._k_lock:
+            # in memory
+            if si_key in self._h_entries:
+                x_stored, z_value = self._h_entries[si_key]
+
+                # still fresh
+                if not self._expired(x_stored):
+                    self._h_entries.move_to_end(si_key)
+                    self._n_hits += 1
+                    return z_value
+
+                # expired; drop it
+                del self._h_entries[si_key]
+
+            # in backing store
+            if self._y_db is not None:
+                a_row = self._y_db.execute('select stored, value from entries where key=?', (si_key,)).fetchone()
+                if a_row is not None:
+                    x_stored, sb_value = a_row
+
+                    # still fresh; promote into memory
+                    if not self._expired(x_stored):
+                        z_value = pickle.loads(sb_value)
+                        self._remember(si_key, x_stored, z_value)
+                        self._y_db.execute('update entries set accessed=? where key=?', (time.time(), si_key))
+                        self._y_db.commit()
+                        self._n_hits += 1
+                        return z_value
+
+                    # expired; drop it
+                    self._y_db.execute('delete from entries where key=?', (si_key,))
+                    self._y_db.commit()
+
+            self._n_misses += 1
+            return default
+
+    def put(self, key: str, value: Any):
+        '''
+        Store an entry
+
+        :param key: The cache key
+        :param value: The value to store; must be picklable if the cache has a backing store
+        '''
+        si_key = key
+        x_now = time.time()
+
+        with self._k_lock:
+            self._remember(si_key, x_now, value)
+
+            # persist and evict least recently accessed entries beyond the size bound
+            if self._y_db is not None:
+                self._y_db.execute('insert or replace into entries (key, stored, accessed, value) values (?, ?, ?, ?)', (
+                    si_key, x_now, x_now, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+                ))
+                self._y_db.execute('delete from entries where key not in (select key from entries order by accessed desc limit ?)', (self._n_size,))
+                self._y_db.commit()
+
+    def discard(self, key: str):
+        '''
+        Remove an entry if it exists
+
+        :param key: The cache key
+        '''
+        with self._k_lock:
+            self._h_entries.pop(key, None)
+            if self._y_db is not None:
+                self._y_db.execute('delete from entries where key=?', (key,))
+                self._y_db.commit()
+
+    def clear(self):
+        '''
+        Remove all entries and reset the counters
+        '''
+        with self._k_lock:
+            self._h_entries.clear()
+            self._n_hits = 0
+            self._n_misses = 0
+            if self._y_db is not None:
+                self._y_db.execute('delete from entries')
+                self._y_db.commit()
+
+    def close(self):
+        '''
+        Close the backing store, if any
+        '''
+        with self._k_lock:
+            if self._y_db is not None:
+                self._y_db.close()
+                self._y_db = None
@@ -1,4 +1,125 @@
+import re
+import time
+import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
 import atlassian
+import requests
+
+from .cache import ResultCache
+from .instrumentation import span
+from . import transport as _transport
+from .transport import TransportPolicy
+
+
+# render the XHTML for a Confluence `span` macro wrapping the given content
+def _span_macro_xhtml(span_id: str, content: str, macro_id: str=None) -> str:
+    return '''
+            <ac:structured-macro ac:name="span" ac:schema-version="1" ac:macro-id="{macro_id}">
+                <ac:parameter ac:name="id">{span_id}</ac:parameter>
+                <ac:parameter ac:name="atlassian-macro-output-type">INLINE</ac:parameter>
+                <ac:rich-text-body>
+                    <p class="auto-cursor-target">
+                        <br />
+                    </p>
+                    {content}
+                    <p class="auto-cursor-target">
+                        <br />
+                    </p>
+                </ac:rich-text-body>
+            </ac:structured-macro>
+        '''.format(
+            macro_id=macro_id or str(uuid.uuid4()),
+            span_id=span_id,
+            content=content,
+        )
+
+# derive a deterministic macro ID from the content of a span so that unchanged spans can be recognized on the page
+def _content_macro_id(content: str) -> str:
+    return str(uuid.UUID(hashlib.sha256(content.encode()).hexdigest()[:32], version=4))
+
+# opening, closing and self-closing macro tags within storage format XHTML; CDATA sections are matched so they can be skipped
+_R_MACRO_TAG = re.compile(r'(?s)<!\[CDATA\[.*?\]\]>|<(/?)ac:structured-macro\b([^>]*?)(/?)>')
+
+# end of the parameters of a macro, which precede its body and any macro nested inside it
+_R_MACRO_HEAD_END = re.compile(r'<ac:structured-macro\b|<ac:rich-text-body>')
+
+# locate an entire `span` macro by its span ID within storage format XHTML, including any macros nested inside it;
+# returns (start, end, attributes of its opening tag), or None if there is no such span
+def _find_span_macro(sx_page: str, span_id: str) -> Optional[Tuple[int, int, str]]:
+    r_id = re.compile(r'<ac:parameter ac:name="id">'+re.escape(span_id)+r'</ac:parameter>')
+
+    # open macros as (start, attributes, whether it is the span being located)
+    a_open = []
+    for m_tag in _R_MACRO_TAG.finditer(sx_page):
+        s_slash, s_attrs, s_self_closing = m_tag.groups()
+
+        # CDATA or self-closing macro
+        if s_attrs is None or s_self_closing:
+            continue
+
+        # opening tag
+        if not s_slash:
+            b_target = False
+            if re.search(r'\bac:name="span"', s_attrs):
+                m_head_end = _R_MACRO_HEAD_END.search(sx_page, m_tag.end())
+                b_target = r_id.search(sx_page, m_tag.end(), m_head_end.start() if m_head_end else len(sx_page)) is not None
+            a_open.append((m_tag.start(), s_attrs, b_target))
+        # closing tag of an open macro
+        elif a_open:
+            i_start, s_open_attrs, b_target = a_open.pop()
+            if b_target:
+                return i_start, m_tag.end(), s_open_attrs
+
+    return None
+
+
+# key of a page in the content cache
+def _page_cache_key(p_server: str, si_page: str) -> str:
+    return ResultCache.key('confluence', p_server, str(si_page))
+
+# key of the record of what was last published to a page
+def _published_cache_key(p_server: str, si_page: str) -> str:
+    return ResultCache.key('confluence.published', p_server, str(si_page))
+
+# digest of XHTML content as it was sent to Confluence, which re-serializes the storage format it returns
+def _content_digest(sx_content: str) -> str:
+    return hashlib.sha256(sx_content.encode()).hexdigest()
+
+# entry to store in the content cache for a page object returned by the Confluence REST API
+def _page_cache_entry(g_page: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'title': g_page['title'],
+        'version': g_page['version'],
+        'body': g_page['body']['storage']['value'],
+    }
+
+
+# spaces out calls so that no more than a given number start per second, across threads
+class _RateLimiter:
+    def __init__(self, x_rate: float=None):
+        self._x_interval = 1.0 / x_rate if x_rate else 0.0
+        self._x_next = 0.0
+        self._k_lock = threading.Lock()
+
+    def wait(self):
+        # unlimited
+        if not self._x_interval:
+            return
+
+        # reserve the next slot
+        with self._k_lock:
+            x_now = time.monotonic()
+            x_start = max(x_now, self._x_next)
+            self._x_next = x_start + self._x_interval
+
+        # wait for it
+        if x_start > x_now:
+            time.sleep(x_start - x_now)
+
 
 class _Page:
     '''
@@ -15,17 +136,46 @@ class _Page:
     @property
     def version(self):
         if self._g_version is None:
-            self.get_content()
+            self._fetch_metadata()
         return self._g_version
 
+    # fetch only the title and version of the page, without its body
+    def _fetch_metadata(self):
+        _g_page = _transport.call(self._k_wiki._k_transport, self._y_confluence.url, lambda: self._y_confluence.get_page_by_id(self._si_page, expand='version'))
+        self._g_version = _g_page['version']
+        self._s_title = _g_page['title']
+
     def get_content(self) -> str:
         '''
-        Retrieve the XHTML content of the page
+        Retrieve the XHTML content of the page. If a previously downloaded copy is cached, only the page's version
+        is checked and the body is downloaded again only if the version has moved
         '''
-        _g_page = self._y_confluence.get_page_by_id(self._si_page, expand='body.storage,version')
-        self._g_version = _g_page['version']
-        self._s_title = _g_page['title']
-        return _g_page['body']['storage']['value']
+        k_cache = self._k_wiki._k_cache
+        si_key = _page_cache_key(self._y_confluence.url, self._si_page)
+
+        with span('confluence.get_content', page=self._si_page) as k_span:
+            # cached copy exists
+            g_cached = k_cache.get(si_key) if k_cache is not None else None
+            if g_cached is not None:
+                self._fetch_metadata()
+
+                # version has not moved
+                if self._g_version['number'] == g_cached['version']['number']:
+                    k_span.set('cached', True)
+                    k_span.set('bytes', len(g_cached['body']))
+                    return g_cached['body']
+
+            _g_page = _transport.call(self._k_wiki._k_transport, self._y_confluence.url, lambda: self._y_confluence.get_page_by_id(self._si_page, expand='body.storage,version'))
+            self._g_version = _g_page['version']
+            self._s_title = _g_page['title']
+
+            # save to cache
+            if k_cache is not None:
+                k_cache.put(si_key, _page_cache_entry(_g_page))
+
+            sx_content = _g_page['body']['storage']['value']
+            k_span.set('bytes', len(sx_content))
+            return sx_content
 
     def update_content(self, content: str):
         '''
@@ -33,16 +183,62 @@ class _Page:
         '''
         # page title not set; download it
         if self._s_title is None:
-            self._s_title = self._k_wiki.get_page_by_id(self._si_page)['title']
+            self._s_title = _transport.call(self._k_wiki._k_transport, self._y_confluence.url, lambda: self._y_confluence.get_page_by_id(self._si_page))['title']
 
         # update page content
-        return self._y_confluence.update_page(
-            type='page',
-            page_id=self._si_page,
-            title=self._s_title,
-            body=content,
-            minor_edit=True,
-        )
+        with span('confluence.update_content', page=self._si_page, bytes=len(content)):
+            g_updated = _transport.call(self._k_wiki._k_transport, self._y_confluence.url, lambda: self._y_confluence.update_page(
+                type='page',
+                page_id=self._si_page,
+                title=self._s_title,
+                body=content,
+                minor_edit=True,
+            ), False)
+
+        # version has moved
+        self._g_version = None
+        if self._k_wiki._k_cache is not None:
+            self._k_wiki._k_cache.discard(_page_cache_key(self._y_confluence.url, self._si_page))
+        self._k_wiki._record_published(self._si_page, content, g_updated)
+
+        return g_updated
+
+    def update_spans(self, spans: Dict[str, str]) -> bool:
+        '''
+        Update only the `span` macros whose content changed, e.g., ones created by `QueryResultsTable.to_confluence_xhtml`,
+        and skip updating the page altogether if none did. Each span is tagged with a macro ID derived from a hash of its
+        content, which is how unchanged spans are recognized on subsequent updates
+
+        :param spans: dict that maps each span ID to the XHTML content to place inside it, e.g., `QueryResultsTable.to_html()`
+        :return: True if the page was updated, False if it was already up to date
+        '''
+        sx_page = self.get_content()
+        b_changed = False
+
+        # each span
+        for si_span, sx_content in spans.items():
+            # locate span macro on page
+            a_span = _find_span_macro(sx_page, si_span)
+            if a_span is None:
+                raise Exception(f'no span with id "{si_span}" found on page {self._si_page}')
+            i_start, i_end, s_attrs = a_span
+
+            # content unchanged
+            si_macro = _content_macro_id(sx_content)
+            m_macro_id = re.search(r'\bac:macro-id="([^"]*)"', s_attrs)
+            if m_macro_id is not None and m_macro_id.group(1) == si_macro:
+                continue
+
+            # replace span macro
+            sx_page = sx_page[:i_start]+_span_macro_xhtml(si_span, sx_content, si_macro).strip()+sx_page[i_end:]
+            b_changed = True
+
+        # nothing changed; skip update
+        if not b_changed:
+            return False
+
+        self.update_content(sx_page)
+        return True
 
 
 class Confluence:
@@ -52,14 +248,48 @@ class Confluence:
     :param server: URI of the Confluence server
     :param username: Username to authenticate with
     :param password: Password to authenticate with
+    :param pool_size: Maximum number of connections to keep alive for concurrent requests
+    :param cache: ResultCache used to keep the title, version and content of pages that were downloaded, so that
+        they are only downloaded again after the page's version moves; defaults to an in-memory cache. Provide one
+        with a `path` to persist it across processes
+    :param transport: TransportPolicy that governs retries, hedging and circuit breaking of requests to the server;
+        defaults to `opl.transport.DEFAULT_POLICY`
     '''
-    def __init__(self, server: str, username: str, password: str):
+    def __init__(self, server: str, username: str, password: str, pool_size: int=10, cache: ResultCache=None, transport: TransportPolicy=None):
+        # shared session with a connection pool large enough for concurrent requests
+        y_session = requests.Session()
+        y_adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        y_session.mount('https://', y_adapter)
+        y_session.mount('http://', y_adapter)
+
         self._y_confluence = atlassian.Confluence(
             url=server,
             username=username,
             password=password,
+            session=y_session,
         )
 
+        # page content cache
+        self._k_cache = cache if cache is not None else ResultCache(size=256)
+
+        # request policy
+        self._k_transport = transport
+
+    # remember the digest of the content that produced a page's new version, so that publishing it again can be skipped
+    def _record_published(self, si_page: str, sx_content: str, g_updated: Any):
+        if self._k_cache is None or not isinstance(g_updated, dict) or 'version' not in g_updated:
+            return
+
+        self._k_cache.put(_published_cache_key(self._y_confluence.url, si_page), {
+            'version': g_updated['version']['number'],
+            'digest': _content_digest(sx_content),
+        })
+
+    # whether the given content is what was last published to a page whose current version is given
+    def _is_published(self, si_page: str, sx_content: str, n_version: int) -> bool:
+        g_published = self._k_cache.get(_published_cache_key(self._y_confluence.url, si_page)) if self._k_cache is not None else None
+        return g_published is not None and g_published['version'] == n_version and g_published['digest'] == _content_digest(sx_content)
+
     def page(self, page_id: str) -> _Page:
         '''
         Create a handle for a specific page
@@ -68,3 +298,111 @@ class Confluence:
         '''
         return _Page(self, page_id);
 
+    def fetch_pages(self, page_ids: List[str], batch_size: int=50) -> Dict[str, Dict[str, Any]]:
+        '''
+        Retrieve the title, version and XHTML content of many pages using batched CQL searches
+
+        :param page_ids: the IDs of the pages
+        :param batch_size: maximum number of pages to retrieve per request
+        :return: dict that maps each page ID found to its content object as returned by the Confluence REST API
+        '''
+        h_pages = {}
+        a_ids = list(dict.fromkeys(str(si_page) for si_page in page_ids))
+
+        # each batch of IDs
+        for i_batch in range(0, len(a_ids), batch_size):
+            a_batch = a_ids[i_batch:i_batch+batch_size]
+
+            # each page of search results
+            i_start = 0
+            while True:
+                g_response = _transport.call(self._k_transport, self._y_confluence.url, lambda: self._y_confluence.get('rest/api/content/search', params={
+                    'cql': 'id in ({})'.format(','.join(a_batch)),
+                    'expand': 'body.storage,version',
+                    'start': i_start,
+                    'limit': batch_size,
+                }))
+
+                a_results = g_response['results']
+                for g_page in a_results:
+                    h_pages[str(g_page['id'])] = g_page
+
+                    # save to cache
+                    self._k_cache.put(_page_cache_key(self._y_confluence.url, g_page['id']), _page_cache_entry(g_page))
+
+                # no more results
+                i_start += len(a_results)
+                if not a_results or 'next' not in g_response.get('_links', {}):
+                    break
+
+        return h_pages
+
+    def publish(self, pages: Dict[str, str], max_workers: int=8, rate_limit: float=None, retries: int=3, return_exceptions: bool=True) -> Dict[str, Any]:
+        '''
+        Update the XHTML content of many pages concurrently over the shared session. Titles and versions are fetched in
+        batches up front and updates that hit a version conflict are retried against the latest version. A page is
+        skipped if its current version was created by this client publishing the same content, as recorded in the cache;
+        comparing against the stored content is not enough since Confluence re-serializes it
+
+        :param pages: dict that maps each page ID to its new XHTML content
+        :param max_workers: maximum number of pages to update at once
+        :param rate_limit: optional maximum number of requests to start per second
+        :param retries: number of times to retry an update after a version conflict
+        :param return_exceptions: If True, a failed update yields its exception in place of its result
+            without affecting the others; otherwise, the first failure is raised once all updates have settled
+        :return: dict that maps each page ID to the updated content object, or to None if it was already up to date
+        '''
+        # nothing to publish
+        if not pages:
+            return {}
+
+        with span('confluence.fetch_pages', pages=len(pages)):
+            h_current = self.fetch_pages(list(pages))
+        k_limiter = _RateLimiter(rate_limit)
+
+        # update a single page
+        def publish_page(si_page):
+            sx_content = pages[si_page]
+            g_page = h_current.get(str(si_page))
+
+            # page not found
+            if g_page is None:
+                raise Exception(f'page {si_page} was not found')
+
+            n_version = g_page['version']['number']
+
+            # content unchanged since it was last published, or stored verbatim
+            if self._is_published(si_page, sx_content, n_version) or g_page['body']['storage']['value'] == sx_content:
+                return None
+            i_attempt = 0
+            while True:
+                k_limiter.wait()
+                try:
+                    with span('confluence.put', page=si_page, bytes=len(sx_content), attempt=i_attempt):
+                        g_updated = _transport.call(self._k_transport, self._y_confluence.url, lambda: self._y_confluence.put(f'rest/api/content/{si_page}', data={
+                            'id': si_page,
+                            'type': 'page',
+                            'title': g_page['title'],
+                            'version': {'number': n_version+1, 'minorEdit': True},
+                            'body': {'storage': {'value': sx_content, 'representation': 'storage'}},
+                        }), False)
+
+                    self._record_published(si_page, sx_content, g_updated)
+                    return g_updated
+                except requests.HTTPError as e_put:
+                    # not a version conflict or out of retries
+                    if e_put.response is None or 409 != e_put.response.status_code or i_attempt >= retries:
+                        raise
+
+                    # fetch latest version and retry
+                    i_attempt += 1
+                    k_limiter.wait()
+                    n_version = _transport.call(self._k_transport, self._y_confluence.url, lambda: self._y_confluence.get(f'rest/api/content/{si_page}', params={'expand': 'version'}))['version']['number']
+
+        # update pages concurrently
+        a_ids = list(pages)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(a_ids)))) as y_pool:
+            a_futures = [y_pool.submit(publish_page, si_page) for si_page in a_ids]
+
+        # collect results
+        return dict(zip(a_ids, _transport.settle(a_futures, return_exceptions)))
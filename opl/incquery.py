@@ -1,11 +1,23 @@
+import os
 import re
-import uuid
+import json
 import html
+import time
+import hashlib
 import datetime
+import functools
+import threading
 from urllib.parse import urlparse
-from typing import Optional, Callable, List, Dict, Any, NamedTuple
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Iterator, List, Dict, Any, NamedTuple, Tuple, Union
 
 from .types import Hash
+from .cache import ResultCache
+from .instrumentation import span
+from . import transport as _transport
+from .transport import TransportPolicy
+from .confluence import _span_macro_xhtml
 import iqs_client
 
 # type aliases
@@ -48,6 +60,40 @@ def _dict_to_query_defs(h_queries: Hash):
     return a_defs
 
 
+# maximum number of distinct pattern sets whose compiled definitions are memoized
+N_COMPILED_DEFS = 256
+
+@functools.lru_cache(maxsize=N_COMPILED_DEFS)
+def _compile_query_defs_cached(a_items: Tuple[Tuple[str, str], ...]) -> Tuple[str, Tuple[str, ...]]:
+    a_defs = tuple(_dict_to_query_defs(dict(a_items)))
+    return hashlib.sha256('\n'.join(a_defs).encode()).hexdigest(), a_defs
+
+# compile dict of patterns into query definitions, memoized per pattern set; returns (fingerprint, definitions)
+def _compile_query_defs(h_patterns: Hash) -> Tuple[str, Tuple[str, ...]]:
+    return _compile_query_defs_cached(tuple(sorted(h_patterns.items())))
+
+# process-wide registry of (host, query package) pairs whose pattern sets are registered on the server
+_as_registered_packages = set()
+_as_unsupported_hosts = set()
+_k_registered_lock = threading.Lock()
+
+# locks that serialize registration of each (host, query package) pair, so that distinct packages register concurrently
+_h_registering_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+# statuses with which a server rejects the registration endpoint itself rather than the pattern set
+_AS_UNSUPPORTED_STATUSES = {404, 405, 501}
+
+# whether an error from executing a query by reference means the server does not know the query, e.g., after a restart
+def _unknown_query(e_api: iqs_client.rest.ApiException) -> bool:
+    if e_api.status == 404:
+        return True
+    elif e_api.status == 400:
+        z_body = e_api.body
+        s_body = z_body.decode('utf-8', 'replace') if isinstance(z_body, bytes) else str(z_body or '')
+        return re.search(r'(?i)\b(?:unknown|not\s+(?:be\s+)?found|not\s+registered|no\s+such)\b', s_body) is not None
+    return False
+
+
 # convert dict of [parameter: str => value: str] to the expected format used by API client
 def _dict_to_bindings(h_bindings: Hash):
     return [
@@ -55,6 +101,298 @@ def _dict_to_bindings(h_bindings: Hash):
     ]
 
 
+# maximum number of concurrent compartment detail lookups
+N_DETAILS_WORKERS = 16
+
+# process-wide memo of commit names by compartment URI; compartments are immutable so entries never go stale
+_h_commit_names: Dict[str, str] = {}
+_k_commit_names_lock = threading.Lock()
+
+# read the commit index file (if any) and merge it into the process-wide memo; returns (file entries, memo snapshot)
+def _load_commit_index(p_index: str=None) -> Tuple[Dict[str, str], Dict[str, str]]:
+    h_index = {}
+    if p_index is not None and os.path.exists(p_index):
+        with open(p_index) as d_index:
+            h_index = json.load(d_index)
+
+    with _k_commit_names_lock:
+        _h_commit_names.update(h_index)
+        return h_index, dict(_h_commit_names)
+
+# add commit names to the process-wide memo and write the memo's entries under the given prefix to the commit index
+# file (if any), on top of the entries it had when it was loaded; the file is only rewritten if any of them are new
+def _save_commit_index(p_index: str, h_index: Dict[str, str], s_prefix: str, h_commits: Dict[str, str]):
+    with _k_commit_names_lock:
+        _h_commit_names.update(h_commits)
+        if p_index is None:
+            return
+
+        h_new = {
+            p_compartment: s_commit for p_compartment, s_commit in _h_commit_names.items()
+            if p_compartment.startswith(s_prefix) and h_index.get(p_compartment) != s_commit
+        }
+
+        # file already up to date
+        if not h_new:
+            return
+
+        # write atomically
+        p_tmp = f'{p_index}.{os.getpid()}.tmp'
+        with open(p_tmp, 'w') as d_tmp:
+            json.dump({**h_index, **h_new}, d_tmp)
+        os.replace(p_tmp, p_index)
+
+
+# process-wide API clients keyed by (host, username, password) so that projects share connection pools
+_h_api_clients: Dict[Tuple[str, str, str], iqs_client.ApiClient] = {}
+_k_api_clients_lock = threading.Lock()
+
+# return the API client shared by all projects using the same server and credentials
+def _shared_api_client(p_host: str, s_username: str, s_password: str) -> iqs_client.ApiClient:
+    si_client = (p_host, s_username, s_password)
+    with _k_api_clients_lock:
+        if si_client not in _h_api_clients:
+            _h_api_clients[si_client] = iqs_client.ApiClient(iqs_client.Configuration(
+                host=p_host,
+                username=s_username,
+                password=s_password,
+            ))
+        return _h_api_clients[si_client]
+
+# determines the latest available commit for a given org/project/ref; may reuse a listing of the persisted compartments
+def _latest_commit(y_persistent, y_mms_repo, si_org: str, si_project: str, s_ref: str=None, b_refresh: bool=True, p_index: str=None, a_persisted: list=None, f_call: Callable[[Callable[[], Any]], Any]=None):
+    if s_ref is None: s_ref = 'master'
+
+    # sends each request
+    if f_call is None: f_call = lambda f_request: f_request()
+
+    # prepare compartment URI prefix
+    s_prefix = f'mms-index:/orgs/{si_org}/projects/{si_project}/refs/{s_ref}/commits/'
+
+    # commit index file entries, and known commit names by compartment URI
+    h_index, h_commits = _load_commit_index(p_index)
+
+    # candidate compartments => commit name
+    h_candidates = {}
+
+    # trust the index without listing
+    if not b_refresh:
+        h_candidates = {p_compartment: s_commit for p_compartment, s_commit in h_commits.items() if p_compartment.startswith(s_prefix)}
+
+    # refresh requested or nothing known yet
+    if not h_candidates:
+        # list compartments stored in persistent index
+        if a_persisted is None:
+            a_persisted = f_call(y_persistent.list_persisted_model_compartments).persisted_model_compartments
+
+        # each compartment that matches prefix target
+        a_compartments = [
+            g_persistent_compartment
+            for g_persistent_compartment in a_persisted
+            if g_persistent_compartment.compartment_uri.startswith(s_prefix)
+        ]
+
+        # only look up details for compartments not seen before
+        a_unknown = [g_compartment for g_compartment in a_compartments if g_compartment.compartment_uri not in h_commits]
+        h_found = {}
+        if a_unknown:
+            # fetch compartment details concurrently
+            with ThreadPoolExecutor(max_workers=min(N_DETAILS_WORKERS, len(a_unknown))) as y_pool:
+                a_details = list(y_pool.map(lambda g_compartment: f_call(lambda: y_mms_repo.get_repository_compartment_details(g_compartment)), a_unknown))
+
+            h_found = {
+                g_compartment.compartment_uri: g_details.commit_name for g_compartment, g_details in zip(a_unknown, a_details)
+            }
+            h_commits.update(h_found)
+
+        # memoize commit names of this ref
+        _save_commit_index(p_index, h_index, s_prefix, h_found)
+
+        h_candidates = {g_compartment.compartment_uri: h_commits[g_compartment.compartment_uri] for g_compartment in a_compartments}
+
+    # prep latest fields
+    d_latest_commit = None
+    p_latest_compartment = None
+
+    # each candidate compartment
+    for p_compartment, s_commit in h_candidates.items():
+        # parse compartment datetime
+        d_commit = datetime.datetime.strptime(s_commit, '%Y-%m-%d %H:%M:%S')
+
+        # latest by default or newer; make it latest
+        if p_latest_compartment is None or d_commit > d_latest_commit:
+            d_latest_commit = d_commit
+            p_latest_compartment = p_compartment
+
+    # return compartment URI to latest commit
+    return p_latest_compartment
+
+
+# process-wide registry of (host, compartment URI) pairs known to be loaded into the in-memory index
+_as_loaded_compartments = set()
+_k_loaded_lock = threading.Lock()
+
+
+# convert a (possibly nested) binding value into a hashable key so that equal bindings can be grouped
+def _freeze(z_value):
+    if isinstance(z_value, dict):
+        return tuple(sorted((si_key, _freeze(z_item)) for si_key, z_item in z_value.items()))
+    elif isinstance(z_value, (list, tuple)):
+        return tuple(_freeze(z_item) for z_item in z_value)
+    elif hasattr(z_value, 'to_dict'):
+        return _freeze(z_value.to_dict())
+    else:
+        return z_value
+
+
+# element descriptor keys that differ between compartments even when the element itself is unchanged
+_AS_COMPARTMENT_KEYS = {'compartmentURI', 'compartment_uri'}
+
+# hashable identity of a result row that is stable across compartments of the same project
+def _match_key(z_value):
+    if isinstance(z_value, dict):
+        return tuple(sorted((si_key, _match_key(z_item)) for si_key, z_item in z_value.items() if si_key not in _AS_COMPARTMENT_KEYS))
+    elif isinstance(z_value, (list, tuple)):
+        return tuple(_match_key(z_item) for z_item in z_value)
+    elif hasattr(z_value, 'to_dict'):
+        return _match_key(z_value.to_dict())
+    else:
+        return z_value
+
+# hashable identity of a value for joining rows with matches; element descriptors are identified by their relative
+# element ID alone since the matches of one execution all come from the same compartment and joins may produce
+# partial descriptors
+def _identity_key(z_value):
+    if hasattr(z_value, 'to_dict') and not isinstance(z_value, dict):
+        z_value = z_value.to_dict()
+
+    if isinstance(z_value, dict):
+        for si_id in ('relativeElementID', 'relative_element_id'):
+            if z_value.get(si_id) is not None:
+                return ('element', z_value[si_id])
+        return tuple(sorted((si_key, _identity_key(z_item)) for si_key, z_item in z_value.items() if si_key not in _AS_COMPARTMENT_KEYS))
+    elif isinstance(z_value, (list, tuple)):
+        return tuple(_identity_key(z_item) for z_item in z_value)
+    else:
+        return z_value
+
+# rows added and removed between two sets of results, respecting duplicates
+def _diff_rows(a_previous: List[Row], a_current: List[Row]) -> Tuple[List[Row], List[Row]]:
+    h_previous = Counter(_match_key(g_row) for g_row in a_previous)
+    h_current = Counter(_match_key(g_row) for g_row in a_current)
+
+    # rows beyond the count present on the other side
+    def surplus(a_rows, h_other):
+        h_remaining = dict(h_other)
+        a_surplus = []
+        for g_row in a_rows:
+            z_key = _match_key(g_row)
+            if h_remaining.get(z_key, 0) > 0:
+                h_remaining[z_key] -= 1
+            else:
+                a_surplus.append(g_row)
+        return a_surplus
+
+    # unchanged
+    if h_previous == h_current:
+        return [], []
+
+    return surplus(a_current, h_previous), surplus(a_previous, h_current)
+
+
+# convert a column of raw values, resolving recognizer dispatch once for the column and interning repeated elements
+def _column_to_elements(a_raw: List[Any], f_url_provider=None) -> List[Any]:
+    # converted elements by frozen descriptor
+    h_interned = {}
+
+    # recognizer resolved for this column
+    f_column = None
+
+    a_column = []
+    for z_value in a_raw:
+        # not a dict; store as-is
+        if not isinstance(z_value, dict):
+            a_column.append(z_value)
+            continue
+
+        # repeated element; reuse converted instance
+        z_key = _freeze(z_value)
+        if z_key in h_interned:
+            a_column.append(h_interned[z_key])
+            continue
+
+        g_element = None
+
+        # try recognizer resolved for this column first
+        if f_column is not None:
+            g_element = f_column(z_value)
+
+        # resolve recognizer
+        if not g_element:
+            for f_recognizer in d_element_dict_recognizers:
+                g_element = f_recognizer(z_value)
+                if g_element:
+                    f_column = f_recognizer
+                    break
+
+        # recognized
+        if g_element:
+            if f_url_provider is not None:
+                g_element.url = f_url_provider(g_element)
+        # not recognized as an element, treated as raw dict
+        else:
+            g_element = z_value
+
+        h_interned[z_key] = g_element
+        a_column.append(g_element)
+
+    return a_column
+
+
+class QueryResults:
+    '''
+    Compact, column-oriented query results as returned by `IncQueryProject.execute_columns`. Iterating yields one
+    row dict at a time; repeated elements within a column share a single instance
+
+    :param columns: A dict that maps each parameter name to its list of values
+    '''
+    __slots__ = ('_h_columns', '_n_rows')
+
+    def __init__(self, columns: Dict[str, List[Any]]):
+        self._h_columns = columns
+        self._n_rows = len(next(iter(columns.values()))) if columns else 0
+
+    @property
+    def columns(self) -> Dict[str, List[Any]]:
+        return self._h_columns
+
+    @property
+    def params(self) -> List[str]:
+        return list(self._h_columns)
+
+    def __len__(self):
+        return self._n_rows
+
+    def __iter__(self):
+        a_params = list(self._h_columns)
+        for a_values in zip(*self._h_columns.values()):
+            yield dict(zip(a_params, a_values))
+
+    def column(self, param: str) -> List[Any]:
+        '''
+        Get the list of values for the given parameter
+
+        :param param: Name of the pattern parameter
+        '''
+        return self._h_columns[param]
+
+    def to_rows(self) -> List[Row]:
+        '''
+        Convert to the list of dicts format returned by `IncQueryProject.execute`
+        '''
+        return list(self)
+
+
 class QueryField(NamedTuple):
     '''
     Descriptor for a query field to be used for extending a query result row
@@ -66,6 +404,23 @@ class QueryField(NamedTuple):
     patterns: Hash={}
 
 
+class QueryDiff(NamedTuple):
+    '''
+    Changes to the results of a watched query between the previous and current compartment of a ref
+
+    :param query: Key of the watched query
+    :param previous: IRI of the compartment the previous results were obtained from
+    :param current: IRI of the compartment the current results were obtained from
+    :param added: Rows in the current results that were not in the previous results
+    :param removed: Rows in the previous results that are no longer in the current results
+    '''
+    query: str
+    previous: str
+    current: str
+    added: List[Row]
+    removed: List[Row]
+
+
 class IncQueryProject:
     '''
     Create a new client to query a specific IncQuery project. May either
@@ -80,18 +435,25 @@ class IncQueryProject:
     :param ref: Which ref to select from the project; defaults to 'master'. Loads the latest commit from that ref
     :param compartment: Instead of specifying org, project/ref, use the specified compartment IRI
     :param patterns: Default patterns to use for implicit query executions
+    :param cache: Optional ResultCache used to memoize query results; safe since a compartment pins an immutable commit
+    :param refresh: When selecting the latest commit, whether to list the compartments on the server; if False, the
+        latest commit already recorded in the commit index is used (falls back to listing if none is recorded)
+    :param commit_index: Optional path to a JSON file that persists commit names by compartment IRI across processes,
+        so that only new compartments need a details lookup
+    :param lazy: Defer loading the compartment into the in-memory index until the first query is sent to the server
+    :param register_patterns: Register each distinct pattern set on the server once and execute queries by reference
+        instead of re-uploading the pattern definitions with every request; falls back to one-off execution if unsupported
+    :param transport: TransportPolicy that governs retries, hedging and circuit breaking of requests to the server;
+        defaults to `opl.transport.DEFAULT_POLICY`
     '''
-    def __init__(self, server: str, username: str, password: str, org: str=None, project: str=None, ref: str=None, compartment: str=None, patterns: Hash={}):
+    def __init__(self, server: str, username: str, password: str, org: str=None, project: str=None, ref: str=None, compartment: str=None, patterns: Hash={}, cache: ResultCache=None, refresh: bool=True, commit_index: str=None, lazy: bool=False, register_patterns: bool=False, transport: TransportPolicy=None):
 
         # parse server iri
         du_iqs = urlparse(server)
+        self._p_host = du_iqs.scheme + '://' + du_iqs.netloc + '/api'
 
-        # instantiate iqs_client API client
-        self._y_incquery = iqs_client.ApiClient(iqs_client.Configuration(
-            host=du_iqs.scheme + '://' + du_iqs.netloc + '/api',
-            username=username,
-            password=password,
-        ))
+        # reuse the API client (and its connection pool) shared by all projects on this server
+        self._y_incquery = _shared_api_client(self._p_host, username, password)
 
         # instantiate API groups
         self._y_incquery_queries = iqs_client.QueriesApi(self._y_incquery)
@@ -104,6 +466,15 @@ class IncQueryProject:
         # save patterns dict
         self._h_patterns = patterns
 
+        # save result cache
+        self._k_cache = cache
+
+        # request policy
+        self._k_transport = transport
+
+        # whether to register pattern sets on the server and execute by reference
+        self._b_register_patterns = register_patterns
+
         # project id specified
         if project is not None:
             if org is None:
@@ -112,61 +483,160 @@ class IncQueryProject:
                 raise Exception('if a project/ref is provided then compartment must be None')
 
             # select latest commit
-            self._s_compartment = self._latest_commit(org, project, ref)
+            self._s_compartment = self._latest_commit(org, project, ref, refresh, commit_index)
+
+            # remember ref so that newer commits can be detected later
+            self._a_ref = (org, project, ref, commit_index)
         # org id specified
         elif org is not None:
             raise Exception('must at least provide an org ID and project ID')
         # compartment IRI specified
         elif compartment is not None:
             self._s_compartment = compartment
+            self._a_ref = None
         # neither specified
         else:
             raise Exception('must specify either a project or compartment')
 
+        # whether this instance has ensured the compartment is loaded
+        self._b_loaded = False
+        self._k_load_lock = threading.Lock()
+
         # ensure the selected compartment is loaded into in-memory index
-        self._y_incquery_in_memory.load_model_compartment({
-            'compartmentURI': self._s_compartment,
-        })
+        if not lazy:
+            self._ensure_loaded()
 
-    # determines the latest available commit for a given org/project/ref
-    def _latest_commit(self, si_org: str, si_project: str, s_ref: str=None):
-        if s_ref is None: s_ref = 'master'
+    # load the selected compartment into the in-memory index unless it is already known to be resident; the caller may
+    # vouch that it is absent, e.g., from a listing it already made, in which case it is loaded without listing again
+    def _ensure_loaded(self, b_force: bool=False, b_absent: bool=False):
+        # already ensured by this instance
+        if self._b_loaded and not b_force:
+            return
+
+        with self._k_load_lock:
+            if self._b_loaded and not b_force:
+                return
+
+            si_loaded = (self._p_host, self._s_compartment)
 
-        # prepare compartment URI prefix
-        s_prefix = f'mms-index:/orgs/{si_org}/projects/{si_project}/refs/{s_ref}/commits/'
+            with _k_loaded_lock:
+                b_resident = si_loaded in _as_loaded_compartments
 
-        # prep latest fields
-        d_latest_commit = None
-        p_latest_compartment = None
+            # not yet seen by this process; ask the server what is resident
+            if b_force or not b_resident:
+                b_resident = not (b_force or b_absent) and any(
+                    g_compartment.compartment_uri == self._s_compartment
+                    for g_compartment in _transport.call(self._k_transport, self._p_host, self._y_incquery_in_memory.list_inmemory_model_compartments).inmemory_model_compartments or []
+                )
 
-        # each compartment stored in persistent index
-        for g_persistent_compartment in self._y_incquery_persistent.list_persisted_model_compartments().persisted_model_compartments:
-            p_persistent_compartment = g_persistent_compartment.compartment_uri
+                # load it
+                if not b_resident:
+                    with span('incquery.load', compartment=self._s_compartment):
+                        _transport.call(self._k_transport, self._p_host, lambda: self._y_incquery_in_memory.load_model_compartment({
+                            'compartmentURI': self._s_compartment,
+                        }), False)
 
-            # compartment URI matches prefix target
-            if p_persistent_compartment.startswith(s_prefix):
-                # fetch compartment details
-                g_details_compartment = self._y_incquery_mms_repo.get_repository_compartment_details(g_persistent_compartment)
+                # register it
+                with _k_loaded_lock:
+                    _as_loaded_compartments.add(si_loaded)
 
-                # parse compartment datetime
-                d_commit = datetime.datetime.strptime(g_details_compartment.commit_name, '%Y-%m-%d %H:%M:%S')
+            self._b_loaded = True
 
-                # latest by default or newer; make it latest
-                if p_latest_compartment is None or d_commit > d_latest_commit:
-                    d_latest_commit = d_commit
-                    p_latest_compartment = p_persistent_compartment
+    def reload(self):
+        '''
+        Force the selected compartment to be loaded into the in-memory index, e.g., after the server evicted it
+        '''
+        self._ensure_loaded(True)
 
-        # return compartment URI to latest commit
-        return p_latest_compartment
+    @property
+    def compartment(self) -> str:
+        '''
+        IRI of the selected compartment
+        '''
+        return self._s_compartment
 
+    def select_latest_commit(self) -> bool:
+        '''
+        Check the ref for a commit newer than the selected one and, if there is one, select its compartment instead.
+        The new compartment is loaded into the in-memory index before the next query is sent to the server.
+        Only available when the project was selected by org, project and ref
 
-    def execute(self, name: str, patterns: Hash={}, bindings: Row={}, w_url_provider=None) -> List[Row]:
+        :return: True if a newer commit was selected
+        '''
+        if self._a_ref is None:
+            raise Exception('can only select the latest commit of a project that was selected by org, project and ref rather than by compartment')
+
+        si_org, si_project, s_ref, p_index = self._a_ref
+        p_latest = self._latest_commit(si_org, si_project, s_ref, True, p_index)
+
+        # no newer commit
+        if p_latest is None or p_latest == self._s_compartment:
+            return False
+
+        # select new compartment
+        with self._k_load_lock:
+            self._s_compartment = p_latest
+            self._b_loaded = False
+
+        return True
+
+    def watch(self, queries: Dict[str, Tuple], interval: float=300, max_workers: int=8) -> Iterator[Dict[str, QueryDiff]]:
+        '''
+        Poll the ref for new commits and, whenever one appears, re-run the given queries against its compartment and
+        yield how their results changed relative to the previous compartment. Rows are compared by value, ignoring
+        which compartment their elements belong to. Runs until the caller stops iterating, e.g.::
+
+            for h_diffs in k_project.watch({'blocks': ('blocks',)}):
+                if h_diffs['blocks'].added or h_diffs['blocks'].removed:
+                    ...
+
+        :param queries: A dict of keys to `(name, patterns, bindings)` tuples as taken by `execute_many`
+        :param interval: Number of seconds to wait between polls
+        :param max_workers: Maximum number of queries in flight at once
+        :return: An iterator yielding a dict of keys to `QueryDiff` each time a new commit is selected
+        '''
+        a_keys = list(queries)
+
+        # run all watched queries against the selected compartment
+        def run_all():
+            a_results = self.execute_many([queries[si_key] for si_key in a_keys], max_workers=max_workers, return_exceptions=False)
+            return dict(zip(a_keys, a_results))
+
+        # baseline
+        h_previous = run_all()
+
+        while True:
+            time.sleep(interval)
+
+            s_previous = self._s_compartment
+            if not self.select_latest_commit():
+                continue
+
+            h_current = run_all()
+
+            # compute diffs
+            h_diffs = {}
+            with span('incquery.diff', compartment=self._s_compartment, queries=len(a_keys)):
+                for si_key in a_keys:
+                    a_added, a_removed = _diff_rows(h_previous[si_key], h_current[si_key])
+                    h_diffs[si_key] = QueryDiff(si_key, s_previous, self._s_compartment, a_added, a_removed)
+
+            h_previous = h_current
+            yield h_diffs
+
+    # determines the latest available commit for a given org/project/ref
+    def _latest_commit(self, si_org: str, si_project: str, s_ref: str=None, b_refresh: bool=True, p_index: str=None):
+        return _latest_commit(self._y_incquery_persistent, self._y_incquery_mms_repo, si_org, si_project, s_ref, b_refresh, p_index, f_call=functools.partial(_transport.call, self._k_transport, self._p_host))
+
+
+    def execute(self, name: str, patterns: Hash={}, bindings: Row={}, w_url_provider=None, timeout: float=None) -> List[Row]:
         '''
         Execute a query and return the results as a list of dicts
 
         :param name: Name of which pattern to execute
         :param bindings: A dict of bindings to pass into query execution
         :param patterns: A dict of patterns to include during query execution (overwrites defaults provided to constructor)
+        :param timeout: Optional number of seconds to wait for the server to connect and respond, in total across retries
         '''
         si_query = name
         h_patterns = {**self._h_patterns}
@@ -174,23 +644,211 @@ class IncQueryProject:
             h_patterns.update(patterns)
         h_bindings = bindings
 
-        # execute query
-        g_response = self._y_incquery_demo.execute_query_one_off({
-            'modelCompartment': {
-                'compartmentURI': self._s_compartment,
-            },
-            'queryLanguage': 'viatra',
-            'queryName': si_query,
-            'queryDefinitions': _dict_to_query_defs(h_patterns),
-            'parameterBinding': _dict_to_bindings(h_bindings),
-        })
-
-        # return results as list of dicts
-        return [
-            dict(
-                (g_arg.parameter, _dict_to_element(g_arg.value, w_url_provider)) for g_arg in g_match.arguments
-            ) for g_match in g_response.matches
-        ]
+        with span('incquery.execute', query=si_query) as k_span:
+            # fetch raw matches
+            a_matches = self._fetch_matches(si_query, h_patterns, h_bindings, timeout)
+            k_span.set('rows', len(a_matches))
+
+            # return results as list of dicts
+            with span('incquery.convert', query=si_query, rows=len(a_matches)):
+                return [
+                    dict(
+                        (si_param, _dict_to_element(w_value, w_url_provider)) for si_param, w_value in a_match
+                    ) for a_match in a_matches
+                ]
+
+    def execute_columns(self, name: str, patterns: Hash={}, bindings: Row={}, w_url_provider=None, timeout: float=None) -> QueryResults:
+        '''
+        Execute a query and return the results in a compact, column-oriented form. Better suited than `execute`
+        for large result sets since element conversion is resolved once per column and repeated elements are interned
+
+        :param name: Name of which pattern to execute
+        :param bindings: A dict of bindings to pass into query execution
+        :param patterns: A dict of patterns to include during query execution (overwrites defaults provided to constructor)
+        :param timeout: Optional number of seconds to wait for the server to connect and respond, in total across retries
+        '''
+        h_patterns = {**self._h_patterns}
+        if patterns is not None:
+            h_patterns.update(patterns)
+
+        with span('incquery.execute_columns', query=name) as k_span:
+            # fetch raw matches
+            a_matches = self._fetch_matches(name, h_patterns, bindings, timeout)
+            k_span.set('rows', len(a_matches))
+
+            # no matches
+            if not a_matches:
+                return QueryResults({})
+
+            with span('incquery.convert', query=name, rows=len(a_matches)):
+                # pivot raw values into columns
+                h_raw = {si_param: [] for si_param, _ in a_matches[0]}
+                for a_match in a_matches:
+                    for si_param, w_value in a_match:
+                        h_raw[si_param].append(w_value)
+
+                # convert each column
+                return QueryResults({
+                    si_param: _column_to_elements(a_raw, w_url_provider) for si_param, a_raw in h_raw.items()
+                })
+
+    # execute a query and return its matches as lists of (parameter, raw value) pairs, consulting the cache if enabled
+    def _fetch_matches(self, si_query: str, h_patterns: Hash, h_bindings: Row, x_timeout: float=None) -> List[List[Tuple[str, Any]]]:
+        si_fingerprint, a_defs = _compile_query_defs(h_patterns)
+
+        # cache enabled
+        si_key = None
+        if self._k_cache is not None:
+            si_key = ResultCache.key('incquery', self._s_compartment, si_query, si_fingerprint, _freeze(h_bindings))
+
+            # cache hit
+            a_cached = self._k_cache.get(si_key)
+            if a_cached is not None:
+                with span('incquery.cache_hit', query=si_query, rows=len(a_cached)):
+                    return a_cached
+
+        # make sure compartment is loaded before querying
+        self._ensure_loaded()
+
+        # the timeout bounds the whole execution, across retries and fallbacks
+        x_deadline = time.monotonic()+x_timeout if x_timeout is not None else None
+
+        # seconds left before the deadline
+        def remaining():
+            return max(0.001, x_deadline-time.monotonic()) if x_deadline is not None else None
+
+        # request options for each attempt
+        def options():
+            x_left = remaining()
+            return {'_request_timeout': (x_left, x_left)} if x_left is not None else {}
+
+        with span('incquery.request', query=si_query, compartment=self._s_compartment) as k_span:
+            g_response = None
+
+            # execute by reference to a pattern set registered on the server
+            if self._b_register_patterns:
+                si_package = self._register_patterns(si_fingerprint, a_defs)
+                if si_package is not None:
+                    try:
+                        g_response = _transport.call(self._k_transport, self._p_host, lambda: self._y_incquery_query_execution.execute_query_on_model_compartment({
+                            'modelCompartment': {
+                                'compartmentURI': self._s_compartment,
+                            },
+                            'queryFQN': f'{si_package}.{si_query}',
+                            'parameterBinding': _dict_to_bindings(h_bindings),
+                        }, **options()), timeout=remaining())
+                        k_span.set('by_reference', True)
+                    except iqs_client.rest.ApiException as e_api:
+                        # anything other than an unknown query, e.g., invalid bindings, would fail one-off too
+                        if not _unknown_query(e_api):
+                            raise
+
+                        # server restarted and forgot the registration; fall back to one-off execution
+                        with _k_registered_lock:
+                            _as_registered_packages.discard((self._p_host, si_package))
+
+            # execute query one-off
+            if g_response is None:
+                k_span.set('request_bytes', sum(len(sx_def) for sx_def in a_defs))
+                g_response = _transport.call(self._k_transport, self._p_host, lambda: self._y_incquery_demo.execute_query_one_off({
+                    'modelCompartment': {
+                        'compartmentURI': self._s_compartment,
+                    },
+                    'queryLanguage': 'viatra',
+                    'queryName': si_query,
+                    'queryDefinitions': list(a_defs),
+                    'parameterBinding': _dict_to_bindings(h_bindings),
+                }, **options()), timeout=remaining())
+
+            # extract raw matches
+            a_matches = [
+                [(g_arg.parameter, g_arg.value) for g_arg in g_match.arguments] for g_match in g_response.matches
+            ]
+            k_span.set('rows', len(a_matches))
+
+        # save to cache
+        if si_key is not None:
+            self._k_cache.put(si_key, a_matches)
+
+        return a_matches
+
+    # register a pattern set on the server once and return the query package it lives in, or None if unsupported
+    def _register_patterns(self, si_fingerprint: str, a_defs: Tuple[str, ...]) -> Optional[str]:
+        si_package = f'opl.p{si_fingerprint[:24]}'
+        si_registered = (self._p_host, si_package)
+
+        with _k_registered_lock:
+            # server does not support registration
+            if self._p_host in _as_unsupported_hosts:
+                return None
+
+            # already registered
+            if si_registered in _as_registered_packages:
+                return si_package
+
+            k_package_lock = _h_registering_locks.setdefault(si_registered, threading.Lock())
+
+        # register outside of the process-wide lock; concurrent requests for the same package wait for the first
+        with k_package_lock:
+            with _k_registered_lock:
+                if si_registered in _as_registered_packages:
+                    return si_package
+
+            try:
+                _transport.call(self._k_transport, self._p_host, lambda: self._y_incquery_queries.register_queries_plain_text('\n\n'.join(a_defs), query_package=si_package, query_language='viatra'), False)
+            except iqs_client.rest.ApiException as e_api:
+                # registration endpoint not available on this server
+                if e_api.status in _AS_UNSUPPORTED_STATUSES:
+                    with _k_registered_lock:
+                        _as_unsupported_hosts.add(self._p_host)
+                    return None
+
+                # server error; execute one-off this time and try registering again next time
+                if e_api.status is not None and e_api.status >= 500:
+                    return None
+
+                # e.g., unauthorized or invalid pattern definitions
+                raise
+
+            with _k_registered_lock:
+                _as_registered_packages.add(si_registered)
+
+        return si_package
+
+    @property
+    def cache(self) -> Optional[ResultCache]:
+        '''
+        The ResultCache used to memoize query results, if any
+        '''
+        return self._k_cache
+
+
+    def execute_many(self, queries: List[Tuple], max_workers: int=8, timeout: float=None, return_exceptions: bool=True) -> List[Union[List[Row], Exception]]:
+        '''
+        Execute many independent queries concurrently over the shared API client and return their results in submission order
+
+        :param queries: A list of `(name, patterns, bindings)` tuples; trailing items may be omitted
+        :param max_workers: Maximum number of queries in flight at once
+        :param timeout: Optional number of seconds each individual query may take before it fails
+        :param return_exceptions: If True, a failed query yields its exception in place of its results
+            without affecting the others; otherwise, the first failure is raised once all queries have settled
+        :return: A list with one entry per query, each as would be returned by `execute`
+        '''
+        # nothing to execute
+        if not queries:
+            return []
+
+        # run one query from its descriptor
+        def execute_one(a_query):
+            si_query, h_patterns, h_bindings = (tuple(a_query)+({}, {}))[:3]
+            return self.execute(si_query, patterns=h_patterns, bindings=h_bindings, timeout=timeout)
+
+        # submit all queries to a bounded pool
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(queries)))) as y_pool:
+            a_futures = [y_pool.submit(execute_one, a_query) for a_query in queries]
+
+        # collect results in submission order
+        return _transport.settle(a_futures, return_exceptions)
 
 
     def extend_row(self, row: Row, query_field: QueryField) -> List[Row]:
@@ -220,6 +878,246 @@ class IncQueryProject:
         return list(map(k_field.select, a_rows))
 
 
+    def extend_rows(self, rows: List[Row], query_field: QueryField, fold: bool=False) -> List[List[Row]]:
+        '''
+        Extend many rows by applying the given query_field, executing each distinct join binding only once
+
+        :param rows: A list of dict items obtained from `execute` results
+        :param query_field: A QueryField descriptor that specifies how to perform the extension
+        :param fold: Execute the query a single time, binding only the joined parameters whose value is the same for
+            every row, and split the matches back out per row by the identity of the joined values, where element
+            descriptors are identified by their relative element ID. Only worthwhile when the pattern is selective
+            without the joined parameters that vary between rows
+        :return: A list with one entry per row, each identical to what `extend_row` would return for that row
+        '''
+        k_field = query_field
+
+        # distinct join bindings, keyed by their frozen representation
+        h_joins = {}
+
+        # frozen join key for each row, in order
+        a_keys = []
+
+        # each row
+        for g_row in rows:
+            h_join = k_field.join(g_row)
+            z_key = _freeze(h_join)
+
+            # first occurrence of this binding
+            if z_key not in h_joins:
+                h_joins[z_key] = h_join
+
+            a_keys.append(z_key)
+
+        # matches for each distinct join binding
+        h_matches = {z_key: [] for z_key in h_joins}
+
+        # fold all join bindings into one execution
+        if fold and len(h_joins) > 1:
+            # distinct sets of parameters bound by the join
+            a_params = list({tuple(sorted(h_join)) for h_join in h_joins.values()})
+
+            # union of joined parameters
+            as_joined = {si_param for a_group in a_params for si_param in a_group}
+
+            # joined parameters bound to the same value by every join
+            h_shared = {}
+            for si_param in as_joined:
+                a_values = [h_join[si_param] for h_join in h_joins.values() if si_param in h_join]
+                if len(a_values) == len(h_joins) and len({_identity_key(w_value) for w_value in a_values}) == 1:
+                    h_shared[si_param] = a_values[0]
+
+            # execute query with static and shared bindings only
+            a_rows = self.execute(
+                name=k_field.query,
+                bindings={
+                    **{si_param: w_value for si_param, w_value in k_field.bindings.items() if si_param not in as_joined},
+                    **h_shared,
+                },
+                patterns=k_field.patterns,
+            )
+
+            # distinct joins by the parameters they bind and the identity of their values
+            h_identities = {}
+            for z_key, h_join in h_joins.items():
+                h_identities.setdefault((tuple(sorted(h_join)), _identity_key(h_join)), []).append(z_key)
+
+            # split matches back out by the identity of their joined parameter values
+            for g_match in a_rows:
+                for a_group in a_params:
+                    for z_key in h_identities.get((a_group, _identity_key({si_param: g_match.get(si_param) for si_param in a_group})), []):
+                        h_matches[z_key].append(g_match)
+        # execute once per distinct join binding
+        else:
+            for z_key, h_join in h_joins.items():
+                h_matches[z_key] = self.execute(
+                    name=k_field.query,
+                    bindings={**k_field.bindings, **h_join},
+                    patterns=k_field.patterns,
+                )
+
+        # map thru select function once per distinct binding
+        h_selected = {z_key: list(map(k_field.select, a_rows)) for z_key, a_rows in h_matches.items()}
+
+        # fan results back out to each row
+        return [list(h_selected[z_key]) for z_key in a_keys]
+
+
+# maximum number of compartments resolved, loaded or queried at once by default
+N_FANOUT_WORKERS = 16
+
+class IncQueryProjects:
+    '''
+    Run the same queries across many compartments at once, e.g., for cross-project reports. Compartments are
+    resolved and loaded into the in-memory index concurrently, and every query is sent to all of them in parallel
+    over the API client shared by all projects on the server.
+
+    :param server: URI of the IncQuery server
+    :param username: Username to authenticate with
+    :param password: Password to authenticate with
+    :param projects: A list of compartments to query, each given as either a compartment IRI or an `(org, project)`
+        or `(org, project, ref)` tuple whose latest commit is selected
+    :param patterns: Default patterns to use for implicit query executions
+    :param cache: Optional ResultCache used to memoize query results, shared by all compartments
+    :param refresh: When selecting latest commits, whether to list the compartments on the server; see `IncQueryProject`
+    :param commit_index: Optional path to a JSON file that persists commit names by compartment IRI across processes
+    :param lazy: Defer loading each compartment into the in-memory index until the first query is sent to it
+    :param register_patterns: Register each distinct pattern set on the server once and execute queries by reference
+    :param max_workers: Maximum number of compartments resolved, loaded or queried at once
+    :param transport: TransportPolicy that governs requests to the server; see `IncQueryProject`
+    '''
+    def __init__(self, server: str, username: str, password: str, projects: List[Union[str, Tuple[str, ...]]], patterns: Hash={}, cache: ResultCache=None, refresh: bool=True, commit_index: str=None, lazy: bool=False, register_patterns: bool=False, max_workers: int=N_FANOUT_WORKERS, transport: TransportPolicy=None):
+        self._n_workers = max(1, max_workers)
+
+        # parse server iri
+        du_iqs = urlparse(server)
+        p_host = du_iqs.scheme + '://' + du_iqs.netloc + '/api'
+
+        # API groups on the shared client
+        y_incquery = _shared_api_client(p_host, username, password)
+        y_persistent = iqs_client.PersistentIndexApi(y_incquery)
+        y_mms_repo = iqs_client.MmsRepositoryApi(y_incquery)
+        y_in_memory = iqs_client.InMemoryIndexApi(y_incquery)
+
+        # send each request according to the transport policy
+        self._p_host = p_host
+        self._k_transport = transport
+        f_call = functools.partial(_transport.call, transport, p_host)
+
+        a_refs = [tuple(z_project) for z_project in projects if not isinstance(z_project, str)]
+
+        # list persisted compartments once for all refs
+        a_persisted = None
+        if a_refs and refresh:
+            a_persisted = f_call(y_persistent.list_persisted_model_compartments).persisted_model_compartments
+
+        # resolve the latest commit of a ref
+        def resolve(a_ref):
+            si_org, si_project, s_ref = (a_ref+(None,))[:3]
+            p_compartment = _latest_commit(y_persistent, y_mms_repo, si_org, si_project, s_ref, refresh, commit_index, a_persisted, f_call)
+            if p_compartment is None:
+                raise Exception(f'no commits found for org "{si_org}", project "{si_project}" and ref "{s_ref or "master"}"')
+            return p_compartment
+
+        with span('incquery.resolve', refs=len(a_refs)):
+            with ThreadPoolExecutor(max_workers=max(1, min(self._n_workers, len(a_refs)))) as y_pool:
+                h_resolved = dict(zip(a_refs, y_pool.map(resolve, a_refs)))
+
+        # create a lazy client for each compartment
+        self._h_projects: Dict[str, IncQueryProject] = {}
+        for z_project in projects:
+            if isinstance(z_project, str):
+                p_compartment = z_project
+                a_ref = None
+            else:
+                a_ref = tuple(z_project)
+                p_compartment = h_resolved[a_ref]
+
+            k_project = IncQueryProject(server, username, password, compartment=p_compartment, patterns=patterns, cache=cache, lazy=True, register_patterns=register_patterns, transport=transport)
+
+            # keep ref so that the latest commit can be selected later
+            if a_ref is not None:
+                si_org, si_project, s_ref = (a_ref+(None,))[:3]
+                k_project._a_ref = (si_org, si_project, s_ref, commit_index)
+
+            self._h_projects[p_compartment] = k_project
+
+        # load all compartments up front
+        if not lazy:
+            self._load(y_in_memory, p_host)
+
+    # load every compartment that is not yet resident, listing the in-memory index only once
+    def _load(self, y_in_memory, p_host: str):
+        as_resident = {
+            g_compartment.compartment_uri
+            for g_compartment in _transport.call(self._k_transport, self._p_host, y_in_memory.list_inmemory_model_compartments).inmemory_model_compartments or []
+        }
+
+        # register resident compartments so that their projects skip loading
+        with _k_loaded_lock:
+            _as_loaded_compartments.update((p_host, p_compartment) for p_compartment in self._h_projects if p_compartment in as_resident)
+
+        # load the others without each project listing the in-memory index again
+        with ThreadPoolExecutor(max_workers=max(1, min(self._n_workers, len(self._h_projects)))) as y_pool:
+            list(y_pool.map(lambda a_item: a_item[1]._ensure_loaded(b_absent=a_item[0] not in as_resident), self._h_projects.items()))
+
+    @property
+    def projects(self) -> Dict[str, IncQueryProject]:
+        '''
+        The client for each compartment, by compartment IRI
+        '''
+        return dict(self._h_projects)
+
+    def execute_each(self, name: str, patterns: Hash={}, bindings: Row={}, timeout: float=None, return_exceptions: bool=True) -> Dict[str, Union[List[Row], Exception]]:
+        '''
+        Execute a query against every compartment concurrently and return the results of each
+
+        :param name: Name of which pattern to execute
+        :param patterns: A dict of patterns to include during query execution (overwrites defaults provided to constructor)
+        :param bindings: A dict of bindings to pass into query execution
+        :param timeout: Optional number of seconds each compartment's query may take before it fails
+        :param return_exceptions: If True, a compartment whose query failed maps to the exception in place of its
+            results without affecting the others; otherwise, the first failure is raised once all queries have settled
+        :return: A dict of compartment IRI to results, as would be returned by `IncQueryProject.execute`
+        '''
+        a_compartments = list(self._h_projects)
+
+        def execute_one(p_compartment):
+            return self._h_projects[p_compartment].execute(name, patterns=patterns, bindings=bindings, timeout=timeout)
+
+        with span('incquery.fan_out', query=name, compartments=len(a_compartments)):
+            with ThreadPoolExecutor(max_workers=max(1, min(self._n_workers, len(a_compartments)))) as y_pool:
+                a_futures = [y_pool.submit(execute_one, p_compartment) for p_compartment in a_compartments]
+
+        # collect results in compartment order
+        return dict(zip(a_compartments, _transport.settle(a_futures, return_exceptions)))
+
+    def execute(self, name: str, patterns: Hash={}, bindings: Row={}, timeout: float=None, tag: str='compartment') -> List[Row]:
+        '''
+        Execute a query against every compartment concurrently and return all of their results as a single list of
+        dicts, each tagged with the IRI of the compartment it came from
+
+        :param name: Name of which pattern to execute
+        :param patterns: A dict of patterns to include during query execution (overwrites defaults provided to constructor)
+        :param bindings: A dict of bindings to pass into query execution
+        :param timeout: Optional number of seconds each compartment's query may take before it fails
+        :param tag: Key under which each row records its source compartment IRI
+        '''
+        a_rows = []
+        for p_compartment, a_results in self.execute_each(name, patterns, bindings, timeout, return_exceptions=False).items():
+            a_rows.extend({**g_row, tag: p_compartment} for g_row in a_results)
+
+        return a_rows
+
+# default cell renderer: lists become bulleted lists, anything else is written as an escaped string
+def _html_cell(z_value, g_row: Row) -> str:
+    # value is a list
+    if isinstance(z_value, list):
+        return '<ul>'+''.join('<li>'+html.escape(s_value)+'</li>' for s_value in z_value)+'</ul>'
+    # write simple string as HTML
+    else:
+        return html.escape(z_value)
+
 
 class QueryResultsTable:
     '''
@@ -251,56 +1149,55 @@ class QueryResultsTable:
 
         :param rewriters: dict of callback functions for rewriting cell values under the given columns
         '''
+        with span('table.to_html', rows=len(self._a_rows)) as k_span:
+            s_html = ''.join(self.iter_html(rewriters))
+            k_span.set('bytes', len(s_html))
+            return s_html
+
+    def iter_html(self, rewriters: Rewriters={}, chunk_size: int=1000) -> Iterator[str]:
+        '''
+        Generate the same HTML as `to_html` in chunks, suitable for streaming large tables to a file or HTTP body
+
+        :param rewriters: dict of callback functions for rewriting cell values under the given columns
+        :param chunk_size: number of rows to render per chunk
+        '''
         rewriters = rewriters or {}
         h_rewriters = {**self._h_rewriters, **rewriters}
-        s_html = '<table><tbody><tr>'
-        h_labels = {**self._h_labels}
-
-        # empty results
-        if 0 == len(self._a_rows):
-            # no labels provided; exit
-            if self._h_labels is None:
-                return '<p>No query results and no column headers were provided. Nothing to display.</p>'
-        # non-empty results
-        else:
-            # each column in first row
-            for si_col in self._a_rows[0]:
-                # column id missing from labels; default to id
-                if si_col not in h_labels:
-                    h_labels[si_col] = si_col
+        h_labels = self._h_labels
 
-        # construct headers
-        for si_col in self._h_labels:
-            s_html += '<th>{label}</th>'.format(label=self._h_labels[si_col])
+        # no labels provided
+        if h_labels is None:
+            # empty results; exit
+            if 0 == len(self._a_rows):
+                yield '<p>No query results and no column headers were provided. Nothing to display.</p>'
+                return
+
+            # default to ids of each column in first row
+            h_labels = {si_col: si_col for si_col in self._a_rows[0]}
 
-        # close header row
-        s_html += '</tr>'
+        # resolve cell handler for each column once
+        a_columns = [(si_col, h_rewriters.get(si_col, _html_cell)) for si_col in h_labels]
+
+        # construct headers
+        yield '<table><tbody><tr>'+''.join(f'<th>{h_labels[si_col]}</th>' for si_col in h_labels)+'</tr>'
 
         # construct data
+        a_chunk = []
         for g_row in self._a_rows:
-            s_html += '<tr>'
-            for si_col in self._h_labels:
-                z_value = g_row[si_col]
-                s_cell = ''
-
-                # column has rewriter
-                if si_col in h_rewriters:
-                    s_cell += h_rewriters[si_col](z_value, g_row)
-                # value is a list
-                elif isinstance(z_value, list):
-                    s_cell += '<ul>'
-                    for s_value in z_value:
-                        s_cell += '<li>{value}</li>'.format(value=html.escape(s_value))
-                    s_cell += '</ul>'
-                # write simple string as HTML
-                else:
-                    s_cell += html.escape(z_value)
+            a_chunk.append('<tr>')
+            for si_col, f_cell in a_columns:
                 # style="text-align:left;"
-                s_html += '<td>{value}</td>'.format(value=s_cell)
-            s_html += '</tr>'
+                a_chunk.append('<td>'+f_cell(g_row[si_col], g_row)+'</td>')
+            a_chunk.append('</tr>')
+
+            # flush chunk
+            if len(a_chunk) >= chunk_size * (len(a_columns) + 2):
+                yield ''.join(a_chunk)
+                a_chunk = []
 
         # close
-        return s_html+'</tbody></table>'
+        a_chunk.append('</tbody></table>')
+        yield ''.join(a_chunk)
 
     def to_confluence_xhtml(self, span_id: str, macro_id: str=None, rewriters: Rewriters={}):
         '''
@@ -310,22 +1207,4 @@ class QueryResultsTable:
         :param macro_id: optional UUIDv4 to give the Confluence macro
         :param rewriters: dict of callback functions for rewriting cell values under the given columns
         '''
-        return '''
-            <ac:structured-macro ac:name="span" ac:schema-version="1" ac:macro-id="{macro_id}">
-                <ac:parameter ac:name="id">{span_id}</ac:parameter>
-                <ac:parameter ac:name="atlassian-macro-output-type">INLINE</ac:parameter>
-                <ac:rich-text-body>
-                    <p class="auto-cursor-target">
-                        <br />
-                    </p>
-                    {content}
-                    <p class="auto-cursor-target">
-                        <br />
-                    </p>
-                </ac:rich-text-body>
-            </ac:structured-macro>
-        '''.format(
-            macro_id=macro_id or str(uuid.uuid4()),
-            span_id=span_id,
-            content=self.to_html(rewriters),
-        )
+        return _span_macro_xhtml(span_id, self.to_html(rewriters), macro_id)
@@ -0,0 +1,155 @@
+'''
+Pluggable instrumentation for the clients in this library. Timed spans around requests, result conversion and
+rendering are emitted as `Event`s to every registered callback, e.g.::
+
+    import opl
+
+    opl.instrumentation.register(lambda event: print(event.name, event.duration, event.attributes))
+
+When no callback is registered, spans are a shared no-op object and cost next to nothing.
+'''
+import time
+import warnings
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+
+class Event(NamedTuple):
+    '''
+    A finished span
+
+    :param name: Dotted name of the operation, e.g., 'sparql.request'
+    :param start: Wall-clock time at which the operation started, in seconds since the epoch
+    :param duration: Number of seconds the operation took
+    :param attributes: Details about the operation, e.g., row counts ('rows') and payload sizes ('bytes')
+    :param error: The exception raised by the operation, if it failed
+    '''
+    name: str
+    start: float
+    duration: float
+    attributes: Dict[str, Any]
+    error: Optional[BaseException]
+
+
+# registered callbacks; replaced rather than mutated so that emitting never needs a lock
+_a_callbacks: List[Callable[[Event], None]] = []
+
+def register(callback: Callable[[Event], None]):
+    '''
+    Register a callback to receive every finished span
+
+    :param callback: Function that accepts an `Event`; should return quickly since it runs on the instrumented thread
+    '''
+    global _a_callbacks
+    _a_callbacks = _a_callbacks+[callback]
+
+def unregister(callback: Callable[[Event], None]):
+    '''
+    Stop sending spans to a previously registered callback
+
+    :param callback: The callback that was registered
+    '''
+    global _a_callbacks
+    _a_callbacks = [f_callback for f_callback in _a_callbacks if f_callback is not callback]
+
+def enabled() -> bool:
+    '''
+    Whether any callback is registered
+    '''
+    return bool(_a_callbacks)
+
+
+class _Span:
+    __slots__ = ('_s_name', '_h_attributes', '_x_start', '_x_perf')
+
+    def __init__(self, s_name: str, h_attributes: Dict[str, Any]):
+        self._s_name = s_name
+        self._h_attributes = h_attributes
+
+    def set(self, key: str, value: Any):
+        self._h_attributes[key] = value
+
+    def add(self, key: str, amount: int=1):
+        self._h_attributes[key] = self._h_attributes.get(key, 0)+amount
+
+    def __enter__(self):
+        self._x_start = time.time()
+        self._x_perf = time.perf_counter()
+        return self
+
+    def __exit__(self, dc_error, e_error, y_traceback):
+        g_event = Event(self._s_name, self._x_start, time.perf_counter()-self._x_perf, self._h_attributes, e_error)
+
+        for f_callback in _a_callbacks:
+            try:
+                f_callback(g_event)
+            except Exception as e_callback:
+                warnings.warn(f'instrumentation callback failed while handling "{self._s_name}": {e_callback!r}')
+
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, key: str, value: Any):
+        pass
+
+    def add(self, key: str, amount: int=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, dc_error, e_error, y_traceback):
+        return False
+
+_K_NULL_SPAN = _NullSpan()
+
+
+def span(name: str, **attributes):
+    '''
+    Create a context manager that times the enclosed operation and emits it as an `Event` once it exits.
+    The object it yields accepts `.set(key, value)` and `.add(key, amount)` to record attributes along the way
+
+    :param name: Dotted name of the operation
+    :param attributes: Initial attributes
+    '''
+    if not _a_callbacks:
+        return _K_NULL_SPAN
+    return _Span(name, attributes)
+
+
+class OpenTelemetryAdapter:
+    '''
+    Callback that forwards each event as an OpenTelemetry span. Requires the `opentelemetry-api` package::
+
+        opl.instrumentation.register(opl.instrumentation.OpenTelemetryAdapter())
+
+    :param tracer: OpenTelemetry tracer to create spans with; defaults to the global tracer provider's 'opl' tracer
+    '''
+    def __init__(self, tracer=None):
+        try:
+            from opentelemetry import trace
+        except ImportError as e_import:
+            raise Exception('OpenTelemetryAdapter requires the `opentelemetry-api` package') from e_import
+
+        self._y_trace = trace
+        self._y_tracer = tracer if tracer is not None else trace.get_tracer('opl')
+
+    def __call__(self, event: Event):
+        g_event = event
+
+        # attribute values must be primitives
+        h_attributes = {
+            si_attr: z_value if isinstance(z_value, (str, bool, int, float)) else str(z_value)
+            for si_attr, z_value in g_event.attributes.items()
+        }
+
+        n_start = int(g_event.start * 1e9)
+        y_span = self._y_tracer.start_span(g_event.name, start_time=n_start, attributes=h_attributes)
+
+        if g_event.error is not None:
+            y_span.record_exception(g_event.error)
+            y_span.set_status(self._y_trace.Status(self._y_trace.StatusCode.ERROR, str(g_event.error)))
+
+        y_span.end(end_time=n_start+int(g_event.duration * 1e9))
@@ -0,0 +1,321 @@
+'''
+Declarative report pipelines. A report is declared as a DAG of named stages (queries, row extensions, tables and
+page updates) which `Pipeline.run` executes concurrently as soon as their inputs are ready, e.g.::
+
+    k_pipeline = opl.Pipeline()
+    k_pipeline.query('blocks', k_project, 'blocks')
+    k_pipeline.extend('blocks_owned', 'blocks', k_project, {'owner': k_owner_field})
+    k_pipeline.table('blocks_table', 'blocks_owned', {'name': 'Name', 'owner': 'Owner'})
+    k_pipeline.publish('blocks_page', k_wiki.page('123456'), {'blocks': 'blocks_table'})
+
+    for si_stage, g_result in k_pipeline.run().items():
+        print(si_stage, g_result.status, g_result.duration)
+
+Each stage is identified by a key derived from its parameters and the keys of its inputs. Stage outputs are
+memoized by that key in a ResultCache, which can be shared by pipelines whose reports have inputs in common, and
+publishing is skipped when its inputs are unchanged since the page was last published. Callables taken by a stage,
+e.g., the join and select functions of query fields, are only identified within their own pipeline, so outputs of
+stages that take callables are not reused by other pipelines.
+'''
+import time
+import json
+import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from .types import Hash
+from .cache import ResultCache
+from .instrumentation import span
+from .confluence import _Page
+from .incquery import IncQueryProject, QueryField, QueryResultsTable, Row, Rewriters, _compile_query_defs, _freeze
+
+
+class StageResult(NamedTuple):
+    '''
+    Outcome of a single stage of a pipeline run
+
+    :param output: The stage's output, e.g., rows for query and extend stages, a QueryResultsTable for table stages,
+        and for publish stages whether the page was updated
+    :param status: 'ran' if the stage was executed, 'memoized' if its output was reused from the cache, or 'skipped'
+        if it was a publish stage whose inputs were unchanged
+    :param duration: Number of seconds the stage took
+    '''
+    output: Any
+    status: str
+    duration: float
+
+
+class _Stage(NamedTuple):
+    kind: str
+    inputs: Tuple[str, ...]
+
+    # accepts the keys of the inputs and returns the stage key, or None if the stage cannot be identified
+    key: Callable[[List[Optional[str]]], Optional[str]]
+
+    # accepts the outputs of the inputs and the stage key and returns (output, skipped)
+    run: Callable[[List[Any], Optional[str]], Tuple[Any, bool]]
+
+    # whether the output may be stored in the cache
+    memoize: bool
+
+
+# derive a stage key from its own parameters and the keys of its inputs, unless any input is unidentified
+def _chain_key(a_parts: tuple, a_keys: List[Optional[str]]) -> Optional[str]:
+    if any(si_key is None for si_key in a_keys):
+        return None
+    return ResultCache.key('pipeline', *a_parts, *a_keys)
+
+
+class Pipeline:
+    '''
+    A report declared as a DAG of named stages. Stages may be declared in any order; each one names the stages
+    whose outputs it takes as inputs
+
+    :param cache: ResultCache used to memoize stage outputs and to record what was last published to each page;
+        share one among pipelines to reuse outputs across reports, and provide one with a `path` to skip publishing
+        unchanged pages across processes. Defaults to an in-memory cache
+    '''
+    def __init__(self, cache: ResultCache=None):
+        self._k_cache = cache if cache is not None else ResultCache()
+        self._h_stages: Dict[str, _Stage] = {}
+
+        # random token of each callable in stage keys, by id; holding the callable keeps its id from being reused
+        self._h_callables: Dict[int, Tuple[Callable, str]] = {}
+        self._k_callables_lock = threading.Lock()
+
+    @property
+    def cache(self) -> ResultCache:
+        '''
+        The ResultCache used to memoize stage outputs
+        '''
+        return self._k_cache
+
+    # identity of a callable within this pipeline; never matches a key made by another pipeline, even from a persisted cache
+    def _callable_key(self, f_callable: Callable) -> str:
+        with self._k_callables_lock:
+            a_entry = self._h_callables.get(id(f_callable))
+            if a_entry is None:
+                a_entry = self._h_callables[id(f_callable)] = (f_callable, uuid.uuid4().hex)
+            return a_entry[1]
+
+    def _add(self, si_stage: str, k_stage: _Stage):
+        if si_stage in self._h_stages:
+            raise Exception(f'pipeline already has a stage named "{si_stage}"')
+        self._h_stages[si_stage] = k_stage
+
+    def query(self, name: str, project: IncQueryProject, query: str, patterns: Hash={}, bindings: Row={}):
+        '''
+        Declare a stage that executes a query and outputs its rows, same as `IncQueryProject.execute`
+
+        :param name: Unique name of the stage
+        :param project: The project to execute the query against
+        :param query: Name of which pattern to execute
+        :param patterns: A dict of patterns to include during query execution (overwrites defaults provided to project)
+        :param bindings: A dict of bindings to pass into query execution
+        '''
+        def key(a_keys):
+            si_fingerprint, _ = _compile_query_defs({**project._h_patterns, **(patterns or {})})
+            return _chain_key(('query', project.compartment, query, si_fingerprint, _freeze(bindings)), a_keys)
+
+        def run(a_inputs, si_key):
+            return project.execute(query, patterns=patterns, bindings=dict(bindings)), False
+
+        self._add(name, _Stage('query', (), key, run, True))
+
+    def extend(self, name: str, source: str, project: IncQueryProject, fields: Dict[str, QueryField], fold: bool=False):
+        '''
+        Declare a stage that extends each row of another stage's output with new columns, one per query field, same as
+        `IncQueryProject.extend_rows`. The fields are executed concurrently
+
+        :param name: Unique name of the stage
+        :param source: Name of the stage whose rows to extend
+        :param project: The project to execute the field queries against
+        :param fields: A dict that maps each new column to the QueryField that produces its values
+        :param fold: Passed on to `IncQueryProject.extend_rows`
+        '''
+        a_columns = list(fields)
+
+        def key(a_keys):
+            return _chain_key(('extend', project.compartment, fold, tuple(
+                (si_column, k_field.query, _freeze(k_field.bindings), _freeze(k_field.patterns), self._callable_key(k_field.join), self._callable_key(k_field.select))
+                for si_column, k_field in fields.items()
+            )), a_keys)
+
+        def run(a_inputs, si_key):
+            a_rows = a_inputs[0]
+
+            # nothing to extend
+            if not a_columns:
+                return [dict(g_row) for g_row in a_rows], False
+
+            with ThreadPoolExecutor(max_workers=len(a_columns)) as y_pool:
+                a_extensions = list(y_pool.map(lambda si_column: project.extend_rows(a_rows, fields[si_column], fold), a_columns))
+
+            return [
+                {**g_row, **{si_column: a_extension[i_row] for si_column, a_extension in zip(a_columns, a_extensions)}}
+                for i_row, g_row in enumerate(a_rows)
+            ], False
+
+        self._add(name, _Stage('extend', (source,), key, run, True))
+
+    def table(self, name: str, source: str, labels: Hash=None, rewriters: Rewriters={}):
+        '''
+        Declare a stage that arranges another stage's rows into a QueryResultsTable
+
+        :param name: Unique name of the stage
+        :param source: Name of the stage whose rows to tabulate
+        :param labels: A dict that maps field IDs to text labels
+        :param rewriters: dict of callback functions for rewriting cell values under the given columns
+        '''
+        def key(a_keys):
+            return _chain_key(('table', _freeze(labels), tuple(
+                (si_column, self._callable_key(f_rewriter)) for si_column, f_rewriter in sorted((rewriters or {}).items())
+            )), a_keys)
+
+        def run(a_inputs, si_key):
+            return QueryResultsTable(a_inputs[0], labels, rewriters), False
+
+        # tables hold callables and are cheap to create, so they are not memoized
+        self._add(name, _Stage('table', (source,), key, run, False))
+
+    def publish(self, name: str, page: _Page, spans: Dict[str, str]):
+        '''
+        Declare a stage that updates `span` macros on a Confluence page with the outputs of other stages, same as
+        `_Page.update_spans`. Publishing is skipped without contacting Confluence if the inputs are the same as, or
+        render to the same content as, what was last published to those spans by a pipeline sharing the cache
+
+        :param name: Unique name of the stage
+        :param page: The page to update
+        :param spans: A dict that maps each span ID to the name of the stage whose output to place inside it; outputs may
+            be a QueryResultsTable, which is rendered using `to_html`, or an XHTML string
+        '''
+        a_spans = list(spans)
+        si_published = ResultCache.key('pipeline.publish', page._y_confluence.url, page._si_page, tuple(a_spans))
+
+        def key(a_keys):
+            return _chain_key(('publish', page._y_confluence.url, page._si_page, tuple(a_spans)), a_keys)
+
+        def run(a_inputs, si_key):
+            # (stage key, content digest) as of the last publish
+            a_last = self._k_cache.get(si_published)
+
+            # inputs unchanged
+            if a_last is not None and si_key is not None and a_last[0] == si_key:
+                return False, True
+
+            # render spans
+            h_spans = {
+                si_span: z_output.to_html() if isinstance(z_output, QueryResultsTable) else z_output
+                for si_span, z_output in zip(a_spans, a_inputs)
+            }
+            si_digest = hashlib.sha256(json.dumps(h_spans, sort_keys=True).encode()).hexdigest()
+
+            # content unchanged
+            if a_last is not None and a_last[1] == si_digest:
+                self._k_cache.put(si_published, (si_key, si_digest))
+                return False, True
+
+            b_updated = page.update_spans(h_spans)
+            self._k_cache.put(si_published, (si_key, si_digest))
+            return b_updated, False
+
+        self._add(name, _Stage('publish', tuple(spans[si_span] for si_span in a_spans), key, run, False))
+
+    def stage(self, name: str, function: Callable[..., Any], inputs: List[str]=[], key: str=None):
+        '''
+        Declare a custom stage
+
+        :param name: Unique name of the stage
+        :param function: Called with the outputs of the input stages as positional arguments; returns the stage output
+        :param inputs: Names of the stages whose outputs to pass to the function
+        :param key: Optional string that identifies what the function computes given its inputs. The output is only
+            memoized if a key is provided, and then must be picklable if the cache is persisted
+        '''
+        def key_of(a_keys):
+            if key is None:
+                return None
+            return _chain_key(('stage', key), a_keys)
+
+        def run(a_inputs, si_key):
+            return function(*a_inputs), False
+
+        self._add(name, _Stage('stage', tuple(inputs), key_of, run, key is not None))
+
+    # run a single stage given the outputs and keys of its inputs
+    def _run_stage(self, si_stage: str, a_inputs: List[Any], a_keys: List[Optional[str]]) -> Tuple[StageResult, Optional[str]]:
+        k_stage = self._h_stages[si_stage]
+
+        with span('pipeline.stage', stage=si_stage, kind=k_stage.kind) as k_span:
+            x_start = time.perf_counter()
+            si_key = k_stage.key(a_keys)
+
+            # memoized output
+            if k_stage.memoize and si_key is not None:
+                a_memo = self._k_cache.get(si_key)
+                if a_memo is not None:
+                    k_span.set('status', 'memoized')
+                    return StageResult(a_memo[0], 'memoized', time.perf_counter()-x_start), si_key
+
+            z_output, b_skipped = k_stage.run(a_inputs, si_key)
+
+            # save to cache
+            if k_stage.memoize and si_key is not None:
+                self._k_cache.put(si_key, (z_output,))
+
+            s_status = 'skipped' if b_skipped else 'ran'
+            k_span.set('status', s_status)
+            return StageResult(z_output, s_status, time.perf_counter()-x_start), si_key
+
+    def run(self, max_workers: int=8) -> Dict[str, StageResult]:
+        '''
+        Run all stages, each one as soon as all of its inputs are ready, with independent stages running concurrently
+
+        :param max_workers: Maximum number of stages running at once
+        :return: A dict that maps each stage name to its StageResult, in declaration order
+        '''
+        # validate graph
+        for si_stage, k_stage in self._h_stages.items():
+            for si_input in k_stage.inputs:
+                if si_input not in self._h_stages:
+                    raise Exception(f'pipeline stage "{si_stage}" takes input from unknown stage "{si_input}"')
+
+        h_results: Dict[str, StageResult] = {}
+        h_keys: Dict[str, Optional[str]] = {}
+        as_pending = set(self._h_stages)
+        h_running = {}
+
+        with span('pipeline.run', stages=len(self._h_stages)):
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as y_pool:
+                while as_pending or h_running:
+                    # submit every stage whose inputs are ready
+                    for si_stage in [si_stage for si_stage in self._h_stages if si_stage in as_pending]:
+                        a_inputs = self._h_stages[si_stage].inputs
+                        if all(si_input in h_results for si_input in a_inputs):
+                            as_pending.discard(si_stage)
+                            h_running[y_pool.submit(
+                                self._run_stage, si_stage,
+                                [h_results[si_input].output for si_input in a_inputs],
+                                [h_keys[si_input] for si_input in a_inputs],
+                            )] = si_stage
+
+                    # remaining stages depend on each other
+                    if not h_running:
+                        raise Exception(f'pipeline has a cycle among the stages: {", ".join(sorted(as_pending))}')
+
+                    # collect finished stages
+                    as_done, _ = wait(h_running, return_when=FIRST_COMPLETED)
+                    for y_future in as_done:
+                        si_stage = h_running.pop(y_future)
+                        e_stage = y_future.exception()
+
+                        # stop scheduling and let running stages settle
+                        if e_stage is not None:
+                            for y_running in h_running:
+                                y_running.cancel()
+                            raise Exception(f'pipeline stage "{si_stage}" failed') from e_stage
+
+                        h_results[si_stage], h_keys[si_stage] = y_future.result()
+
+        return {si_stage: h_results[si_stage] for si_stage in self._h_stages}
@@ -1,10 +1,24 @@
+import io
 import re
+import sys
+import asyncio
+import datetime
+import functools
+import tempfile
 import rdflib
-from typing import Any, List, Dict
+import rdflib.parser
+import requests
+from rdflib.plugins.parsers.ntriples import NTriplesParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Hashable, List, Dict, Iterator, Optional, Tuple
 
-from SPARQLWrapper import SPARQLWrapper, JSON, POST, RDFXML, TURTLE
+from SPARQLWrapper import SPARQLWrapper, JSON, POST, RDFXML, TURTLE, TSV
 
+from .cache import ResultCache
 from .constants import prefixes
+from .instrumentation import span
+from . import transport as _transport
+from .transport import TransportPolicy
 from .types import Hash
 
 def _join_prefixes(s_token, s_term=''):
@@ -13,10 +27,47 @@ def _join_prefixes(s_token, s_term=''):
 S_PREFIXES_SPARQL = _join_prefixes('prefix')
 SB_PREFIXES_TURTLE = _join_prefixes('@prefix', ' .').encode()
 
-# regex pattern builder for matching inline directives (i'm not sorry)
+# string literals and IRIs are kept verbatim when normalizing query text, while runs of whitespace elsewhere collapse
+_R_QUERY_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|<[^<>\s]*>|\s+')
+
+def _normalize_query(sx_query: str) -> str:
+    return _R_QUERY_TOKENS.sub(lambda m_token: ' ' if m_token.group(0).isspace() else m_token.group(0), sx_query).strip()
+
+# construct results smaller than this stay in memory when no file is given, larger ones spill over to disk
+N_SPOOL_BYTES = 16 * 1024 * 1024
+
+# reads several binary streams back to back without joining them
+class _ChainedReader(io.RawIOBase):
+    def __init__(self, *a_streams):
+        self._a_streams = list(a_streams)
+
+    def readable(self):
+        return True
+
+    def readinto(self, ab_buffer):
+        while self._a_streams:
+            sb_chunk = self._a_streams[0].read(len(ab_buffer))
+            if sb_chunk:
+                n_chunk = len(sb_chunk)
+                ab_buffer[:n_chunk] = sb_chunk
+                return n_chunk
+            self._a_streams.pop(0)
+        return 0
+
+# collects the triple parsed from the most recent line
+class _TripleSink:
+    __slots__ = ('triple_',)
+
+    def __init__(self):
+        self.triple_ = None
+
+    def triple(self, y_subject, y_predicate, y_object):
+        self.triple_ = (y_subject, y_predicate, y_object)
+
+# regex pattern builder for matching inline directives (i'm not sorry); use with re.M
 def _directive(s_keyword: str, z_arg='', b_capture_indent=False):
     return (
-        r'(?m)^'
+        r'^'
         ''+(r'([ \t]*)' if b_capture_indent else r'[ \t]*')+''
         r'#[ \t]*'+s_keyword+''
         ''+(r'[ \t]+([\w]+)' if z_arg is True else z_arg or '')+''
@@ -24,19 +75,342 @@ def _directive(s_keyword: str, z_arg='', b_capture_indent=False):
     )
 
 
+P_XSD = prefixes['xsd']
+
+# escape sequences permitted within terms of SPARQL TSV results
+_H_TSV_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+_R_TSV_ESCAPE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+_R_TSV_LITERAL = re.compile(r'(?s)^"((?:[^"\\]|\\.)*)"(?:@([\w-]+)|\^\^<([^>]*)>)?$')
+_R_TSV_INTEGER = re.compile(r'^[+-]?\d+$')
+_R_TSV_DECIMAL = re.compile(r'^[+-]?\d*\.\d+$')
+_R_TSV_DOUBLE = re.compile(r'^[+-]?(?:\d+\.?\d*|\.\d+)[eE][+-]?\d+$')
+
+def _tsv_unescape(s_value: str) -> str:
+    if '\\' not in s_value:
+        return s_value
+    return _R_TSV_ESCAPE.sub(lambda m_escape: chr(int(m_escape.group(1) or m_escape.group(2), 16))
+        if m_escape.group(3) is None else _H_TSV_ESCAPES.get(m_escape.group(3), m_escape.group(3)), s_value)
+
+# parse an RDF term from a SPARQL TSV result into the same dict format used by SPARQL JSON results; None if unbound
+def _tsv_term_to_binding(s_term: str) -> Optional[Dict[str, str]]:
+    # unbound
+    if not s_term:
+        return None
+
+    # IRI
+    if s_term.startswith('<') and s_term.endswith('>'):
+        return {'type': 'uri', 'value': _tsv_unescape(s_term[1:-1])}
+
+    # blank node
+    if s_term.startswith('_:'):
+        return {'type': 'bnode', 'value': s_term[2:]}
+
+    # quoted literal
+    m_literal = _R_TSV_LITERAL.match(s_term)
+    if m_literal is not None:
+        g_binding = {'type': 'literal', 'value': _tsv_unescape(m_literal.group(1))}
+        if m_literal.group(2):
+            g_binding['xml:lang'] = m_literal.group(2)
+        elif m_literal.group(3):
+            g_binding['datatype'] = _tsv_unescape(m_literal.group(3))
+        return g_binding
+
+    # abbreviated literals
+    if _R_TSV_INTEGER.match(s_term):
+        return {'type': 'literal', 'value': s_term, 'datatype': P_XSD+'integer'}
+    elif _R_TSV_DECIMAL.match(s_term):
+        return {'type': 'literal', 'value': s_term, 'datatype': P_XSD+'decimal'}
+    elif _R_TSV_DOUBLE.match(s_term):
+        return {'type': 'literal', 'value': s_term, 'datatype': P_XSD+'double'}
+    elif s_term in ('true', 'false'):
+        return {'type': 'literal', 'value': s_term, 'datatype': P_XSD+'boolean'}
+
+    # unrecognized; treat as plain literal
+    return {'type': 'literal', 'value': s_term}
+
+
+# literal datatypes by the typed array they convert to
+_AS_XSD_INTEGERS = {P_XSD+s_type for s_type in (
+    'integer', 'int', 'long', 'short', 'byte', 'nonNegativeInteger', 'nonPositiveInteger', 'positiveInteger',
+    'negativeInteger', 'unsignedLong', 'unsignedInt', 'unsignedShort', 'unsignedByte',
+)}
+_AS_XSD_FLOATS = {P_XSD+s_type for s_type in ('decimal', 'double', 'float')}
+P_XSD_BOOLEAN = P_XSD+'boolean'
+P_XSD_DATE_TIME = P_XSD+'dateTime'
+P_XSD_DATE = P_XSD+'date'
+
+# parse an xsd:dateTime lexical form as a naive UTC datetime
+def _xsd_date_time(s_value: str) -> datetime.datetime:
+    dt_value = datetime.datetime.fromisoformat(s_value.replace('Z', '+00:00'))
+    if dt_value.tzinfo is not None:
+        dt_value = dt_value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt_value
+
+# convert one column of SPARQL JSON bindings (None where unbound) into a typed numpy array
+def _bindings_to_array(a_bindings: List[Optional[Dict[str, str]]]):
+    import numpy as np
+
+    a_bound = [g_binding for g_binding in a_bindings if g_binding is not None]
+    b_missing = len(a_bound) < len(a_bindings)
+
+    # all IRIs; intern them since the same few usually repeat throughout a column
+    if a_bound and all(g_binding['type'] == 'uri' for g_binding in a_bound):
+        return np.array([sys.intern(g_binding['value']) if g_binding is not None else None for g_binding in a_bindings], dtype=object)
+
+    # all typed literals of a single kind
+    as_types = {g_binding.get('datatype') if g_binding['type'] in ('literal', 'typed-literal') else None for g_binding in a_bound}
+    if a_bound and None not in as_types:
+        # integers; unbound values force floats so they can be NaN
+        if as_types <= _AS_XSD_INTEGERS:
+            try:
+                if not b_missing:
+                    return np.fromiter((int(g_binding['value']) for g_binding in a_bindings), dtype=np.int64, count=len(a_bindings))
+                return np.array([float(g_binding['value']) if g_binding is not None else np.nan for g_binding in a_bindings], dtype=np.float64)
+
+            # beyond int64; keep exact values as objects
+            except OverflowError:
+                return np.array([int(g_binding['value']) if g_binding is not None else None for g_binding in a_bindings], dtype=object)
+
+            # malformed lexical form
+            except ValueError:
+                pass
+
+        # floating point
+        elif as_types <= _AS_XSD_FLOATS | _AS_XSD_INTEGERS:
+            try:
+                return np.array([float(g_binding['value']) if g_binding is not None else np.nan for g_binding in a_bindings], dtype=np.float64)
+            except ValueError:
+                pass
+
+        # booleans; unbound values keep the column as objects
+        elif as_types == {P_XSD_BOOLEAN}:
+            return np.array([g_binding['value'] in ('true', '1') if g_binding is not None else None for g_binding in a_bindings], dtype=object if b_missing else bool)
+
+        # timestamps; values outside what datetime64 represents (negative years, `24:00:00`) stay as plain values
+        elif as_types == {P_XSD_DATE_TIME}:
+            try:
+                return np.array([_xsd_date_time(g_binding['value']) if g_binding is not None else 'NaT' for g_binding in a_bindings], dtype='datetime64[us]')
+            except (ValueError, OverflowError):
+                pass
+
+        # dates
+        elif as_types == {P_XSD_DATE}:
+            try:
+                return np.array([g_binding['value'][:10] if g_binding is not None else 'NaT' for g_binding in a_bindings], dtype='datetime64[D]')
+            except (ValueError, OverflowError):
+                pass
+
+    # anything else as plain values
+    return np.array([g_binding['value'] if g_binding is not None else None for g_binding in a_bindings], dtype=object)
+
+
+# find the solution modifiers trailing the outermost group of a SELECT query
+def _query_modifiers(sx_query: str) -> str:
+    i_close = sx_query.rfind('}')
+    return sx_query[i_close+1:] if i_close >= 0 else ''
+
+# find the variables projected by a SELECT query in order, including the targets of `(expression AS ?var)`,
+# or None for `SELECT *`
+def _projected_vars(sx_query: str) -> Optional[List[str]]:
+    m_select = re.search(r'(?is)\bselect\s+(?:distinct\s+|reduced\s+)?(.*?)\s*(?:\bfrom\b|\bwhere\b|\{)', sx_query)
+    if m_select is None or m_select.group(1).strip() == '*':
+        return None
+
+    a_vars = []
+    n_depth = 0
+    i_group = 0
+    s_projection = m_select.group(1)
+    for m_token in re.finditer(r'[()]|[?$]\w+', s_projection):
+        s_token = m_token.group(0)
+
+        # open projected expression
+        if s_token == '(':
+            if n_depth == 0:
+                i_group = m_token.end()
+            n_depth += 1
+        # close projected expression; its variable is the target of the trailing `AS`
+        elif s_token == ')':
+            n_depth -= 1
+            if n_depth == 0:
+                m_as = re.search(r'(?i)\bas\s+[?$](\w+)\s*$', s_projection[i_group:m_token.start()])
+                if m_as is not None:
+                    a_vars.append(m_as.group(1))
+        # plain variable
+        elif n_depth == 0:
+            a_vars.append(s_token[1:])
+
+    return a_vars
+
+# prefix of the query variables that stand in for IRI variables when batching a template over many inputs
+S_BATCH_VAR = 'opl_batch_'
+
+_R_SELECT = re.compile(r'(?is)\bselect\s+(?:distinct\s+|reduced\s+)?(.*?)\s*(?:\bfrom\b|\bwhere\b|\{)')
+_R_AGGREGATE = re.compile(r'(?i)\b(?:count|sum|min|max|avg|sample|group_concat)\s*\(')
+
+# rewrite a rendered select query so that it projects the given variables and joins with a values block at the
+# start of its outermost group graph pattern; returns the parts before and after the values block
+def _batch_skeleton(sx_query: str, a_vars: List[str]) -> Tuple[str, str]:
+    m_select = _R_SELECT.search(sx_query)
+    if m_select is None:
+        raise Exception('can only batch SELECT queries')
+
+    # values would apply to the whole result rather than to each input
+    s_projection = m_select.group(1)
+    if re.search(r'(?i)\b(?:limit|offset|group\s+by|having)\b', _query_modifiers(sx_query)) or _R_AGGREGATE.search(s_projection):
+        raise Exception('cannot batch a query that has a LIMIT, OFFSET, GROUP BY, HAVING or aggregate')
+
+    # project batch variables so results can be split back out
+    s_vars = ' '.join('?'+S_BATCH_VAR+si_var for si_var in a_vars)
+    if s_projection.strip() != '*':
+        sx_query = sx_query[:m_select.start(1)]+s_vars+' '+sx_query[m_select.start(1):]
+        i_where = m_select.end()+len(s_vars)+1
+    else:
+        i_where = m_select.end()
+
+    # open brace of the outermost group
+    i_open = sx_query.find('{', i_where-1)
+    if i_open < 0:
+        raise Exception('unable to locate the WHERE clause of the query to batch')
+
+    return sx_query[:i_open+1]+f'\n    values ({s_vars}) {{\n', '    }\n'+sx_query[i_open+1:]
+
+# whether the outermost group of a SELECT query holds a subquery, or modifiers and aggregates of one. subqueries are
+# evaluated on their own, so a values block bound at the top level cannot constrain what they select, limit or count
+def _has_subquery(sx_query: str) -> bool:
+    m_select = _R_SELECT.search(sx_query)
+    if m_select is None:
+        return False
+
+    # body of the outermost group, without its trailing modifiers
+    s_body = sx_query[m_select.end():]
+    s_body = s_body[:s_body.rfind('}')]
+
+    return bool(re.search(r'(?i)\b(?:select|limit|offset|group\s+by|having)\b', s_body) or _R_AGGREGATE.search(s_body))
+
+
+# maximum number of distinct template strings whose compiled form is memoized
+N_COMPILED_TEMPLATES = 512
+
+# fragment kinds in a compiled query template
+_XC_VARIABLE = 0
+_XC_INJECT = 1
+
+_R_VARIABLE = re.compile(r'<\$(\w+)>')
+
+# split a section of template text into literal strings and IRI variable fragments
+def _split_variables(sx_text: str) -> list:
+    a_fragments = []
+    i_prev = 0
+    for m_var in _R_VARIABLE.finditer(sx_text):
+        if m_var.start() > i_prev:
+            a_fragments.append(sx_text[i_prev:m_var.start()])
+        a_fragments.append((_XC_VARIABLE, m_var.group(1)))
+        i_prev = m_var.end()
+
+    if i_prev < len(sx_text):
+        a_fragments.append(sx_text[i_prev:])
+
+    return a_fragments
+
+# serialize the value of an IRI variable
+def _variable_term(si_var: str, h_vars: Hash) -> str:
+    # variable not defined
+    if h_vars.get(si_var) is None:
+        raise Exception(f'query template requires a value for the variable "{si_var}"')
+
+    return rdflib.URIRef(h_vars[si_var]).n3()
+
+
+class QueryTemplate:
+    '''
+    A query template whose mixins have already been resolved and whose injection sites and IRI variables have been
+    located. Created by using the `Sparql.compile` static method
+    '''
+    __slots__ = ('_a_fragments',)
+
+    def __init__(self, a_fragments: tuple):
+        self._a_fragments = a_fragments
+
+    @property
+    def variables(self) -> List[str]:
+        '''
+        Names of the IRI variables that appear in the template outside of injections
+        '''
+        return list(dict.fromkeys(
+            z_fragment[1] for z_fragment in self._a_fragments if isinstance(z_fragment, tuple) and z_fragment[0] == _XC_VARIABLE
+        ))
+
+    def render(self, variables: Hash={}, injections: Hash={}) -> str:
+        '''
+        Apply variable substitions and injections to produce a query string
+
+        :param variables: dict of variables and their values
+        :param injections: dict of injections to apply across query template
+        :return: the output query string
+        '''
+        h_vars = variables or {}
+        return self._render(lambda si_var: _variable_term(si_var, h_vars), injections)
+
+    # render the template, serializing each IRI variable using the given function
+    def _render(self, f_term: Callable[[str], str], injections: Hash={}) -> str:
+        h_injections = injections or {}
+
+        a_output = []
+        for z_fragment in self._a_fragments:
+            # literal text
+            if isinstance(z_fragment, str):
+                a_output.append(z_fragment)
+            # IRI variable
+            elif z_fragment[0] == _XC_VARIABLE:
+                a_output.append(f_term(z_fragment[1]))
+            # injection site
+            else:
+                _, s_indent, si_inject, s_directive = z_fragment
+
+                # injection not declared; leave directive in place
+                if si_inject not in h_injections:
+                    a_output.append(s_directive)
+                    continue
+
+                # apply injection, which may itself reference IRI variables
+                s_injection = s_indent+h_injections[si_inject]
+                if '<$' in s_injection:
+                    s_injection = _R_VARIABLE.sub(lambda m_var: f_term(m_var.group(1)), s_injection)
+
+                a_output.append(s_injection)
+
+        # return output query string
+        return ''.join(a_output).strip()
+
+
 class Sparql:
     '''
     Wrapper class to simplify submitting and fetching SPARQL queries
 
     :param endpoint: full URL to the SPARQL endpoint
+    :param cache: Optional ResultCache used to memoize the results of `fetch` and `construct`, keyed on the endpoint
+        and the query text with insignificant whitespace removed. Provide one with a `ttl` to bound staleness and a
+        `path` to persist results across processes
+    :param validate: Optional function that accepts the endpoint URL and returns a cheap, hashable fingerprint of the
+        dataset's current state, e.g., the result of a COUNT query or an ETag. Cached results are only used while the
+        fingerprint matches the one recorded alongside them
+    :param transport: TransportPolicy that governs retries, hedging and circuit breaking of queries to the endpoint;
+        defaults to `opl.transport.DEFAULT_POLICY`
     '''
-    def __init__(self, endpoint: str):
+    def __init__(self, endpoint: str, cache: ResultCache=None, validate: Callable[[str], Hashable]=None, transport: TransportPolicy=None):
         '''
         :param endpoint: full URI (with port and path) to SPARQL endpoint
         '''
         self._p_endpoint = endpoint
         self._y_store = SPARQLWrapper(self._p_endpoint)
 
+        # result cache and freshness check
+        self._k_cache = cache
+        self._f_validate = validate
+
+        # request policy
+        self._k_transport = transport
+
     @staticmethod
     def load(template: str, variables: Hash={}, injections: Hash={}) -> str:
         '''
@@ -47,13 +421,23 @@ class Sparql:
         :param injections: dict of injections to apply across query template
         :return: the output query string
         '''
+        return Sparql.compile(template).render(variables, injections)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=N_COMPILED_TEMPLATES)
+    def compile(template: str) -> 'QueryTemplate':
+        '''
+        Static method to resolve the mixins of a query template string and locate its injection sites and variables
+        once, so that it can be rendered repeatedly with different values. Compiled templates are memoized by their text
+
+        :param template: the SPARQL query template string
+        :return: the compiled QueryTemplate
+        '''
         sx_template = template
-        h_vars = variables or {}
-        h_injections = injections or {}
 
         # each def
-        sr_def = r'(?s)'+_directive('@def', True)+r'(.*?)'+_directive('@end')
-        di_defs = re.finditer(sr_def, sx_template)
+        sr_def = _directive('@def', True)+r'(.*?)'+_directive('@end')
+        di_defs = re.finditer(sr_def, sx_template, re.M | re.S)
         for m_def in di_defs:
             # ref var name
             si_var = m_def.group(1)
@@ -69,52 +453,72 @@ class Sparql:
             sx_template = sx_template.replace(m_def.group(0), '')
 
             # replace all invocations
-            di_invocations = re.finditer(_directive('@mixin', r'[ \t]+'+si_var, True), sx_template)
+            di_invocations = re.finditer(_directive('@mixin', r'[ \t]+'+si_var, True), sx_template, re.M)
             for m_invocation in di_invocations:
                 s_indent = m_invocation.group(1)
                 sx_aligned = re.sub(r'(?m)^', s_indent, sx_mixin)
                 sx_template = sx_template.replace(m_invocation.group(0), sx_aligned)
 
-        # injections
-        di_inject = re.finditer(_directive('@inject', r'[ \t]+\$([\w]+)', True), sx_template)
-        for m_inject in di_inject:
-            # ref injection label
-            si_inject = m_inject.group(2)
-
-            # injection not declared
-            if si_inject not in h_injections:
-                continue
+        # split into fragments at injection sites
+        a_fragments = []
+        i_prev = 0
+        for m_inject in re.finditer(_directive('@inject', r'[ \t]+\$([\w]+)', True), sx_template, re.M):
+            a_fragments.extend(_split_variables(sx_template[i_prev:m_inject.start()]))
+            a_fragments.append((_XC_INJECT, m_inject.group(1), m_inject.group(2), m_inject.group(0)))
+            i_prev = m_inject.end()
 
-            # apply injection(s)
-            sx_template = sx_template.replace(m_inject.group(0), m_inject.group(1)+h_injections[si_inject])
+        a_fragments.extend(_split_variables(sx_template[i_prev:]))
 
-        # IRI variables
-        di_vars = re.finditer(r'<\$(\w+)>', sx_template)
-        for m_vars in di_vars:
-            si_var = m_vars.group(1)
-
-            # variable not defined
-            if si_var not in h_vars:
-                raise Exception(f'query template requires a value for the variable "{si_var}"')
-
-            # replace
-            sx_template = sx_template.replace(m_vars.group(0), rdflib.URIRef(h_vars[si_var]).n3())
-
-        # return output query string
-        return sx_template.strip()
+        return QueryTemplate(tuple(a_fragments))
 
     def _set_query(self, s_query):
         self._y_store.setQuery(S_PREFIXES_SPARQL+'\n'+s_query)
+        self._y_store.clearCustomHttpHeader('Accept')
         self._y_store.clearParameter('infer')
         self._y_store.addParameter('infer', 'false')
         self._y_store.clearParameter('sameAs')
         self._y_store.addParameter('sameAs', 'false')
 
     def _submit(self):
+        sx_query = self._y_store.queryString
+
         try:
-            return self._y_store.query()
+            with span('sparql.request', endpoint=self._p_endpoint, request_bytes=len(sx_query)) as k_span:
+                # queries are reads, so they may be hedged
+                y_results = _transport.call(self._k_transport, self._p_endpoint, self._y_store.query)
+                k_span.set('bytes', int(y_results.info().get('content-length') or 0))
+                return y_results
         except Exception as e_query:
-            raise Exception(f'while querying """\n{S_PREFIXES_SPARQL}\n{s_query}"""') from e_query
+            raise Exception(f'while querying """\n{sx_query}"""') from e_query
+
+    @property
+    def cache(self) -> Optional[ResultCache]:
+        '''
+        The ResultCache used to memoize query results, if any
+        '''
+        return self._k_cache
+
+    # run a query through the result cache if enabled
+    def _cached(self, s_kind: str, s_query: str, f_query: Callable[[str], Any]) -> Any:
+        # cache disabled
+        if self._k_cache is None:
+            return f_query(s_query)
+
+        si_key = ResultCache.key('sparql', self._p_endpoint, s_kind, _normalize_query(s_query))
+
+        # current dataset fingerprint
+        z_token = self._f_validate(self._p_endpoint) if self._f_validate is not None else None
+
+        # cache hit, still valid
+        a_cached = self._k_cache.get(si_key)
+        if a_cached is not None and a_cached[0] == z_token:
+            with span('sparql.cache_hit', endpoint=self._p_endpoint, kind=s_kind):
+                return a_cached[1]
+
+        # run query and save to cache along with the fingerprint it is valid for
+        z_result = f_query(s_query)
+        self._k_cache.put(si_key, (z_token, z_result))
+        return z_result
 
     def construct(self, query: str) -> str:
         '''
@@ -122,6 +526,9 @@ class Sparql:
 
         :param query: the SPARQL CONSTRUCT query string to submit. Prefixes are prepended automatically
         '''
+        return self._cached('construct', query, self._construct)
+
+    def _construct(self, query: str) -> bytes:
         self._set_query(query)
         self._y_store.setReturnFormat(TURTLE)
 
@@ -129,10 +536,114 @@ class Sparql:
 
         self._y_store.setMethod(POST)
 
-        y_results = self._submit();
+        with span('sparql.construct', endpoint=self._p_endpoint) as k_span:
+            y_results = self._submit();
+
+            # a_results = self._y_store.query()
+            sb_turtle = SB_PREFIXES_TURTLE+y_results.convert()
+            k_span.set('bytes', len(sb_turtle))
+            return sb_turtle
+
+    def _submit_construct(self, query: str, s_accept: str):
+        self._set_query(query)
+        self._y_store.setReturnFormat(TURTLE)
+
+        self._y_store.addCustomHttpHeader('Accept', s_accept)
+
+        self._y_store.setMethod(POST)
+
+        return self._submit().response
 
-        # a_results = self._y_store.query()
-        return SB_PREFIXES_TURTLE+y_results.convert()
+    def construct_stream(self, query: str, file: BinaryIO=None, chunk_size: int=64 * 1024) -> BinaryIO:
+        '''
+        Submit a SPARQL CONSTRUCT query and write the resulting graph as a Turtle document to a binary file-like object,
+        chunk by chunk as the response arrives, without ever holding the whole document in memory
+
+        :param query: the SPARQL CONSTRUCT query string to submit. Prefixes are prepended automatically
+        :param file: binary file-like object to write to. Defaults to a temporary file that is kept in memory while small
+            and spills over to disk once it grows large; it is returned rewound to the start
+        :param chunk_size: number of bytes to copy at a time
+        :return: the file-like object that was written to
+        '''
+        d_output = file if file is not None else tempfile.SpooledTemporaryFile(max_size=N_SPOOL_BYTES)
+
+        with span('sparql.construct_stream', endpoint=self._p_endpoint) as k_span:
+            d_response = self._submit_construct(query, 'text/turtle')
+            try:
+                d_output.write(SB_PREFIXES_TURTLE+b'\n')
+
+                # copy response body
+                while True:
+                    sb_chunk = d_response.read(chunk_size)
+                    if not sb_chunk:
+                        break
+                    d_output.write(sb_chunk)
+                    k_span.add('bytes', len(sb_chunk))
+            finally:
+                d_response.close()
+
+        # rewind temporary file for reading
+        if file is None:
+            d_output.seek(0)
+
+        return d_output
+
+    def construct_triples(self, query: str) -> Iterator[Tuple[rdflib.term.Node, rdflib.term.Node, rdflib.term.Node]]:
+        '''
+        Submit a SPARQL CONSTRUCT query and yield the resulting triples one at a time as they arrive. Results are
+        requested as N-Triples and parsed line by line, keeping memory bounded
+
+        :param query: the SPARQL CONSTRUCT query string to submit. Prefixes are prepended automatically
+        '''
+        k_sink = _TripleSink()
+        k_parser = NTriplesParser(k_sink)
+
+        d_response = self._submit_construct(query, 'application/n-triples')
+        try:
+            with span('sparql.construct_triples', endpoint=self._p_endpoint, triples=0) as k_span:
+                for sb_line in d_response:
+                    k_sink.triple_ = None
+                    k_parser.line = sb_line.decode('utf-8').rstrip('\r\n')
+                    k_parser.parseline()
+
+                    # skip blank and comment lines
+                    if k_sink.triple_ is not None:
+                        k_span.add('triples')
+                        yield k_sink.triple_
+        finally:
+            d_response.close()
+
+    def construct_graph(self, query: str, graph: rdflib.Graph=None, streaming: bool=False) -> rdflib.Graph:
+        '''
+        Submit a SPARQL CONSTRUCT query and load the resulting triples into an rdflib graph
+
+        :param query: the SPARQL CONSTRUCT query string to submit. Prefixes are prepended automatically
+        :param graph: the graph to add triples to. Defaults to a new graph
+        :param streaming: if True, triples are requested as N-Triples and added one at a time as they arrive instead
+            of handing the whole Turtle document to rdflib's parser, keeping memory bounded by the size of the graph
+        :return: the graph
+        '''
+        y_graph = graph if graph is not None else rdflib.Graph()
+
+        # add triple by triple
+        if streaming:
+            for a_triple in self.construct_triples(query):
+                y_graph.add(a_triple)
+            return y_graph
+
+        # hand prefixes and response body to the parser as a single stream
+        with span('sparql.construct_graph', endpoint=self._p_endpoint) as k_span:
+            d_response = self._submit_construct(query, 'text/turtle')
+            try:
+                y_source = rdflib.parser.InputSource(self._p_endpoint)
+                y_source.setByteStream(io.BufferedReader(_ChainedReader(io.BytesIO(SB_PREFIXES_TURTLE+b'\n'), d_response)))
+                y_graph.parse(y_source, format='turtle')
+            finally:
+                d_response.close()
+
+            k_span.set('triples', len(y_graph))
+
+        return y_graph
 
     def fetch(self, query: str) -> List[Dict[str, Any]]:
         '''
@@ -140,12 +651,375 @@ class Sparql:
 
         :param query: the SPARQL SELECT query string to submit. Prefixes are prepended automatically
         '''
+        return self._cached('fetch', query, self._fetch)
+
+    def _fetch(self, query: str) -> List[Dict[str, Any]]:
+        return self._fetch_document(query)['results']['bindings']
+
+    # submit a SELECT query and return the whole SPARQL JSON results document, including the projected variables
+    def _fetch_document(self, query: str) -> Dict[str, Any]:
         self._set_query(query)
         self._y_store.setReturnFormat(JSON)
 
         self._y_store.setMethod(POST)
 
+        with span('sparql.fetch', endpoint=self._p_endpoint) as k_span:
+            y_results = self._submit()
+
+            g_document = y_results.convert()
+            k_span.set('rows', len(g_document['results']['bindings']))
+            return g_document
+
+    def fetch_table(self, query: str, dataframe: bool=False):
+        '''
+        Submit a SPARQL SELECT query and return the query results as columns of typed NumPy arrays. Literals whose
+        datatype is an xsd integer, decimal/float/double, boolean, dateTime or date become int64, float64, bool,
+        datetime64[us] (in UTC) or datetime64[D] arrays respectively; unbound numeric values become NaN and unbound
+        timestamps NaT. IRIs are interned strings and everything else is kept as strings, both in object arrays.
+        Requires the `numpy` package, and `pandas` for a DataFrame
+
+        :param query: the SPARQL SELECT query string to submit. Prefixes are prepended automatically
+        :param dataframe: return a pandas DataFrame instead of a dict of arrays
+        :return: dict of variable name => array, in projection order, or a DataFrame with one column per variable
+        '''
+        try:
+            import numpy
+        except ImportError as e_import:
+            raise Exception('fetch_table requires the `numpy` package') from e_import
+
+        g_document = self._cached('fetch_document', query, self._fetch_document)
+        a_rows = g_document['results']['bindings']
+
+        # column order; variables in the response head, otherwise order of first appearance
+        a_vars = g_document.get('head', {}).get('vars')
+        if a_vars is None:
+            a_vars = list(dict.fromkeys(si_var for g_row in a_rows for si_var in g_row))
+
+        with span('sparql.fetch_table', endpoint=self._p_endpoint, rows=len(a_rows)):
+            h_columns = {
+                si_var: _bindings_to_array([g_row.get(si_var) for g_row in a_rows]) for si_var in a_vars
+            }
+
+        # dict of arrays
+        if not dataframe:
+            return h_columns
+
+        try:
+            import pandas
+        except ImportError as e_import:
+            raise Exception('fetch_table(dataframe=True) requires the `pandas` package') from e_import
+
+        return pandas.DataFrame(h_columns, columns=a_vars, copy=False)
+
+    def fetch_iter(self, query: str) -> Iterator[Dict[str, Any]]:
+        '''
+        Submit a SPARQL SELECT query and yield the query result rows one at a time as they arrive, in the same
+        format as `fetch`. Results are requested as TSV and parsed line by line, keeping memory bounded
+
+        :param query: the SPARQL SELECT query string to submit. Prefixes are prepended automatically
+        '''
+        self._set_query(query)
+        self._y_store.setReturnFormat(TSV)
+
+        self._y_store.setMethod(POST)
+
         y_results = self._submit()
 
-        return y_results.convert()['results']['bindings']
+        # stream response
+        d_response = y_results.response
+        try:
+            with span('sparql.fetch_iter', endpoint=self._p_endpoint, rows=0) as k_span:
+                a_vars = None
+                for sb_line in d_response:
+                    s_line = sb_line.decode('utf-8').rstrip('\r\n')
+
+                    # header row
+                    if a_vars is None:
+                        a_vars = [s_var.lstrip('?$') for s_var in s_line.split('\t')]
+                        continue
+
+                    # blank line is only meaningful as an all-unbound row of a single variable
+                    if not s_line and len(a_vars) > 1:
+                        continue
+
+                    # build row, omitting unbound variables
+                    g_row = {}
+                    for si_var, s_term in zip(a_vars, s_line.split('\t')):
+                        g_binding = _tsv_term_to_binding(s_term)
+                        if g_binding is not None:
+                            g_row[si_var] = g_binding
+
+                    k_span.add('rows')
+                    yield g_row
+        finally:
+            d_response.close()
+
+    def fetch_paginated(self, query: str, page_size: int=10000, max_workers: int=4, order_by: str=None, retries: int=None, backoff: float=None) -> List[Dict[str, Any]]:
+        '''
+        Submit a SPARQL SELECT query in pages using an ORDER BY/LIMIT/OFFSET window, fetching several pages
+        concurrently, and return all the query result rows in order as a list of dicts, same as `fetch`
+
+        :param query: the SPARQL SELECT query string to submit. Prefixes are prepended automatically.
+            Must not have its own LIMIT or OFFSET
+        :param page_size: number of rows to request per page
+        :param max_workers: maximum number of pages to request at once
+        :param order_by: ORDER BY condition(s) that give the results a stable order, e.g., '?s ?p'. Defaults to the
+            query's own ORDER BY if it has one, otherwise to its projected variables
+        :param retries: number of times to retry each page upon a transient failure. Takes precedence over this
+            instance's transport policy; defaults to that policy's setting, or to 3 if this instance has none
+        :param backoff: base number of seconds to wait before retrying; doubles with each attempt and is jittered.
+            Takes precedence over this instance's transport policy, same as `retries`
+        '''
+        sx_query = query.strip()
+        s_modifiers = _query_modifiers(sx_query)
+
+        # query already limited
+        if re.search(r'(?i)\b(?:limit|offset)\b', s_modifiers):
+            raise Exception('cannot paginate a query that already has a LIMIT or OFFSET')
+
+        # query has no order of its own
+        if not re.search(r'(?i)\border\s+by\b', s_modifiers):
+            # default to projected variables
+            if order_by is None:
+                a_vars = _projected_vars(sx_query)
+                if not a_vars:
+                    raise Exception('cannot determine a stable order for paginating the query; please provide `order_by`')
+                order_by = ' '.join('?'+si_var for si_var in a_vars)
+
+            sx_query += f'\norder by {order_by}'
+        # conflicting order
+        elif order_by is not None:
+            raise Exception('query already has an ORDER BY; `order_by` must not be provided')
 
+        # policy shared by all pages; explicit retry settings take precedence over those of this instance's policy
+        if self._k_transport is not None:
+            k_transport = self._k_transport.derive(retries, backoff)
+        else:
+            k_transport = _transport.DEFAULT_POLICY.derive(3 if retries is None else retries, backoff)
+
+        # fetch a single page using its own store since SPARQLWrapper is not thread-safe
+        def fetch_page(i_page):
+            k_page = Sparql(self._p_endpoint, transport=k_transport)
+            s_page = f'{sx_query}\nlimit {page_size}\noffset {i_page*page_size}'
+            return k_page.fetch(s_page)
+
+        a_rows = []
+        i_page = 0
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as y_pool:
+            while True:
+                # request next wave of pages
+                a_pages = list(y_pool.map(fetch_page, range(i_page, i_page+max(1, max_workers))))
+                i_page += len(a_pages)
+
+                # stitch pages in order, stopping after the first partial page
+                for a_page in a_pages:
+                    a_rows.extend(a_page)
+                    if len(a_page) < page_size:
+                        return a_rows
+
+    def fetch_batch(self, template: str, variables: List[Hash], injections: Hash={}, chunk_size: int=500, max_query_bytes: int=64 * 1024, max_workers: int=4) -> List[List[Dict[str, Any]]]:
+        '''
+        Render a SELECT query template for many sets of IRI variables and fetch the results for all of them using a few
+        queries instead of one per set. IRI variables whose values differ between sets are replaced by query variables
+        bound by a generated VALUES block, which is split into chunks that keep each query under the given limits.
+        The result rows are then split back out per set of variables, in the same format as `fetch`. Templates with
+        subqueries cannot be constrained this way, so they are fetched once per distinct set instead
+
+        :param template: the query template string, same as for `Sparql.load`. Must be a SELECT query without LIMIT,
+            OFFSET, GROUP BY, HAVING or aggregates, since those would apply across all sets at once
+        :param variables: list of dicts of variables and their values, one per set
+        :param injections: dict of injections to apply across query template, shared by all sets
+        :param chunk_size: maximum number of sets to bind per query
+        :param max_query_bytes: approximate maximum size of each query string, as some endpoints limit request sizes
+        :param max_workers: maximum number of queries to submit at once
+        :return: list of result rows for each set of variables, in the same order as `variables`
+        '''
+        a_inputs = list(variables)
+        if not a_inputs:
+            return []
+
+        k_template = Sparql.compile(template)
+
+        # every IRI variable referenced by the template or its injections
+        a_names = list(dict.fromkeys(k_template.variables+[
+            m_var.group(1) for s_injection in (injections or {}).values() for m_var in _R_VARIABLE.finditer(s_injection)
+        ]))
+
+        # variables whose values differ between sets get bound by the values block; the rest are substituted directly
+        h_first = a_inputs[0]
+        a_varying = [si_var for si_var in a_names if any(h_vars.get(si_var) != h_first.get(si_var) for h_vars in a_inputs)]
+        as_varying = set(a_varying)
+
+        # all sets render the same query
+        if not a_varying:
+            a_rows = self.fetch(k_template.render(h_first, injections))
+            return [list(a_rows) for _ in a_inputs]
+
+        sx_batch = k_template._render(
+            lambda si_var: '?'+S_BATCH_VAR+si_var if si_var in as_varying else _variable_term(si_var, h_first), injections,
+        )
+
+        # distinct sets of values and the inputs that share them, along with their serialized rows of the values block
+        h_sets = {}
+        h_values_rows = {}
+        for i_input, h_vars in enumerate(a_inputs):
+            a_values = tuple(h_vars.get(si_var) for si_var in a_varying)
+            if a_values not in h_sets:
+                h_sets[a_values] = []
+                h_values_rows[a_values] = '        ('+' '.join(_variable_term(si_var, h_vars) for si_var in a_varying)+')\n'
+            h_sets[a_values].append(i_input)
+
+        # fetch a single query using its own store since SPARQLWrapper is not thread-safe
+        def fetch_query(sx_query):
+            k_query = Sparql(self._p_endpoint, cache=self._k_cache, validate=self._f_validate, transport=self._k_transport)
+            return k_query.fetch(sx_query)
+
+        # subquery would not see the values block; render and fetch each distinct set on its own
+        if _has_subquery(sx_batch):
+            a_sets = list(h_sets.values())
+            with span('sparql.fetch_batch', endpoint=self._p_endpoint, inputs=len(a_inputs), queries=len(a_sets)):
+                with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(a_sets)))) as y_pool:
+                    a_results = list(y_pool.map(fetch_query, [k_template.render(a_inputs[a_indexes[0]], injections) for a_indexes in a_sets]))
+
+            a_output = [None] * len(a_inputs)
+            for a_indexes, a_rows in zip(a_sets, a_results):
+                for i_input in a_indexes:
+                    a_output[i_input] = list(a_rows)
+
+            return a_output
+
+        s_head, s_tail = _batch_skeleton(sx_batch, a_varying)
+
+        # group rows of the values block into chunks
+        a_chunks = []
+        a_chunk = []
+        n_chunk_bytes = len(s_head)+len(s_tail)+len(S_PREFIXES_SPARQL)
+        for s_row in h_values_rows.values():
+            # start a new chunk
+            if a_chunk and (len(a_chunk) >= chunk_size or n_chunk_bytes+len(s_row) > max_query_bytes):
+                a_chunks.append(a_chunk)
+                a_chunk = []
+                n_chunk_bytes = len(s_head)+len(s_tail)+len(S_PREFIXES_SPARQL)
+
+            a_chunk.append(s_row)
+            n_chunk_bytes += len(s_row)
+        a_chunks.append(a_chunk)
+
+        # split rows back out by the values of their batch variables
+        as_batch = {S_BATCH_VAR+si_var for si_var in a_varying}
+        h_results = {a_values: [] for a_values in h_sets}
+        with span('sparql.fetch_batch', endpoint=self._p_endpoint, inputs=len(a_inputs), queries=len(a_chunks)):
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(a_chunks)))) as y_pool:
+                for a_rows in y_pool.map(fetch_query, [s_head+''.join(a_rows)+s_tail for a_rows in a_chunks]):
+                    for g_row in a_rows:
+                        a_values = tuple(g_row[S_BATCH_VAR+si_var]['value'] if S_BATCH_VAR+si_var in g_row else None for si_var in a_varying)
+                        a_matched = h_results.get(a_values)
+                        if a_matched is not None:
+                            a_matched.append({si_var: g_binding for si_var, g_binding in g_row.items() if si_var not in as_batch})
+
+        # results per input
+        a_output = [None] * len(a_inputs)
+        for a_values, a_indexes in h_sets.items():
+            for i_input in a_indexes:
+                a_output[i_input] = list(h_results[a_values])
+
+        return a_output
+
+
+# accept headers sent by SPARQLWrapper for each return format
+S_ACCEPT_JSON = 'application/sparql-results+json,application/json,text/javascript,application/javascript'
+S_ACCEPT_TURTLE = 'text/turtle'
+
+class AsyncSparql:
+    '''
+    Asynchronous counterpart of `Sparql` that keeps connections to the endpoint alive in a pool and can have
+    many queries in flight at once, e.g.::
+
+        async with AsyncSparql(endpoint) as k_sparql:
+            a_results = await asyncio.gather(*[k_sparql.fetch(s_query) for s_query in a_queries])
+
+    Requests are made in a thread pool so that a blocking HTTP client can be shared safely across coroutines
+
+    :param endpoint: full URL to the SPARQL endpoint
+    :param pool_size: Maximum number of connections to keep alive, which is also the maximum number of queries
+        that are submitted at once; further queries wait for a free connection
+    :param transport: TransportPolicy that governs retries, hedging and circuit breaking of queries to the endpoint;
+        defaults to `opl.transport.DEFAULT_POLICY`
+    '''
+    def __init__(self, endpoint: str, pool_size: int=10, transport: TransportPolicy=None):
+        self._p_endpoint = endpoint
+        self._k_transport = transport
+
+        # shared session with a connection pool large enough for concurrent requests
+        self._y_session = requests.Session()
+        y_adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._y_session.mount('https://', y_adapter)
+        self._y_session.mount('http://', y_adapter)
+
+        self._y_pool = ThreadPoolExecutor(max_workers=max(1, pool_size))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, dc_error, e_error, y_traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Close all pooled connections
+        '''
+        self._y_pool.shutdown(wait=False)
+        self._y_session.close()
+
+    # blocking request and conversion of its response, both made on a pool thread
+    def _post(self, s_query: str, s_accept: str, f_convert: Callable[[requests.Response], Any]) -> Any:
+        sx_query = S_PREFIXES_SPARQL+'\n'+s_query
+
+        # send query, failing on error statuses
+        def request():
+            d_response = self._y_session.post(self._p_endpoint, data={
+                'query': sx_query,
+                'infer': 'false',
+                'sameAs': 'false',
+            }, headers={
+                'Accept': s_accept,
+            })
+            d_response.raise_for_status()
+
+            # read the whole body here so that an interrupted transfer fails, and may be retried, within the call
+            sb_body = d_response.content
+            return d_response, len(sb_body)
+
+        try:
+            with span('sparql.request', endpoint=self._p_endpoint, request_bytes=len(sx_query)) as k_span:
+                d_response, n_bytes = _transport.call(self._k_transport, self._p_endpoint, request)
+                k_span.set('bytes', n_bytes)
+        except Exception as e_query:
+            raise Exception(f'while querying """\n{sx_query}"""') from e_query
+
+        return f_convert(d_response)
+
+    async def _submit(self, s_query: str, s_accept: str, f_convert: Callable[[requests.Response], Any]) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._y_pool, self._post, s_query, s_accept, f_convert)
+
+    async def construct(self, query: str) -> bytes:
+        '''
+        Submit a SPARQL CONSTRUCT query and return the resulting graph as a Turtle document, same as `Sparql.construct`
+
+        :param query: the SPARQL CONSTRUCT query string to submit. Prefixes are prepended automatically
+        '''
+        with span('sparql.construct', endpoint=self._p_endpoint) as k_span:
+            sb_turtle = await self._submit(query, S_ACCEPT_TURTLE, lambda d_response: SB_PREFIXES_TURTLE+d_response.content)
+            k_span.set('bytes', len(sb_turtle))
+            return sb_turtle
+
+    async def fetch(self, query: str) -> List[Dict[str, Any]]:
+        '''
+        Submit a SPARQL SELECT query and return the query result rows as a list of dicts, same as `Sparql.fetch`
+
+        :param query: the SPARQL SELECT query string to submit. Prefixes are prepended automatically
+        '''
+        with span('sparql.fetch', endpoint=self._p_endpoint) as k_span:
+            a_bindings = await self._submit(query, S_ACCEPT_JSON, lambda d_response: d_response.json()['results']['bindings'])
+            k_span.set('rows', len(a_bindings))
+            return a_bindings
@@ -0,0 +1,402 @@
+'''
+Transport policies shared by the clients in this library. A policy wraps each request sent to an endpoint with:
+
+ - retries of transient failures (connection errors, timeouts, throttling and 5xx responses) after a jittered,
+   exponentially growing delay; requests that are not idempotent, e.g., page updates, are only retried if they
+   certainly never reached the server, since a write that timed out may still have been applied
+ - hedging of idempotent reads: if a request is still outstanding once it has taken longer than a given percentile
+   of that endpoint's recent latencies, a duplicate is sent and whichever finishes first wins
+ - a circuit breaker per endpoint: after several consecutive transient failures, requests to that endpoint fail
+   immediately with `CircuitOpen` until a cool-down has passed, after which a single trial request decides whether
+   to close the circuit again
+
+Clients use `DEFAULT_POLICY` unless given their own, e.g.::
+
+    k_policy = opl.TransportPolicy(retries=5, hedge_percentile=95)
+    k_sparql = opl.Sparql(endpoint, transport=k_policy)
+'''
+import copy
+import time
+import random
+import socket
+import threading
+import http.client
+import urllib.error
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+import urllib3
+from SPARQLWrapper.SPARQLExceptions import EndPointInternalError
+
+from .instrumentation import span
+
+# HTTP status codes worth retrying
+AS_TRANSIENT_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# HTTP status codes with which a server rejects a request without processing it
+AS_UNPROCESSED_STATUSES = {408, 425, 429}
+
+# network failures worth retrying, across the HTTP clients used by this library
+_TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    http.client.IncompleteRead,
+    urllib.error.URLError,
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.MaxRetryError,
+    urllib3.exceptions.TimeoutError,
+    EndPointInternalError,
+)
+
+# failures to establish a connection, before any part of a request was sent
+_UNSENT_ERRORS = (
+    ConnectionRefusedError,
+    socket.gaierror,
+    requests.exceptions.ConnectTimeout,
+    urllib3.exceptions.NewConnectionError,
+    urllib3.exceptions.ConnectTimeoutError,
+)
+
+# number of recent latencies per endpoint from which the hedging threshold is derived
+N_LATENCY_SAMPLES = 200
+
+
+class CircuitOpen(Exception):
+    '''
+    Raised instead of sending a request to an endpoint whose circuit breaker is open
+    '''
+
+
+# status code carried by an exception from any of the underlying HTTP clients, if any
+def _status(e_error: BaseException) -> Optional[int]:
+    for z_status in (
+        getattr(e_error, 'status', None),
+        getattr(e_error, 'code', None),
+        getattr(getattr(e_error, 'response', None), 'status_code', None),
+    ):
+        if isinstance(z_status, int) and z_status:
+            return z_status
+    return None
+
+def is_transient(error: BaseException) -> bool:
+    '''
+    Default test for whether a failed request is worth retrying: connection failures, timeouts, and responses with
+    a status of 408, 425, 429 or 5xx other than 501
+
+    :param error: The exception raised by the request
+    '''
+    e_error = error
+
+    # HTTP error response
+    n_status = _status(e_error)
+    if n_status is not None:
+        return n_status in AS_TRANSIENT_STATUSES
+
+    # network failures; SPARQLWrapper also maps 500 responses to its own exception
+    if isinstance(e_error, _TRANSIENT_ERRORS):
+        return True
+
+    # wrapped failure
+    if e_error.__cause__ is not None and e_error.__cause__ is not e_error:
+        return is_transient(e_error.__cause__)
+
+    return False
+
+# whether a failed request certainly never reached the server or was rejected without being processed, so that even
+# a request that is not idempotent can safely be sent again
+def _is_unsent(e_error: BaseException, as_seen: set=None) -> bool:
+    as_seen = as_seen if as_seen is not None else set()
+    if id(e_error) in as_seen:
+        return False
+    as_seen.add(id(e_error))
+
+    # HTTP error response
+    n_status = _status(e_error)
+    if n_status is not None:
+        return n_status in AS_UNPROCESSED_STATUSES
+
+    # connection could not be established
+    if isinstance(e_error, _UNSENT_ERRORS):
+        return True
+
+    # underlying failure, e.g., the reason for urllib3's MaxRetryError or urllib's URLError, or the error that
+    # requests wraps in its own ConnectionError
+    a_causes = [getattr(e_error, 'reason', None), e_error.__cause__]
+    if e_error.args:
+        a_causes.append(e_error.args[0])
+
+    return any(isinstance(e_cause, BaseException) and _is_unsent(e_cause, as_seen) for e_cause in a_causes)
+
+# close the result of a hedged request that lost the race once it finishes, e.g., an unread HTTP response
+def _release(y_future):
+    if y_future.cancelled() or y_future.exception() is not None:
+        return
+
+    z_result = y_future.result()
+    for z_closable in (z_result, getattr(z_result, 'response', None)):
+        f_close = getattr(z_closable, 'close', None)
+        if callable(f_close):
+            f_close()
+            return
+
+
+class _CircuitBreaker:
+    __slots__ = ('_n_threshold', '_x_reset', '_k_lock', '_c_failures', '_x_opened', '_b_trial')
+
+    def __init__(self, n_threshold: int, x_reset: float):
+        self._n_threshold = n_threshold
+        self._x_reset = x_reset
+        self._k_lock = threading.Lock()
+        self._c_failures = 0
+        self._x_opened = None
+        self._b_trial = False
+
+    # raise if requests may not be sent right now; lets a single trial request through once the cool-down passed
+    def before(self, p_endpoint: str):
+        with self._k_lock:
+            # closed
+            if self._x_opened is None:
+                return
+
+            # cooling down, or trial already in flight
+            if self._b_trial or time.monotonic() - self._x_opened < self._x_reset:
+                raise CircuitOpen(f'circuit breaker for {p_endpoint} is open after {self._c_failures} consecutive failures')
+
+            # half-open
+            self._b_trial = True
+
+    def record(self, b_healthy: bool):
+        with self._k_lock:
+            self._b_trial = False
+
+            # close circuit
+            if b_healthy:
+                self._c_failures = 0
+                self._x_opened = None
+            # open circuit, or reopen it after a failed trial
+            else:
+                self._c_failures += 1
+                if self._x_opened is not None or self._c_failures >= self._n_threshold:
+                    self._x_opened = time.monotonic()
+
+
+class _LatencyWindow:
+    __slots__ = ('_a_samples', '_k_lock')
+
+    def __init__(self):
+        self._a_samples = deque(maxlen=N_LATENCY_SAMPLES)
+        self._k_lock = threading.Lock()
+
+    def add(self, x_latency: float):
+        with self._k_lock:
+            self._a_samples.append(x_latency)
+
+    # latency at the given percentile, or None until there are enough samples
+    def percentile(self, x_percent: float, n_min_samples: int) -> Optional[float]:
+        with self._k_lock:
+            if len(self._a_samples) < n_min_samples:
+                return None
+            a_sorted = sorted(self._a_samples)
+        return a_sorted[min(len(a_sorted)-1, int(len(a_sorted) * x_percent / 100))]
+
+
+class TransportPolicy:
+    '''
+    Policy for sending requests to endpoints, shared by all clients that use it. Circuit breakers and latency
+    statistics are kept per endpoint, so clients of the same server should share a policy
+
+    :param retries: Number of times to retry a request that failed transiently. Requests that are not idempotent are
+        only retried if they certainly never reached the server, e.g., the connection was refused or the server
+        responded with 408, 425 or 429
+    :param backoff: Base number of seconds to wait before retrying; doubles with each attempt and is fully jittered
+    :param max_backoff: Maximum number of seconds to wait before retrying
+    :param retry_on: Function that accepts the exception a request raised and returns whether it is transient;
+        defaults to `is_transient`. Only transient failures are retried and count against the circuit breaker
+    :param hedge_percentile: Latency percentile, e.g., 95, after which a duplicate of a still outstanding idempotent
+        read is sent; None disables hedging
+    :param hedge_min_samples: Number of latencies that must have been observed for an endpoint before hedging to it
+    :param breaker_threshold: Number of consecutive transient failures after which an endpoint's circuit opens;
+        None disables circuit breaking
+    :param breaker_reset: Number of seconds an open circuit waits before letting a trial request through
+    :param max_workers: Maximum number of requests in flight at once while hedging
+    '''
+    def __init__(self, retries: int=2, backoff: float=0.5, max_backoff: float=30, retry_on: Callable[[BaseException], bool]=None, hedge_percentile: float=None, hedge_min_samples: int=20, breaker_threshold: Optional[int]=5, breaker_reset: float=30, max_workers: int=32):
+        self._n_retries = max(0, retries)
+        self._x_backoff = backoff
+        self._x_max_backoff = max_backoff
+        self._f_retry_on = retry_on if retry_on is not None else is_transient
+        self._x_hedge_percentile = hedge_percentile
+        self._n_hedge_min_samples = max(1, hedge_min_samples)
+        self._n_breaker_threshold = breaker_threshold
+        self._x_breaker_reset = breaker_reset
+        self._n_workers = max(2, max_workers)
+
+        # per-endpoint state
+        self._h_breakers: Dict[str, _CircuitBreaker] = {}
+        self._h_latencies: Dict[str, _LatencyWindow] = {}
+        self._k_lock = threading.Lock()
+
+        # pool for hedged requests, created on first use
+        self._y_pool = None
+
+    def derive(self, retries: int=None, backoff: float=None) -> 'TransportPolicy':
+        '''
+        Create a policy with the same settings except for the given ones, which shares this policy's circuit breakers
+        and latency statistics
+
+        :param retries: Number of times to retry a request that failed transiently; defaults to this policy's
+        :param backoff: Base number of seconds to wait before retrying; defaults to this policy's
+        '''
+        k_derived = copy.copy(self)
+        if retries is not None:
+            k_derived._n_retries = max(0, retries)
+        if backoff is not None:
+            k_derived._x_backoff = backoff
+        return k_derived
+
+    def _endpoint_state(self, p_endpoint: str):
+        with self._k_lock:
+            if p_endpoint not in self._h_latencies:
+                self._h_latencies[p_endpoint] = _LatencyWindow()
+                if self._n_breaker_threshold is not None:
+                    self._h_breakers[p_endpoint] = _CircuitBreaker(self._n_breaker_threshold, self._x_breaker_reset)
+            return self._h_breakers.get(p_endpoint), self._h_latencies[p_endpoint]
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._k_lock:
+            if self._y_pool is None:
+                self._y_pool = ThreadPoolExecutor(max_workers=self._n_workers)
+            return self._y_pool
+
+    # send a request once, hedging it if enabled and it is slow
+    def _attempt(self, f_call: Callable[[], Any], x_threshold: Optional[float], k_span) -> Any:
+        # no hedging
+        if x_threshold is None:
+            return f_call()
+
+        # wait for the first request up to the threshold
+        y_first = self._pool().submit(f_call)
+        if wait([y_first], timeout=x_threshold).done:
+            return y_first.result()
+
+        # send a duplicate and take whichever succeeds first
+        k_span.set('hedged', True)
+        as_pending = {y_first, self._pool().submit(f_call)}
+        e_last = None
+        while as_pending:
+            as_done, as_pending = wait(as_pending, return_when=FIRST_COMPLETED)
+            for y_done in as_done:
+                e_last = y_done.exception()
+                if e_last is None:
+                    # release the loser
+                    for y_other in (as_done | as_pending) - {y_done}:
+                        if not y_other.cancel():
+                            y_other.add_done_callback(_release)
+
+                    return y_done.result()
+
+        raise e_last
+
+    def call(self, endpoint: str, function: Callable[[], Any], idempotent: bool=True, timeout: float=None) -> Any:
+        '''
+        Send a request according to this policy
+
+        :param endpoint: Identifies the server the request goes to, e.g., its URL; keys the circuit breaker and latencies
+        :param function: Sends the request and returns its result, raising an exception on failure. If the result has
+            a `close` method (or a `response` that does), it is called on the result of a hedged request that lost
+        :param idempotent: Whether the request is a read that can safely be sent more than once; only idempotent
+            requests are hedged, and others are only retried if they certainly never reached the server
+        :param timeout: Optional number of seconds the call may take across all attempts; no retry is made that would
+            start after it has passed. Each attempt should bound itself by the time remaining
+        :return: The result of `function`
+        '''
+        p_endpoint = endpoint
+        k_breaker, k_latencies = self._endpoint_state(p_endpoint)
+        x_deadline = time.monotonic()+timeout if timeout is not None else None
+
+        with span('transport.call', endpoint=p_endpoint, attempts=0) as k_span:
+            i_attempt = 0
+            while True:
+                if k_breaker is not None:
+                    k_breaker.before(p_endpoint)
+
+                # hedging threshold for this attempt
+                x_threshold = None
+                if idempotent and self._x_hedge_percentile is not None:
+                    x_threshold = k_latencies.percentile(self._x_hedge_percentile, self._n_hedge_min_samples)
+
+                k_span.add('attempts')
+                x_start = time.perf_counter()
+                try:
+                    z_result = self._attempt(function, x_threshold, k_span)
+                except Exception as e_call:
+                    b_transient = self._f_retry_on(e_call)
+
+                    # only transient failures say anything about the endpoint's health
+                    if k_breaker is not None:
+                        k_breaker.record(not b_transient)
+
+                    # give up; a write that failed ambiguously may have been applied
+                    if not b_transient or i_attempt >= self._n_retries or not (idempotent or _is_unsent(e_call)):
+                        raise
+
+                    # full jitter, unless the retry would start after the deadline
+                    x_sleep = random.uniform(0, min(self._x_max_backoff, self._x_backoff * (2 ** i_attempt)))
+                    if x_deadline is not None and time.monotonic()+x_sleep >= x_deadline:
+                        raise
+
+                    time.sleep(x_sleep)
+                    i_attempt += 1
+                    continue
+
+                if k_breaker is not None:
+                    k_breaker.record(True)
+                k_latencies.add(time.perf_counter() - x_start)
+                return z_result
+
+
+# policy used by clients that are not given one
+DEFAULT_POLICY = TransportPolicy()
+
+
+def call(policy: Optional[TransportPolicy], endpoint: str, function: Callable[[], Any], idempotent: bool=True, timeout: float=None) -> Any:
+    '''
+    Send a request on behalf of a client according to its policy, or according to `DEFAULT_POLICY` if it has none
+
+    :param policy: The client's policy, or None
+    :param endpoint: Key of the endpoint the request is sent to, see `TransportPolicy.call`
+    :param function: Sends the request and returns its result
+    :param idempotent: Whether the request may safely be sent more than once
+    :param timeout: Optional number of seconds the request may take in total, including retries
+    '''
+    return (policy if policy is not None else DEFAULT_POLICY).call(endpoint, function, idempotent, timeout)
+
+
+def settle(futures: List[Future], return_exceptions: bool=True) -> List[Any]:
+    '''
+    Collect the results of concurrently submitted requests in submission order, isolating failures from each other
+
+    :param futures: The futures of the requests, all of which have settled
+    :param return_exceptions: If True, a failed request yields its exception in place of its result; otherwise,
+        the first failure is raised
+    '''
+    a_results = []
+    for y_future in futures:
+        e_request = y_future.exception()
+
+        # isolate failure
+        if e_request is not None:
+            if not return_exceptions:
+                raise e_request
+
+            a_results.append(e_request)
+        else:
+            a_results.append(y_future.result())
+
+    return a_results
@@ -36,6 +36,13 @@ setup(
             'sphinxcontrib-apidoc',
             'sphinx_autodoc_typehints',
         ],
+        'otel': [
+            'opentelemetry-api',
+        ],
+        'table': [
+            'numpy',
+            'pandas',
+        ],
     },
     license='Apache 2.0',
     classifiers=[
@@ -0,0 +1,88 @@
+import time
+import sqlite3
+
+from opl.cache import ResultCache
+
+
+def test_lru_eviction():
+    k_cache = ResultCache(size=2)
+    k_cache.put('a', 1)
+    k_cache.put('b', 2)
+
+    # touch 'a' so that 'b' is least recently used
+    assert k_cache.get('a') == 1
+    k_cache.put('c', 3)
+
+    assert k_cache.get('b') is None
+    assert k_cache.get('a') == 1 and k_cache.get('c') == 3
+    assert k_cache.stats == {'hits': 3, 'misses': 1, 'entries': 2}
+
+def test_ttl_expiry():
+    k_cache = ResultCache(ttl=0.05)
+    k_cache.put('a', 1)
+    assert k_cache.get('a') == 1
+
+    time.sleep(0.08)
+    assert k_cache.get('a', 'missing') == 'missing'
+    assert k_cache.stats['entries'] == 0
+
+def test_persists_across_instances(tmp_path):
+    p_db = str(tmp_path / 'cache.db')
+
+    k_cache = ResultCache(path=p_db)
+    k_cache.put('a', {'rows': [1, 2]})
+    k_cache.close()
+
+    k_cache = ResultCache(path=p_db)
+    assert k_cache.get('a') == {'rows': [1, 2]}
+    k_cache.close()
+
+def test_ttl_expiry_on_disk(tmp_path):
+    p_db = str(tmp_path / 'cache.db')
+
+    k_cache = ResultCache(ttl=0.05, path=p_db)
+    k_cache.put('a', 1)
+    k_cache.close()
+
+    time.sleep(0.08)
+    k_cache = ResultCache(ttl=0.05, path=p_db)
+    assert k_cache.get('a') is None
+    k_cache.close()
+
+    # expired entry was dropped from the backing store
+    with sqlite3.connect(p_db) as y_db:
+        assert y_db.execute('select count(*) from entries').fetchone()[0] == 0
+
+def test_sqlite_eviction(tmp_path):
+    p_db = str(tmp_path / 'cache.db')
+
+    k_cache = ResultCache(size=2, path=p_db)
+    for si_key in ('a', 'b', 'c'):
+        k_cache.put(si_key, si_key.upper())
+        time.sleep(0.01)
+    k_cache.close()
+
+    with sqlite3.connect(p_db) as y_db:
+        assert sorted(a_row[0] for a_row in y_db.execute('select key from entries')) == ['b', 'c']
+
+    k_cache = ResultCache(size=2, path=p_db)
+    assert k_cache.get('a') is None
+    assert k_cache.get('b') == 'B' and k_cache.get('c') == 'C'
+    k_cache.close()
+
+def test_discard_and_clear(tmp_path):
+    k_cache = ResultCache(path=str(tmp_path / 'cache.db'))
+    k_cache.put('a', 1)
+    k_cache.put('b', 2)
+
+    k_cache.discard('a')
+    assert k_cache.get('a') is None and k_cache.get('b') == 2
+
+    k_cache.clear()
+    assert k_cache.get('b') is None
+    assert k_cache.stats == {'hits': 0, 'misses': 1, 'entries': 0}
+    k_cache.close()
+
+def test_key_is_deterministic():
+    assert ResultCache.key('sparql', 'x', 1) == ResultCache.key('sparql', 'x', 1)
+    assert ResultCache.key('sparql', 'x', 1) != ResultCache.key('sparql', 'x', 2)
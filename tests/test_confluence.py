@@ -0,0 +1,104 @@
+import re
+
+from opl.confluence import _Page, _find_span_macro, _span_macro_xhtml, _content_macro_id
+
+
+# page whose content is kept in memory instead of on a server
+class _LocalPage(_Page):
+    def __init__(self, sx_content: str):
+        self._si_page = 'local'
+        self.content = sx_content
+        self.updates = 0
+
+    def get_content(self) -> str:
+        return self.content
+
+    def update_content(self, content: str):
+        self.content = content
+        self.updates += 1
+
+
+def _expand_macro(sx_body: str) -> str:
+    return (
+        '<ac:structured-macro ac:name="expand" ac:schema-version="1" ac:macro-id="expand-1">'
+        '<ac:parameter ac:name="title">Details</ac:parameter>'
+        f'<ac:rich-text-body>{sx_body}</ac:rich-text-body>'
+        '</ac:structured-macro>'
+    )
+
+def _balanced(sx_page: str) -> bool:
+    return len(re.findall(r'<ac:structured-macro\b[^>]*[^/]>', sx_page)) == sx_page.count('</ac:structured-macro>')
+
+
+def test_find_span_macro_spans_nested_macros():
+    sx_span = _span_macro_xhtml('s1', _expand_macro('<p>inside</p>')+'<p>after-nested</p>').strip()
+    sx_page = '<p>before</p>'+sx_span+'<p>after</p>'
+
+    i_start, i_end, _ = _find_span_macro(sx_page, 's1')
+    assert sx_page[i_start:i_end] == sx_span
+
+def test_find_span_macro_ignores_nested_span_ids():
+    sx_inner = _span_macro_xhtml('inner', '<p>inner</p>').strip()
+    sx_outer = _span_macro_xhtml('outer', sx_inner).strip()
+    sx_page = '<p>before</p>'+sx_outer
+
+    i_start, i_end, _ = _find_span_macro(sx_page, 'outer')
+    assert sx_page[i_start:i_end] == sx_outer
+
+    i_start, i_end, _ = _find_span_macro(sx_page, 'inner')
+    assert sx_page[i_start:i_end] == sx_inner
+
+    assert _find_span_macro(sx_page, 'missing') is None
+
+def test_find_span_macro_skips_cdata():
+    sx_code = (
+        '<ac:structured-macro ac:name="code"><ac:plain-text-body><![CDATA[</ac:structured-macro>]]></ac:plain-text-body>'
+        '</ac:structured-macro>'
+    )
+    sx_span = _span_macro_xhtml('s1', sx_code+'<p>tail</p>').strip()
+
+    i_start, i_end, _ = _find_span_macro(sx_span, 's1')
+    assert (i_start, i_end) == (0, len(sx_span))
+
+
+def test_update_spans_replaces_nested_content_entirely():
+    k_page = _LocalPage('<p>before</p>'+_span_macro_xhtml('s1', '<p>old</p>').strip()+'<p>after</p>')
+
+    # nest a macro inside the span, then replace it with plain content
+    assert k_page.update_spans({'s1': _expand_macro('<p>inside</p>')+'<p>after-nested</p>'})
+    assert k_page.update_spans({'s1': 'plain'})
+
+    assert 'after-nested' not in k_page.content
+    assert 'expand' not in k_page.content
+    assert k_page.content.startswith('<p>before</p>')
+    assert k_page.content.endswith('<p>after</p>')
+    assert _balanced(k_page.content)
+
+def test_update_spans_handles_several_spans():
+    k_page = _LocalPage(
+        '<h1>One</h1>'+_span_macro_xhtml('s1', _expand_macro('<p>a</p>')).strip()
+        +'<h1>Two</h1>'+_span_macro_xhtml('s2', '<p>b</p>').strip()
+        +'<h1>Three</h1>'+_span_macro_xhtml('s3', '<p>c</p>').strip()
+    )
+
+    assert k_page.update_spans({'s1': '<p>one</p>', 's3': _expand_macro('<p>three</p>')})
+    assert k_page.updates == 1
+
+    sx_page = k_page.content
+    assert _balanced(sx_page)
+    assert [m_heading.group(1) for m_heading in re.finditer(r'<h1>(\w+)</h1>', sx_page)] == ['One', 'Two', 'Three']
+    assert '<p>b</p>' in sx_page and '<p>a</p>' not in sx_page and '<p>c</p>' not in sx_page
+
+    # each span tagged with the hash of its content
+    for si_span, sx_content in (('s1', '<p>one</p>'), ('s3', _expand_macro('<p>three</p>'))):
+        i_start, i_end, s_attrs = _find_span_macro(sx_page, si_span)
+        assert _content_macro_id(sx_content) in s_attrs
+        assert sx_content in sx_page[i_start:i_end]
+
+def test_update_spans_skips_unchanged_page():
+    k_page = _LocalPage(_span_macro_xhtml('s1', '<p>old</p>').strip()+_span_macro_xhtml('s2', '<p>old</p>').strip())
+
+    h_spans = {'s1': _expand_macro('<p>new</p>'), 's2': '<p>new</p>'}
+    assert k_page.update_spans(h_spans)
+    assert not k_page.update_spans(h_spans)
+    assert k_page.updates == 1
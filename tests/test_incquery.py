@@ -0,0 +1,200 @@
+import threading
+
+import pytest
+
+from opl.incquery import IncQueryProject, IncQueryProjects, QueryField, QueryResultsTable, _identity_key, _diff_rows
+
+
+def _element(si_element: str, p_compartment: str='mms-index:/c/1') -> dict:
+    return {'compartmentURI': p_compartment, 'relativeElementID': si_element}
+
+
+# project whose queries filter an in-memory list of matches by their bindings, the way the server resolves them
+class _LocalProject(IncQueryProject):
+    def __init__(self, a_matches):
+        self._a_matches = a_matches
+        self.executions = []
+
+    def execute(self, name, patterns={}, bindings={}, w_url_provider=None, timeout=None):
+        self.executions.append(dict(bindings))
+        return [
+            dict(g_match) for g_match in self._a_matches
+            if all(_identity_key(g_match.get(si_param)) == _identity_key(w_value) for si_param, w_value in bindings.items())
+        ]
+
+
+def _owned_by_field(h_bindings: dict={}) -> QueryField:
+    return QueryField(
+        join=lambda g_row: {'owner': {'relativeElementID': g_row['block']['relativeElementID']}},
+        query='ownedAttributes',
+        select=lambda g_match: g_match['name'],
+        bindings=h_bindings,
+    )
+
+
+def test_extend_rows_fold_matches_unfolded():
+    a_matches = [
+        {'owner': _element(f'b{i_block}'), 'kind': 'part' if i_attr % 2 else 'value', 'name': f'attr {i_block}.{i_attr}'}
+        for i_block in range(4) for i_attr in range(3)
+    ]
+    a_rows = [{'block': _element(si_block)} for si_block in ('b0', 'b1', 'b1', 'b3', 'missing')]
+
+    k_project = _LocalProject(a_matches)
+    a_unfolded = k_project.extend_rows(a_rows, _owned_by_field({'kind': 'part'}))
+    a_folded = k_project.extend_rows(a_rows, _owned_by_field({'kind': 'part'}), fold=True)
+
+    assert a_unfolded == [['attr 0.1'], ['attr 1.1'], ['attr 1.1'], ['attr 3.1'], []]
+    assert a_folded == a_unfolded
+
+    # folded into a single execution that keeps the static bindings
+    assert k_project.executions[-1] == {'kind': 'part'}
+    assert len(k_project.executions) == 5
+
+def test_extend_rows_fold_binds_shared_join_values():
+    a_matches = [
+        {'owner': _element(f'b{i_block}'), 'type': _element(f't{i_block % 2}'), 'name': f'attr {i_block}'}
+        for i_block in range(4)
+    ]
+
+    # every row joins on the same type
+    k_field = QueryField(
+        join=lambda g_row: {'owner': g_row['block'], 'type': {'relativeElementID': 't1'}},
+        query='typedAttributes',
+        select=lambda g_match: g_match['name'],
+    )
+    a_rows = [{'block': _element(si_block)} for si_block in ('b1', 'b2', 'b3')]
+
+    k_project = _LocalProject(a_matches)
+    assert k_project.extend_rows(a_rows, k_field, fold=True) == k_project.extend_rows(a_rows, k_field) == [['attr 1'], [], ['attr 3']]
+    assert k_project.executions[0] == {'type': {'relativeElementID': 't1'}}
+
+
+# project whose every query fails
+class _FailingProject(IncQueryProject):
+    def __init__(self):
+        pass
+
+    def execute(self, name, patterns={}, bindings={}, w_url_provider=None, timeout=None):
+        raise Exception(f'query "{name}" failed')
+
+def _local_projects(h_projects: dict) -> IncQueryProjects:
+    k_projects = IncQueryProjects.__new__(IncQueryProjects)
+    k_projects._n_workers = 4
+    k_projects._h_projects = h_projects
+    return k_projects
+
+
+def test_projects_execute_tags_rows_by_compartment():
+    k_projects = _local_projects({
+        p_compartment: _LocalProject([{'e': _element(f'e{i_match}', p_compartment)} for i_match in range(n_matches)])
+        for p_compartment, n_matches in (('mms-index:/c/1', 2), ('mms-index:/c/2', 0), ('mms-index:/c/3', 1))
+    })
+
+    a_rows = k_projects.execute('elements', tag='source')
+    assert [(g_row['e']['relativeElementID'], g_row['source']) for g_row in a_rows] == [
+        ('e0', 'mms-index:/c/1'), ('e1', 'mms-index:/c/1'), ('e0', 'mms-index:/c/3'),
+    ]
+
+def test_projects_execute_each_isolates_failures():
+    k_projects = _local_projects({
+        'mms-index:/c/1': _LocalProject([{'e': _element('a')}]),
+        'mms-index:/c/2': _FailingProject(),
+    })
+
+    h_results = k_projects.execute_each('elements')
+    assert list(h_results) == ['mms-index:/c/1', 'mms-index:/c/2']
+    assert h_results['mms-index:/c/1'] == [{'e': _element('a')}]
+    assert isinstance(h_results['mms-index:/c/2'], Exception)
+
+    with pytest.raises(Exception, match='query "elements" failed'):
+        k_projects.execute('elements')
+
+
+def test_iter_html_chunks_render_same_table():
+    a_rows = [{'name': f'<Block {i_row}>', 'parts': [f'p{i_row}', 'a&b']} for i_row in range(25)]
+    k_table = QueryResultsTable(a_rows, {'name': 'Name', 'parts': 'Parts'}, {'name': lambda s_name, g_row: s_name.upper()})
+
+    a_chunks = list(k_table.iter_html(chunk_size=10))
+    assert len(a_chunks) == 4
+    assert ''.join(a_chunks) == k_table.to_html()
+
+    # header, then rows in chunks
+    assert a_chunks[0] == '<table><tbody><tr><th>Name</th><th>Parts</th></tr>'
+    assert a_chunks[1].startswith('<tr><td><BLOCK 0></td><td><ul><li>p0</li><li>a&amp;b</li></ul></td></tr>')
+    assert a_chunks[1].count('<tr>') == a_chunks[2].count('<tr>') == 10
+    assert a_chunks[-1].endswith('</tr></tbody></table>')
+
+def test_iter_html_rewriters_override_and_labels_default():
+    k_table = QueryResultsTable([{'name': 'a<b', 'id': '1'}])
+
+    assert k_table.to_html() == '<table><tbody><tr><th>name</th><th>id</th></tr><tr><td>a&lt;b</td><td>1</td></tr></tbody></table>'
+    assert k_table.to_html({'id': lambda s_id, g_row: f'#{s_id}'}).endswith('<td>a&lt;b</td><td>#1</td></tr></tbody></table>')
+
+def test_iter_html_empty_results():
+    assert QueryResultsTable([]).to_html() == '<p>No query results and no column headers were provided. Nothing to display.</p>'
+    assert QueryResultsTable([], {'name': 'Name'}).to_html() == '<table><tbody><tr><th>Name</th></tr></tbody></table>'
+
+
+def test_diff_rows_unchanged():
+    a_rows = [{'e': _element('a'), 'name': 'A'}, {'e': _element('b'), 'name': 'B'}]
+    assert _diff_rows(a_rows, list(reversed(a_rows))) == ([], [])
+
+def test_diff_rows_added_and_removed():
+    a_previous = [{'e': _element('a'), 'name': 'A'}, {'e': _element('b'), 'name': 'B'}]
+    a_current = [{'e': _element('b'), 'name': 'B'}, {'e': _element('c'), 'name': 'C'}]
+
+    assert _diff_rows(a_previous, a_current) == ([a_current[1]], [a_previous[0]])
+
+def test_diff_rows_changed_value():
+    a_previous = [{'e': _element('a'), 'name': 'A'}]
+    a_current = [{'e': _element('a'), 'name': 'Renamed'}]
+
+    assert _diff_rows(a_previous, a_current) == (a_current, a_previous)
+
+def test_diff_rows_ignores_compartment():
+    a_previous = [{'e': _element('a', 'mms-index:/c/1'), 'owners': [_element('x', 'mms-index:/c/1')]}]
+    a_current = [{'e': _element('a', 'mms-index:/c/2'), 'owners': [_element('x', 'mms-index:/c/2')]}]
+
+    assert _diff_rows(a_previous, a_current) == ([], [])
+
+def test_diff_rows_respects_duplicates():
+    g_row = {'e': _element('a'), 'name': 'A'}
+
+    a_added, a_removed = _diff_rows([g_row], [g_row, dict(g_row), dict(g_row)])
+    assert a_added == [g_row, g_row] and a_removed == []
+
+    a_added, a_removed = _diff_rows([g_row, dict(g_row)], [g_row])
+    assert a_added == [] and a_removed == [g_row]
+
+
+# project selected by ref whose latest commit advances through the given compartments, one per poll
+class _WatchedProject(IncQueryProject):
+    def __init__(self, a_commits, h_matches):
+        self._a_ref = ('org', 'project', 'master', None)
+        self._s_compartment = a_commits[0]
+        self._a_commits = list(a_commits)
+        self._h_matches = h_matches
+        self._k_load_lock = threading.Lock()
+        self._b_loaded = True
+
+    def _latest_commit(self, si_org, si_project, s_ref=None, b_refresh=True, p_index=None):
+        return self._a_commits.pop(0) if len(self._a_commits) > 1 else self._a_commits[0]
+
+    def execute(self, name, patterns={}, bindings={}, w_url_provider=None, timeout=None):
+        return [dict(g_match) for g_match in self._h_matches[self._s_compartment]]
+
+
+def test_watch_yields_diffs_for_new_commits():
+    h_matches = {
+        'mms-index:/c/1': [{'e': _element('a', 'mms-index:/c/1')}, {'e': _element('b', 'mms-index:/c/1')}],
+        'mms-index:/c/2': [{'e': _element('b', 'mms-index:/c/2')}, {'e': _element('c', 'mms-index:/c/2')}],
+    }
+    k_project = _WatchedProject(['mms-index:/c/1', 'mms-index:/c/1', 'mms-index:/c/2'], h_matches)
+
+    h_diffs = next(k_project.watch({'blocks': ('blocks',)}, interval=0))
+
+    k_diff = h_diffs['blocks']
+    assert (k_diff.previous, k_diff.current) == ('mms-index:/c/1', 'mms-index:/c/2')
+    assert [g_row['e']['relativeElementID'] for g_row in k_diff.added] == ['c']
+    assert [g_row['e']['relativeElementID'] for g_row in k_diff.removed] == ['a']
+    assert not k_project.select_latest_commit()
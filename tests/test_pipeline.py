@@ -0,0 +1,122 @@
+import gc
+import time
+import threading
+import weakref
+
+import pytest
+
+from opl.cache import ResultCache
+from opl.incquery import QueryField
+from opl.pipeline import Pipeline
+
+
+# project whose field queries answer each row with its own name, counting the executions
+class _LocalProject:
+    compartment = 'mms-index:/c/1'
+
+    def __init__(self):
+        self.executions = 0
+
+    def extend_rows(self, a_rows, k_field, b_fold=False):
+        self.executions += 1
+        return [[k_field.select({'name': k_field.join(g_row)['name']})] for g_row in a_rows]
+
+def _name_field() -> QueryField:
+    return QueryField(join=lambda g_row: {'name': g_row['name']}, query='named', select=lambda g_match: g_match['name'].upper())
+
+
+def test_run_schedules_stages_once_inputs_are_ready():
+    k_pipeline = Pipeline()
+    a_started = []
+    k_lock = threading.Lock()
+
+    # record the order in which stages start
+    def stage(si_stage, f_output):
+        def run(*a_inputs):
+            with k_lock:
+                a_started.append(si_stage)
+            time.sleep(0.02)
+            return f_output(*a_inputs)
+        return run
+
+    # declared out of order
+    k_pipeline.stage('total', stage('total', lambda n_left, n_right: n_left+n_right), ['left', 'right'])
+    k_pipeline.stage('left', stage('left', lambda n_base: n_base*2), ['base'])
+    k_pipeline.stage('right', stage('right', lambda n_base: n_base+1), ['base'])
+    k_pipeline.stage('base', stage('base', lambda: 5))
+
+    h_results = k_pipeline.run()
+
+    assert list(h_results) == ['total', 'left', 'right', 'base']
+    assert h_results['total'].output == 16
+    assert a_started[0] == 'base' and a_started[-1] == 'total'
+    assert all(g_result.status == 'ran' for g_result in h_results.values())
+
+def test_run_rejects_invalid_graphs():
+    k_pipeline = Pipeline()
+    k_pipeline.stage('a', lambda z_b: z_b, ['b'])
+    k_pipeline.stage('b', lambda z_a: z_a, ['a'])
+    with pytest.raises(Exception, match='cycle'):
+        k_pipeline.run()
+
+    k_pipeline = Pipeline()
+    k_pipeline.stage('a', lambda z_b: z_b, ['missing'])
+    with pytest.raises(Exception, match='unknown stage "missing"'):
+        k_pipeline.run()
+
+def test_run_raises_stage_failures():
+    k_pipeline = Pipeline()
+    k_pipeline.stage('broken', lambda: 1/0)
+
+    with pytest.raises(Exception, match='stage "broken" failed') as e_info:
+        k_pipeline.run()
+    assert isinstance(e_info.value.__cause__, ZeroDivisionError)
+
+
+def test_keyed_stages_are_memoized():
+    a_calls = []
+    k_pipeline = Pipeline()
+    k_pipeline.stage('keyed', lambda: a_calls.append('keyed') or 1, key='one')
+    k_pipeline.stage('unkeyed', lambda n_one: a_calls.append('unkeyed') or n_one+1, ['keyed'])
+
+    k_pipeline.run()
+    h_results = k_pipeline.run()
+
+    assert (h_results['keyed'].status, h_results['unkeyed'].status) == ('memoized', 'ran')
+    assert a_calls == ['keyed', 'unkeyed', 'unkeyed']
+
+def test_extend_memoizes_by_callables_within_pipeline():
+    k_project = _LocalProject()
+    k_cache = ResultCache()
+
+    def extend_pipeline(k_field):
+        k_pipeline = Pipeline(cache=k_cache)
+        k_pipeline.stage('rows', lambda: [{'name': 'a'}, {'name': 'b'}], key='rows')
+        k_pipeline.extend('extended', 'rows', k_project, {'names': k_field})
+        return k_pipeline
+
+    k_pipeline = extend_pipeline(_name_field())
+    assert k_pipeline.run()['extended'].output == [{'name': 'a', 'names': ['A']}, {'name': 'b', 'names': ['B']}]
+    assert k_pipeline.run()['extended'].status == 'memoized'
+    assert k_project.executions == 1
+
+    # another pipeline does not reuse outputs that involve callables, even when sharing the cache
+    assert extend_pipeline(_name_field()).run()['extended'].status == 'ran'
+    assert k_project.executions == 2
+
+def test_callable_keys_are_not_reused():
+    k_pipeline = Pipeline()
+
+    f_first = lambda g_row: g_row
+    y_first = weakref.ref(f_first)
+    si_first = k_pipeline._callable_key(f_first)
+    assert k_pipeline._callable_key(f_first) == si_first
+
+    # keyed callables are held, so their ids cannot be taken by new ones
+    del f_first
+    gc.collect()
+    assert y_first() is not None
+
+    a_others = [lambda g_row: g_row for _ in range(100)]
+    assert si_first not in {k_pipeline._callable_key(f_other) for f_other in a_others}
+    assert Pipeline()._callable_key(y_first()) != si_first
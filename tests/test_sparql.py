@@ -0,0 +1,351 @@
+import io
+import re
+import json
+import threading
+
+import pytest
+import rdflib
+import rdflib.compare
+from SPARQLWrapper import SPARQLWrapper
+from SPARQLWrapper.SPARQLExceptions import EndPointInternalError
+
+from opl.sparql import (
+    Sparql, P_XSD, SB_PREFIXES_TURTLE, S_BATCH_VAR,
+    _tsv_term_to_binding, _bindings_to_array, _projected_vars, _batch_skeleton, _has_subquery,
+)
+from opl.transport import TransportPolicy
+
+
+@pytest.mark.parametrize('s_term, g_binding', [
+    ('', None),
+    ('<https://example.org/a>', {'type': 'uri', 'value': 'https://example.org/a'}),
+    ('_:b0', {'type': 'bnode', 'value': 'b0'}),
+    ('"plain"', {'type': 'literal', 'value': 'plain'}),
+    ('"chat"@fr', {'type': 'literal', 'value': 'chat', 'xml:lang': 'fr'}),
+    ('"chat"@en-US', {'type': 'literal', 'value': 'chat', 'xml:lang': 'en-US'}),
+    (f'"2021-01-01"^^<{P_XSD}date>', {'type': 'literal', 'value': '2021-01-01', 'datatype': P_XSD+'date'}),
+    (r'"tab\there\nnewline \"quoted\" \\ café"', {'type': 'literal', 'value': 'tab\there\nnewline "quoted" \\ café'}),
+    (r'"\U0001F600"', {'type': 'literal', 'value': '\U0001F600'}),
+    ('42', {'type': 'literal', 'value': '42', 'datatype': P_XSD+'integer'}),
+    ('-1.5', {'type': 'literal', 'value': '-1.5', 'datatype': P_XSD+'decimal'}),
+    ('1.0e3', {'type': 'literal', 'value': '1.0e3', 'datatype': P_XSD+'double'}),
+    ('true', {'type': 'literal', 'value': 'true', 'datatype': P_XSD+'boolean'}),
+])
+def test_tsv_term_to_binding(s_term, g_binding):
+    assert _tsv_term_to_binding(s_term) == g_binding
+
+
+@pytest.mark.parametrize('sx_query, a_vars', [
+    ('select * { ?s ?p ?o }', None),
+    ('select ?s ?p { ?s ?p ?o }', ['s', 'p']),
+    ('select (count(?s) as ?c) { ?s ?p ?o }', ['c']),
+    ('select ?o (count(?s) as ?c) { ?s ?p ?o } group by ?o', ['o', 'c']),
+    ('select distinct ?a (str(coalesce(?x, (1+2))) AS $b) ?d where { }', ['a', 'b', 'd']),
+])
+def test_projected_vars(sx_query, a_vars):
+    assert _projected_vars(sx_query) == a_vars
+
+
+def _literal(s_value: str, s_type: str) -> dict:
+    return {'type': 'literal', 'value': s_value, 'datatype': P_XSD+s_type}
+
+def test_bindings_to_array_types():
+    np = pytest.importorskip('numpy')
+
+    a_ints = _bindings_to_array([_literal('1', 'integer'), _literal('-2', 'long')])
+    assert a_ints.dtype == np.int64 and a_ints.tolist() == [1, -2]
+
+    a_floats = _bindings_to_array([_literal('1', 'integer'), None])
+    assert a_floats.dtype == np.float64 and a_floats[0] == 1 and np.isnan(a_floats[1])
+
+    a_times = _bindings_to_array([_literal('2021-01-01T10:00:00+02:00', 'dateTime'), None])
+    assert a_times.dtype == np.dtype('datetime64[us]')
+    assert str(a_times[0]) == '2021-01-01T08:00:00.000000' and np.isnat(a_times[1])
+
+def test_bindings_to_array_falls_back_outside_native_ranges():
+    np = pytest.importorskip('numpy')
+
+    # beyond int64
+    a_ints = _bindings_to_array([_literal('99999999999999999999', 'integer'), _literal('1', 'integer')])
+    assert a_ints.dtype == object and a_ints.tolist() == [99999999999999999999, 1]
+
+    # rejected by datetime
+    for s_value in ('-0044-03-15T12:00:00', '2021-01-01T24:00:00'):
+        a_times = _bindings_to_array([_literal(s_value, 'dateTime'), None])
+        assert a_times.dtype == object and a_times.tolist() == [s_value, None]
+
+    # malformed lexical forms
+    assert _bindings_to_array([_literal('n/a', 'integer')]).tolist() == ['n/a']
+    assert _bindings_to_array([_literal('2021-13-45', 'date')]).tolist() == ['2021-13-45']
+
+
+# stands in for `SPARQLWrapper.query`, answering `limit`/`offset` windows over a fixed list of rows
+def _paged_endpoint(n_rows: int, n_failures: int=0):
+    a_queries = []
+    h_failures = {}
+
+    class _Results:
+        def __init__(self, g_document):
+            self._g_document = g_document
+
+        def info(self):
+            return {}
+
+        def convert(self):
+            return self._g_document
+
+    def query(y_store):
+        sx_query = y_store.queryString
+        a_queries.append(sx_query)
+        n_limit = int(re.search(r'\blimit (\d+)', sx_query).group(1))
+        i_offset = int(re.search(r'\boffset (\d+)', sx_query).group(1))
+
+        # fail the first attempts at each page
+        h_failures[i_offset] = h_failures.get(i_offset, 0)+1
+        if h_failures[i_offset] <= n_failures:
+            raise EndPointInternalError('overloaded')
+
+        return _Results({'head': {'vars': ['i']}, 'results': {'bindings': [
+            {'i': {'type': 'literal', 'value': str(i_row)}} for i_row in range(i_offset, min(n_rows, i_offset+n_limit))
+        ]}})
+
+    return query, a_queries
+
+
+def test_fetch_paginated_stitches_pages_in_order(monkeypatch):
+    f_query, a_queries = _paged_endpoint(25)
+    monkeypatch.setattr(SPARQLWrapper, 'query', f_query)
+
+    a_rows = Sparql('http://localhost/sparql').fetch_paginated('select ?i { ?s ?p ?i }', page_size=10, max_workers=2)
+
+    assert [g_row['i']['value'] for g_row in a_rows] == [str(i_row) for i_row in range(25)]
+    assert all('order by ?i' in sx_query for sx_query in a_queries)
+    assert len(a_queries) == 4
+
+def test_fetch_paginated_rejects_limited_query():
+    with pytest.raises(Exception, match='LIMIT'):
+        Sparql('http://localhost/sparql').fetch_paginated('select ?i { ?s ?p ?i } limit 5')
+
+def test_fetch_paginated_retries_take_precedence(monkeypatch):
+    k_sparql = Sparql('http://localhost/sparql', transport=TransportPolicy(retries=0, backoff=0, breaker_threshold=None))
+
+    # instance policy does not retry
+    monkeypatch.setattr(SPARQLWrapper, 'query', _paged_endpoint(5, n_failures=1)[0])
+    with pytest.raises(Exception):
+        k_sparql.fetch_paginated('select ?i { ?s ?p ?i }', page_size=10, max_workers=1)
+
+    # explicit retries do
+    f_query, a_queries = _paged_endpoint(5, n_failures=1)
+    monkeypatch.setattr(SPARQLWrapper, 'query', f_query)
+    a_rows = k_sparql.fetch_paginated('select ?i { ?s ?p ?i }', page_size=10, max_workers=1, retries=1)
+    assert len(a_rows) == 5 and len(a_queries) == 2
+
+
+def test_batch_skeleton_projects_batch_variables():
+    s_var = '?'+S_BATCH_VAR+'s'
+    s_head, s_tail = _batch_skeleton(f'select ?x where {{ {s_var} ?p ?x }}', ['s'])
+
+    assert s_head == f'select {s_var} ?x where {{\n    values ({s_var}) {{\n'
+    assert s_tail == f'    }}\n {s_var} ?p ?x }}'
+
+def test_batch_skeleton_select_all_keeps_modifiers():
+    s_var = '?'+S_BATCH_VAR+'s'
+    s_head, s_tail = _batch_skeleton(f'select * {{ {s_var} ?p ?x }} order by ?x', ['s'])
+
+    assert s_head == f'select * {{\n    values ({s_var}) {{\n'
+    assert s_tail.endswith('} order by ?x')
+
+def test_batch_skeleton_several_variables():
+    s_head, _ = _batch_skeleton('select distinct ?x { ?a ?b ?x }', ['a', 'b'])
+    a_vars = ' '.join('?'+S_BATCH_VAR+si_var for si_var in ('a', 'b'))
+
+    assert s_head.startswith(f'select distinct {a_vars} ?x {{')
+    assert f'values ({a_vars})' in s_head
+
+@pytest.mark.parametrize('sx_query', [
+    'select ?x { ?s ?p ?x } limit 10',
+    'select ?x { ?s ?p ?x } offset 10',
+    'select ?x (count(?s) as ?n) { ?s ?p ?x } group by ?x',
+    'select (max(?x) as ?m) { ?s ?p ?x }',
+    'select ?x { ?s ?p ?x } group by ?x having (?x > 1)',
+])
+def test_batch_skeleton_rejects_whole_result_modifiers(sx_query):
+    with pytest.raises(Exception, match='cannot batch'):
+        _batch_skeleton(sx_query, ['s'])
+
+def test_batch_skeleton_rejects_non_select():
+    with pytest.raises(Exception, match='SELECT'):
+        _batch_skeleton('construct { ?s ?p ?o } where { ?s ?p ?o }', ['s'])
+
+@pytest.mark.parametrize('sx_query, b_subquery', [
+    ('select ?x { ?s ?p ?x } order by ?x limit 10', False),
+    ('select ?x { ?s ?p ?x { select ?s { ?s a ?t } } }', True),
+    ('select ?x { ?s ?p ?x { select ?s { ?s a ?t } limit 1 } }', True),
+    ('select * where { ?s ?p ?x . { select (count(?o) as ?n) { ?s ?q ?o } } }', True),
+])
+def test_has_subquery(sx_query, b_subquery):
+    assert _has_subquery(sx_query) == b_subquery
+
+
+# stands in for `SPARQLWrapper.query`, evaluating each query against an in-memory graph
+def _graph_endpoint(y_graph: rdflib.Graph):
+    a_queries = []
+
+    # rdflib's query parser is not thread-safe
+    y_lock = threading.Lock()
+
+    class _Results:
+        def __init__(self, sb_document):
+            self._sb_document = sb_document
+
+        def info(self):
+            return {}
+
+        def convert(self):
+            return json.loads(self._sb_document)
+
+    def query(y_store):
+        with y_lock:
+            a_queries.append(y_store.queryString)
+            return _Results(y_graph.query(y_store.queryString).serialize(format='json'))
+
+    return query, a_queries
+
+def _batch_graph() -> rdflib.Graph:
+    y_graph = rdflib.Graph()
+    for i_node in range(4):
+        for i_child in range(i_node+1):
+            y_graph.add((rdflib.URIRef(f'https://example.org/n{i_node}'), rdflib.URIRef('https://example.org/child'), rdflib.Literal(f'c{i_node}.{i_child}')))
+    return y_graph
+
+def _values(a_results) -> list:
+    return [sorted(g_row[si_var]['value'] for g_row in a_rows for si_var in g_row) for a_rows in a_results]
+
+A_BATCH_INPUTS = [{'node': f'https://example.org/n{i_node}'} for i_node in (2, 0, 3, 2)]
+
+def test_fetch_batch_binds_varying_variables(monkeypatch):
+    f_query, a_queries = _graph_endpoint(_batch_graph())
+    monkeypatch.setattr(SPARQLWrapper, 'query', f_query)
+
+    s_template = 'select ?c { <$node> <https://example.org/child> ?c }'
+    a_results = Sparql('http://localhost/sparql').fetch_batch(s_template, A_BATCH_INPUTS)
+
+    assert _values(a_results) == [['c2.0', 'c2.1', 'c2.2'], ['c0.0'], ['c3.0', 'c3.1', 'c3.2', 'c3.3'], ['c2.0', 'c2.1', 'c2.2']]
+    assert len(a_queries) == 1
+
+@pytest.mark.parametrize('s_template', [
+    # varying variable inside the subquery
+    'select ?n { { select (count(?c) as ?n) { <$node> <https://example.org/child> ?c } } }',
+    # limit inside the subquery
+    'select ?c { { select ?c { <$node> <https://example.org/child> ?c } order by ?c limit 2 } }',
+])
+def test_fetch_batch_fetches_subqueries_per_input(monkeypatch, s_template):
+    f_query, a_queries = _graph_endpoint(_batch_graph())
+    monkeypatch.setattr(SPARQLWrapper, 'query', f_query)
+
+    k_sparql = Sparql('http://localhost/sparql')
+    a_results = k_sparql.fetch_batch(s_template, A_BATCH_INPUTS)
+
+    # one query per distinct set
+    assert len(a_queries) == 3
+    assert _values(a_results) == _values([k_sparql.fetch(Sparql.load(s_template, h_vars)) for h_vars in A_BATCH_INPUTS])
+    assert len(a_results[2][0]) == 1
+
+
+S_TEMPLATE = '''
+# @def typed
+    ?s a <$type> .
+    ?s rdfs:label ?label .
+# @end
+select ?s ?label {
+    # @mixin typed
+    # @inject $filter
+}
+'''
+
+def test_compiled_template_renders_like_load():
+    k_template = Sparql.compile(S_TEMPLATE)
+    assert k_template is Sparql.compile(S_TEMPLATE)
+    assert k_template.variables == ['type']
+
+    for si_type in ('Block', 'Port'):
+        h_vars = {'type': f'https://example.org/{si_type}', 'other': 'https://example.org/x'}
+        h_injections = {'filter': 'filter(?s != <$other>)'}
+
+        sx_query = k_template.render(h_vars, h_injections)
+        assert sx_query == Sparql.load(S_TEMPLATE, h_vars, h_injections)
+        assert sx_query == (
+            'select ?s ?label {\n    \n'
+            f'    ?s a <https://example.org/{si_type}> .\n    ?s rdfs:label ?label .\n    \n'
+            '    filter(?s != <https://example.org/x>)\n}'
+        )
+
+def test_template_keeps_undeclared_injections():
+    sx_query = Sparql.compile(S_TEMPLATE).render({'type': 'https://example.org/Block'})
+    assert sx_query.endswith('    # @inject $filter\n}')
+
+def test_template_requires_variables():
+    with pytest.raises(Exception, match='requires a value for the variable "type"'):
+        Sparql.compile(S_TEMPLATE).render({})
+
+
+SB_NTRIPLES = (
+    b'<https://example.org/a> <https://example.org/label> "A"@en .\n'
+    b'# comment\n'
+    b'\n'
+    b'<https://example.org/a> <https://example.org/next> <https://example.org/b> .\n'
+    b'_:n0 <https://example.org/count> "2"^^<http://www.w3.org/2001/XMLSchema#integer> .\n'
+)
+
+# stands in for `SPARQLWrapper.query`, answering every query with a fixed N-Triples document
+def _construct_endpoint():
+    a_responses = []
+
+    class _Response(io.BytesIO):
+        pass
+
+    class _Results:
+        def __init__(self):
+            self.response = _Response(SB_NTRIPLES)
+            a_responses.append(self.response)
+
+        def info(self):
+            return {}
+
+    return lambda y_store: _Results(), a_responses
+
+
+def test_construct_triples_streams_lines(monkeypatch):
+    f_query, a_responses = _construct_endpoint()
+    monkeypatch.setattr(SPARQLWrapper, 'query', f_query)
+
+    a_triples = list(Sparql('http://localhost/sparql').construct_triples('construct { ?s ?p ?o } where { ?s ?p ?o }'))
+
+    assert [(y_subject.n3(), y_predicate.n3()) for y_subject, y_predicate, _ in a_triples[:2]] == [
+        ('<https://example.org/a>', '<https://example.org/label>'),
+        ('<https://example.org/a>', '<https://example.org/next>'),
+    ]
+    assert a_triples[0][2] == rdflib.Literal('A', lang='en')
+    assert isinstance(a_triples[2][0], rdflib.BNode) and a_triples[2][2].toPython() == 2
+    assert a_responses[0].closed
+
+def test_construct_graph_streaming_matches_parsed(monkeypatch):
+    f_query, a_responses = _construct_endpoint()
+    monkeypatch.setattr(SPARQLWrapper, 'query', f_query)
+
+    k_sparql = Sparql('http://localhost/sparql')
+    y_streamed = k_sparql.construct_graph('construct { ?s ?p ?o } where { ?s ?p ?o }', streaming=True)
+    y_parsed = k_sparql.construct_graph('construct { ?s ?p ?o } where { ?s ?p ?o }')
+
+    assert len(y_streamed) == len(y_parsed) == 3
+    assert rdflib.compare.isomorphic(y_streamed, y_parsed)
+    assert all(d_response.closed for d_response in a_responses)
+
+def test_construct_stream_prepends_prefixes(monkeypatch):
+    monkeypatch.setattr(SPARQLWrapper, 'query', _construct_endpoint()[0])
+
+    d_output = Sparql('http://localhost/sparql').construct_stream('construct { ?s ?p ?o } where { ?s ?p ?o }', chunk_size=16)
+    sb_document = d_output.read()
+
+    assert sb_document.startswith(SB_PREFIXES_TURTLE+b'\n')
+    assert sb_document.endswith(SB_NTRIPLES)
@@ -0,0 +1,247 @@
+import time
+import threading
+
+import pytest
+import requests
+import urllib3
+import iqs_client
+
+from opl import transport
+from opl.transport import TransportPolicy, CircuitOpen, is_transient, _is_unsent
+
+
+def _api_error(n_status: int) -> iqs_client.rest.ApiException:
+    return iqs_client.rest.ApiException(status=n_status)
+
+def _http_error(n_status: int) -> requests.HTTPError:
+    d_response = requests.Response()
+    d_response.status_code = n_status
+    return requests.HTTPError(response=d_response)
+
+def _refused() -> requests.ConnectionError:
+    return requests.ConnectionError(urllib3.exceptions.MaxRetryError(None, '/', urllib3.exceptions.NewConnectionError(None, 'refused')))
+
+# function that raises the given errors in turn, then returns 'ok'
+def _flaky(*a_errors):
+    a_calls = []
+
+    def f_call():
+        a_calls.append(None)
+        if len(a_calls) <= len(a_errors):
+            raise a_errors[len(a_calls)-1]
+        return 'ok'
+
+    return f_call, a_calls
+
+
+@pytest.mark.parametrize('e_error', [
+    _api_error(503), _api_error(429), _http_error(502), _http_error(408),
+    ConnectionResetError(), requests.ReadTimeout(), _refused(),
+])
+def test_transient_errors(e_error):
+    assert is_transient(e_error)
+
+@pytest.mark.parametrize('e_error', [
+    _api_error(400), _api_error(401), _http_error(404), _http_error(501), ValueError('no'),
+])
+def test_permanent_errors(e_error):
+    assert not is_transient(e_error)
+
+def test_wrapped_errors_are_classified_by_cause():
+    try:
+        try:
+            raise requests.ReadTimeout()
+        except Exception as e_timeout:
+            raise Exception('while querying') from e_timeout
+    except Exception as e_wrapped:
+        assert is_transient(e_wrapped)
+
+def test_unsent_errors():
+    assert _is_unsent(_refused())
+    assert _is_unsent(_api_error(429))
+    assert not _is_unsent(_api_error(503))
+    assert not _is_unsent(requests.ReadTimeout())
+
+
+def test_retries_transient_failures():
+    f_call, a_calls = _flaky(_api_error(503), requests.ConnectionError())
+    assert TransportPolicy(retries=2, backoff=0).call('e', f_call) == 'ok'
+    assert len(a_calls) == 3
+
+def test_gives_up_after_retries():
+    f_call, a_calls = _flaky(*[_api_error(503)]*3)
+    with pytest.raises(iqs_client.rest.ApiException):
+        TransportPolicy(retries=1, backoff=0).call('e', f_call)
+    assert len(a_calls) == 2
+
+def test_does_not_retry_permanent_failures():
+    f_call, a_calls = _flaky(_api_error(400))
+    with pytest.raises(iqs_client.rest.ApiException):
+        TransportPolicy(retries=3, backoff=0).call('e', f_call)
+    assert len(a_calls) == 1
+
+def test_retries_writes_only_when_unsent():
+    k_policy = TransportPolicy(retries=3, backoff=0)
+
+    # may have been applied
+    for e_error in (_api_error(503), requests.ReadTimeout()):
+        f_call, a_calls = _flaky(e_error)
+        with pytest.raises(type(e_error)):
+            k_policy.call('e', f_call, idempotent=False)
+        assert len(a_calls) == 1
+
+    # never reached the server
+    f_call, a_calls = _flaky(_refused(), _api_error(429))
+    assert k_policy.call('e', f_call, idempotent=False) == 'ok'
+    assert len(a_calls) == 3
+
+def test_no_retry_after_timeout():
+    a_calls = []
+
+    def f_call():
+        a_calls.append(None)
+        time.sleep(0.1)
+        raise requests.ReadTimeout()
+
+    with pytest.raises(requests.ReadTimeout):
+        TransportPolicy(retries=5, backoff=0).call('e', f_call, timeout=0.1)
+    assert len(a_calls) == 1
+
+
+def test_derived_policy_overrides_retries_and_shares_breakers():
+    k_policy = TransportPolicy(retries=0, backoff=0, breaker_threshold=2)
+
+    f_call, a_calls = _flaky(_api_error(503))
+    assert k_policy.derive(retries=1).call('r', f_call) == 'ok'
+    assert len(a_calls) == 2
+
+    # failures through either policy count toward the same circuit
+    k_derived = k_policy.derive(backoff=0.01)
+    for k_failing in (k_policy, k_derived):
+        with pytest.raises(iqs_client.rest.ApiException):
+            k_failing.call('e', _flaky(_api_error(503))[0])
+
+    with pytest.raises(CircuitOpen):
+        k_policy.call('e', _flaky()[0])
+
+def test_module_call_falls_back_to_default_policy(monkeypatch):
+    monkeypatch.setattr(transport, 'DEFAULT_POLICY', TransportPolicy(retries=1, backoff=0))
+
+    f_call, a_calls = _flaky(_api_error(503))
+    assert transport.call(None, 'e', f_call) == 'ok'
+    assert len(a_calls) == 2
+
+    f_call, a_calls = _flaky(_api_error(503))
+    with pytest.raises(iqs_client.rest.ApiException):
+        transport.call(TransportPolicy(retries=0), 'e', f_call)
+
+
+def test_circuit_breaker_opens_and_half_opens():
+    k_policy = TransportPolicy(retries=0, breaker_threshold=2, breaker_reset=0.1)
+
+    # open after consecutive transient failures
+    for _ in range(2):
+        with pytest.raises(iqs_client.rest.ApiException):
+            k_policy.call('e', _flaky(_api_error(503))[0])
+
+    f_call, a_calls = _flaky()
+    with pytest.raises(CircuitOpen):
+        k_policy.call('e', f_call)
+    assert not a_calls
+
+    # other endpoints are unaffected
+    assert k_policy.call('other', f_call) == 'ok'
+
+    # a single trial request is let through once the cool-down passed
+    time.sleep(0.15)
+    k_release = threading.Event()
+    k_started = threading.Event()
+
+    def f_trial():
+        k_started.set()
+        k_release.wait()
+        return 'trial'
+
+    a_trial = []
+    y_trial = threading.Thread(target=lambda: a_trial.append(k_policy.call('e', f_trial)))
+    y_trial.start()
+    k_started.wait()
+
+    with pytest.raises(CircuitOpen):
+        k_policy.call('e', f_call)
+
+    k_release.set()
+    y_trial.join()
+    assert a_trial == ['trial']
+
+    # successful trial closes the circuit
+    assert k_policy.call('e', f_call) == 'ok'
+
+def test_circuit_breaker_reopens_after_failed_trial():
+    k_policy = TransportPolicy(retries=0, breaker_threshold=1, breaker_reset=0.05)
+
+    with pytest.raises(iqs_client.rest.ApiException):
+        k_policy.call('e', _flaky(_api_error(503))[0])
+
+    time.sleep(0.08)
+    with pytest.raises(iqs_client.rest.ApiException):
+        k_policy.call('e', _flaky(_api_error(503))[0])
+
+    with pytest.raises(CircuitOpen):
+        k_policy.call('e', _flaky()[0])
+
+def test_permanent_failures_do_not_open_circuit():
+    k_policy = TransportPolicy(retries=0, breaker_threshold=1)
+
+    for _ in range(3):
+        with pytest.raises(iqs_client.rest.ApiException):
+            k_policy.call('e', _flaky(_api_error(400))[0])
+
+    assert k_policy.call('e', _flaky()[0]) == 'ok'
+
+
+class _Response:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def _warm_up(k_policy: TransportPolicy, n_samples: int):
+    for _ in range(n_samples):
+        k_policy.call('e', lambda: time.sleep(0.01))
+
+def test_hedges_slow_reads_and_closes_loser():
+    k_policy = TransportPolicy(hedge_percentile=50, hedge_min_samples=3)
+    _warm_up(k_policy, 3)
+
+    a_responses = []
+
+    def f_call():
+        d_response = _Response()
+        a_responses.append(d_response)
+        time.sleep(0.5 if len(a_responses) == 1 else 0.01)
+        return d_response
+
+    x_start = time.monotonic()
+    d_winner = k_policy.call('e', f_call)
+    assert time.monotonic()-x_start < 0.4
+    assert d_winner is a_responses[1] and not d_winner.closed
+
+    # loser is closed once it finishes
+    time.sleep(0.6)
+    assert a_responses[0].closed
+
+def test_does_not_hedge_writes():
+    k_policy = TransportPolicy(hedge_percentile=50, hedge_min_samples=3)
+    _warm_up(k_policy, 3)
+
+    a_calls = []
+
+    def f_call():
+        a_calls.append(None)
+        time.sleep(0.1)
+        return 'ok'
+
+    assert k_policy.call('e', f_call, idempotent=False) == 'ok'
+    assert len(a_calls) == 1